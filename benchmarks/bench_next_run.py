@@ -0,0 +1,63 @@
+"""
+Measures the cost of computing a job's next run when its schedule has gone stale,
+e.g. after the job was disabled for 30 days, comparing iterating over the rrule
+from the stale next run against fast-forwarding it first.
+
+Run from the project root with:
+
+    PYTHONPATH=. python benchmarks/bench_next_run.py
+"""
+import os
+import sys
+import time
+from datetime import timedelta
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chroniker.tests.settings')
+
+import django # pylint: disable=wrong-import-position
+
+django.setup()
+
+from django.utils import timezone # pylint: disable=wrong-import-position
+
+from chroniker import constants as c # pylint: disable=wrong-import-position
+from chroniker.models import Job, clear_rrule_cache # pylint: disable=wrong-import-position
+
+STALE_DAYS = 30
+
+SCHEDULES = (
+    (c.SECONDLY, 'interval:1'),
+    (c.SECONDLY, 'interval:7'),
+    (c.MINUTELY, 'interval:1'),
+    (c.MINUTELY, 'interval:5'),
+    (c.HOURLY, 'interval:1'),
+    (c.DAILY, 'interval:1'),
+    (c.HOURLY, 'interval:1;byminute:0,30'),
+)
+
+
+def bench(func, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        result = func()
+    return result, (time.perf_counter() - t0) / repeat
+
+
+def main():
+    now = timezone.now()
+    next_run = (now - timedelta(days=STALE_DAYS)).replace(microsecond=0)
+    print('next_run %i days stale' % STALE_DAYS)
+    print('%-10s %-28s %14s %14s %10s' % ('frequency', 'params', 'before (msec)', 'after (msec)', 'speedup'))
+    for frequency, params in SCHEDULES:
+        job = Job(frequency=frequency, params=params, next_run=next_run)
+        repeat = 1 if frequency == c.SECONDLY else 10
+        clear_rrule_cache()
+        expected, before = bench(lambda: job.rrule.after(now), repeat) # pylint: disable=cell-var-from-loop
+        clear_rrule_cache()
+        actual, after = bench(lambda: job.get_next_run_after(now), repeat) # pylint: disable=cell-var-from-loop
+        assert actual == expected, (frequency, params, actual, expected)
+        print('%-10s %-28s %14.3f %14.3f %9.0fx' % (frequency, params, before * 1e3, after * 1e3, before / after))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
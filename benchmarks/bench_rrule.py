@@ -0,0 +1,91 @@
+"""
+Measures the per-job cost of building each job's rrule, comparing the original
+uncached implementation against the cached one, for a table of 10k jobs.
+
+Each job's rrule is accessed three times, as happens when a job is saved,
+run and then displayed in admin.
+
+Run from the project root with:
+
+    PYTHONPATH=. python benchmarks/bench_rrule.py
+"""
+import os
+import sys
+import time
+from datetime import timedelta
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chroniker.tests.settings')
+
+import django # pylint: disable=wrong-import-position
+
+django.setup()
+
+from dateutil import rrule # pylint: disable=wrong-import-position
+from django.utils import timezone # pylint: disable=wrong-import-position
+
+from chroniker import constants as c # pylint: disable=wrong-import-position
+from chroniker.models import Job, clear_rrule_cache # pylint: disable=wrong-import-position
+
+JOBS = 10000
+ACCESSES = 3
+
+PARAMS = (
+    None,
+    'interval:15',
+    'interval:10;byhour:7,8,9',
+    'byweekday:MO,TU,WE,TH,FR;byhour:6',
+    'bymonthday:1,15;byhour:0;byminute:30',
+)
+
+FREQUENCIES = (c.MINUTELY, c.HOURLY, c.DAILY, c.WEEKLY)
+
+
+def get_rrule_uncached(job):
+    """
+    The original implementation, which parsed params and built a new rrule on every access.
+    """
+    params = {}
+    for param in (job.params or '').split(';'):
+        if param.strip() == '':
+            continue
+        param = param.split(':')
+        if len(param) == 2:
+            values = [job.param_to_int(p.strip()) for p in param[1].split(',')]
+            params[param[0].strip()] = values[0] if len(values) == 1 else values
+    return rrule.rrule(getattr(rrule, job.frequency), dtstart=job.next_run, **params)
+
+
+def get_jobs():
+    now = timezone.now().replace(microsecond=0)
+    return [
+        Job(
+            id=i,
+            frequency=FREQUENCIES[i % len(FREQUENCIES)],
+            params=PARAMS[i % len(PARAMS)],
+            next_run=now + timedelta(seconds=i),
+        ) for i in range(JOBS)
+    ]
+
+
+def bench(label, jobs, func):
+    t0 = time.perf_counter()
+    for _ in range(ACCESSES):
+        for job in jobs:
+            func(job)
+    seconds = time.perf_counter() - t0
+    print('%-28s %8.3f sec total %8.2f usec/job' % (label, seconds, seconds / len(jobs) * 1e6))
+    return seconds
+
+
+def main():
+    jobs = get_jobs()
+    print('%i jobs, %i rrule accesses per job' % (len(jobs), ACCESSES))
+    before = bench('before (uncached)', jobs, get_rrule_uncached)
+    clear_rrule_cache()
+    after = bench('after (cached, cold start)', jobs, lambda job: job.rrule)
+    warm = bench('after (cached, warm)', jobs, lambda job: job.rrule)
+    print('speedup: %.1fx cold, %.1fx warm' % (before / after, before / warm))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
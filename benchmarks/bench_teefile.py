@@ -0,0 +1,105 @@
+"""
+Measures the throughput of capturing a job's output with TeeFile, comparing the
+original implementation, which filtered out non-ASCII characters one at a time
+and sent every write to the supervisor's queue, against the current one.
+
+A job printing 100 MB of mixed ASCII and non-ASCII lines is simulated with the
+same options handle_run() uses, with the output also sent to a queue drained by
+a thread, as the supervisor does.
+
+Run from the project root with:
+
+    PYTHONPATH=. python benchmarks/bench_teefile.py [megabytes]
+"""
+import os
+import sys
+import threading
+import time
+from io import StringIO
+from multiprocessing import Queue, current_process
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'chroniker.tests.settings')
+
+import django # pylint: disable=wrong-import-position
+
+django.setup()
+
+from chroniker.utils import TeeFile # pylint: disable=wrong-import-position
+
+LINES = (
+    'Processed record 1234 of 100000 in 0.0012 seconds.\n',
+    'Importé «données» depuis le fichier client_ÿ.csv\n',
+    'Загружено 512 записей из таблицы пользователей\n',
+    '処理が完了しました: 1024 件のレコード ✓\n',
+    'Warning: retrying request to https://example.com/api/v1/items?page=7\n',
+)
+
+
+class OriginalTeeFile(StringIO):
+    """
+    The original implementation.
+    """
+
+    def __init__(self, file, auto_flush=False, queue=None, local=True): # pylint: disable=W0622
+        super().__init__()
+        self.file = file
+        self.auto_flush = auto_flush
+        self.length = 0
+        self.queue = queue
+        self.queue_buffer = []
+        self.local = local
+
+    def write(self, s):
+        s = ''.join(_ for _ in s if ord(_) < 128)
+        self.length += len(s)
+        self.file.write(s)
+        if self.local:
+            StringIO.write(self, s)
+        if self.auto_flush:
+            self.flush()
+        if self.queue is not None:
+            self.queue_buffer.append(s)
+
+    def flush(self):
+        self.file.flush()
+        StringIO.flush(self)
+        if self.queue is not None:
+            data = (current_process().pid, ''.join(self.queue_buffer)) # pylint: disable=E1102
+            self.queue.put(data)
+            self.queue_buffer = []
+
+
+def drain(queue):
+    while 1:
+        if queue.get() is None:
+            return
+
+
+def bench(label, cls, megabytes):
+    line_count = megabytes * 1024 * 1024 // (sum(len(_.encode('utf-8')) for _ in LINES) // len(LINES))
+    queue = Queue()
+    drainer = threading.Thread(target=drain, args=(queue,), daemon=True)
+    drainer.start()
+    with open(os.devnull, 'w', encoding='utf-8') as devnull:
+        tee = cls(devnull, auto_flush=True, queue=queue, local=True)
+        t0 = time.perf_counter()
+        for i in range(line_count):
+            tee.write(LINES[i % len(LINES)])
+        tee.flush()
+        seconds = time.perf_counter() - t0
+    queue.put(None)
+    drainer.join()
+    print('%-10s %8i lines %8.2f sec %8.1f MB/s %12i chars kept' % (label, line_count, seconds, megabytes / seconds, len(tee.getvalue())))
+    return seconds
+
+
+def main():
+    megabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    print('Writing %i MB of mixed-Unicode lines' % megabytes)
+    before = bench('before', OriginalTeeFile, megabytes)
+    after = bench('after', TeeFile, megabytes)
+    print('speedup: %.1fx' % (before / after))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
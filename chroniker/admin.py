@@ -1,3 +1,6 @@
+import hashlib
+from datetime import timedelta
+
 from django import forms
 from django.conf import settings
 from django.urls import re_path as url
@@ -5,22 +8,27 @@ from django.contrib import admin
 from django.core.management import get_commands
 from django.urls import reverse, NoReverseMatch
 from django.db import models
+from django.db.models import BooleanField, Count, ExpressionWrapper, IntegerField, OuterRef, Subquery
 from django.forms import TextInput
 from django.shortcuts import render
 from django.utils.encoding import force_str as force_text
-from django.http import HttpResponseRedirect, Http404, HttpResponse
+from django.http import (
+    HttpResponseRedirect, Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotModified, JsonResponse, StreamingHttpResponse
+)
 from django.utils import dateformat, timezone
 from django.utils.datastructures import MultiValueDict
 from django.utils.formats import get_format
 from django.utils.html import format_html
 from django.utils.text import capfirst
+from django.utils.cache import patch_vary_headers
+from django.utils.http import quote_etag
 try:
     from django.utils.translation import gettext_lazy as _
 except ImportError:
     from django.utils.translation import ugettext_lazy as _
 
-from chroniker.models import Job, Log, JobDependency, Monitor
-from chroniker import utils
+from chroniker.models import Job, Log, LogOutput, JobDailyStats, JobDependency, JobRuntimeState, Monitor
+from chroniker import notify, settings as _settings, utils
 from chroniker.widgets import ImproveRawIdFieldsFormTabularInline
 
 try:
@@ -28,6 +36,9 @@ try:
 except ImportError:
     ApproxCountQuerySet = None
 
+# The number of days of statistics summarized on each job.
+RUN_STATS_DAYS = 30
+
 
 class JobDependencyInline(ImproveRawIdFieldsFormTabularInline):
     model = JobDependency
@@ -39,7 +50,31 @@ class JobDependencyInline(ImproveRawIdFieldsFormTabularInline):
     raw_id_fields = ('dependee',)
 
 
+class JobForm(forms.ModelForm):
+    """
+    Edits the job along with its force_stop flag, which is kept in its runtime state.
+    """
+
+    force_stop = forms.BooleanField(required=False, help_text=_("If checked, and running then this job will be stopped."))
+
+    class Meta:
+        model = Job
+        exclude = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.instance.pk:
+            self.fields['force_stop'].initial = self.instance.force_stop
+
+    def save(self, commit=True):
+        if self.instance.force_stop != self.cleaned_data['force_stop']:
+            self.instance.force_stop = self.cleaned_data['force_stop']
+        return super().save(commit=commit)
+
+
 class JobAdmin(admin.ModelAdmin):
+    form = JobForm
+
     formfield_overrides = {
         models.CharField: {
             'widget': TextInput(attrs={
@@ -94,6 +129,7 @@ class JobAdmin(admin.ModelAdmin):
         'total_parts_complete',
         'progress_percent_str',
         'estimated_completion_datetime_str',
+        'run_stats',
         'monitor_records',
         'current_hostname',
         'current_pid',
@@ -107,6 +143,7 @@ class JobAdmin(admin.ModelAdmin):
         'is_running',
         'last_run_successful',
         'hostname',
+        'concurrency_group',
         'is_monitor',
     )
     filter_horizontal = ('subscribers',)
@@ -119,6 +156,7 @@ class JobAdmin(admin.ModelAdmin):
                 'args',
                 'raw_command',
                 'hostname',
+                'concurrency_group',
                 'current_hostname',
                 'current_pid',
             )
@@ -135,6 +173,7 @@ class JobAdmin(admin.ModelAdmin):
                     'total_parts_complete',
                     'progress_percent_str',
                     'estimated_completion_datetime_str',
+                    'run_stats',
                     'last_heartbeat',
                     'last_run_start_timestamp',
                     'last_run',
@@ -189,10 +228,12 @@ class JobAdmin(admin.ModelAdmin):
     search_fields = (
         'name',
         'hostname',
-        'current_hostname',
-        'current_pid',
+        'runtime__current_hostname',
+        'runtime__current_pid',
     )
 
+    list_select_related = ('runtime',)
+
     inlines = (JobDependencyInline,)
 
     class Media:
@@ -204,6 +245,19 @@ class JobAdmin(admin.ModelAdmin):
             qs = qs._clone(klass=ApproxCountQuerySet)
         return qs
 
+    def get_queryset(self, request):
+        """
+        Annotates each job with its latest log, number of logs and staleness,
+        so the changelist is loaded in a fixed number of queries instead of several per job.
+        """
+        qs = super().get_queryset(request)
+        logs = Log.objects.filter(job=OuterRef('pk'))
+        return qs.annotate(
+            latest_log_id=Subquery(logs.order_by('-run_start_datetime', '-id').values('id')[:1]),
+            log_count=Subquery(logs.order_by().values('job').annotate(count=Count('id')).values('count'), output_field=IntegerField()),
+            stale=ExpressionWrapper(Job.objects.stale_q(), output_field=BooleanField()),
+        )
+
     def get_readonly_fields(self, request, obj=None):
         fields = list(self.readonly_fields)
         if getattr(settings, 'CHRONIKER_DISABLE_RAW_COMMAND', False):
@@ -219,7 +273,12 @@ class JobAdmin(admin.ModelAdmin):
             if obj.last_run is not None:
                 value = utils.localtime(obj.last_run)
                 value = capfirst(dateformat.format(value, fmt))
-            log_id = obj.log_set.latest('run_start_datetime').id
+            if hasattr(obj, 'latest_log_id'):
+                log_id = obj.latest_log_id
+                if log_id is None:
+                    return value
+            else:
+                log_id = obj.log_set.latest('run_start_datetime').id
             try:
                 # Old way
                 u = reverse('chroniker_log_change', args=(log_id,))
@@ -237,12 +296,22 @@ class JobAdmin(admin.ModelAdmin):
     def check_is_complete(self, obj=None):
         if not obj or not obj.id:
             return ''
-        return not obj.check_is_running()
+        return not obj.check_is_running(save=False)
 
     check_is_complete.short_description = _('is complete')
     check_is_complete.boolean = True
     check_is_complete.admin_order_field = 'is_running'
 
+    def is_fresh(self, obj=None):
+        if not obj or not obj.id:
+            return ''
+        if hasattr(obj, 'stale'):
+            return not obj.stale
+        return obj.is_fresh()
+
+    is_fresh.short_description = _('is fresh')
+    is_fresh.boolean = True
+
     def get_timeuntil(self, obj=None):
         if not obj or not obj.id or not obj.next_run:
             return ''
@@ -291,17 +360,44 @@ class JobAdmin(admin.ModelAdmin):
     def view_logs_button(self, obj=None):
         if not obj or not obj.id:
             return ''
-        q = obj.logs.all()
+        if hasattr(obj, 'log_count'):
+            # Jobs without logs aren't counted at all.
+            count = obj.log_count or 0
+        else:
+            count = obj.logs.all().count()
         kwargs = dict(
             url=utils.get_admin_changelist_url(Log),
             id=obj.id,
-            count=q.count(),
+            count=count,
         )
         return format_html('<a href="{url}?job__id__exact={id}"' ' target="_blank" class="button">View&nbsp;{count}</a>'.format(**kwargs))
 
     view_logs_button.allow_tags = True
     view_logs_button.short_description = 'Logs'
 
+    def run_stats(self, obj=None):
+        if not obj or not obj.id:
+            return ''
+        since = timezone.localdate() - timedelta(days=RUN_STATS_DAYS - 1)
+        summary = JobDailyStats.summarize(obj.daily_stats.filter(date__gte=since))
+        if not summary['runs']:
+            return _('No runs in the last %i days.') % RUN_STATS_DAYS
+        return _(
+            '%(runs)i runs, %(failures)i failed, %(timeouts)i timed out in the last %(days)i days. '
+            'Duration: mean %(mean).1fs, median about %(p50).1fs, 95th percentile about %(p95).1fs, max %(max).1fs.'
+        ) % dict(
+            runs=summary['runs'],
+            failures=summary['failures'],
+            timeouts=summary['timeouts'],
+            days=RUN_STATS_DAYS,
+            mean=summary['mean_duration'],
+            p50=summary['p50_duration'],
+            p95=summary['p95_duration'],
+            max=summary['max_duration'],
+        )
+
+    run_stats.short_description = _('Recent runs')
+
     def run_job_view(self, request, job_id):
         """
         Runs the specified job.
@@ -309,10 +405,12 @@ class JobAdmin(admin.ModelAdmin):
         try:
             Job.objects.filter(id=job_id).update(
                 force_run=True,
-                force_stop=False,
+                last_modified=timezone.now(),
             )
+            JobRuntimeState.objects.filter(job_id=job_id).update(force_stop=False)
         except (TypeError, ValueError) as exc:
             raise Http404 from exc
+        notify.notify(notify.RUN, job_id)
         self.message_user(request, _('Job %(job)s has been signalled to start running immediately.') % {'job': job_id})
         if 'inline' in request.GET:
             redirect = request.path + '../../'
@@ -325,12 +423,11 @@ class JobAdmin(admin.ModelAdmin):
         Stop the specified job.
         """
         try:
-            Job.objects.filter(id=job_id).update(
-                force_run=False,
-                force_stop=True,
-            )
+            if Job.objects.filter(id=job_id).update(force_run=False, last_modified=timezone.now()):
+                JobRuntimeState.objects.update_or_create(job_id=job_id, defaults=dict(force_stop=True))
         except (TypeError, ValueError) as exc:
             raise Http404 from exc
+        notify.notify(notify.STOP, job_id)
         self.message_user(
             request,
             _('Job %(job)s has been signalled to stop running immediately.') \
@@ -351,18 +448,9 @@ class JobAdmin(admin.ModelAdmin):
             raise Http404 from exc
         obj = self.get_object(request, object_id)
 
-        q = None
-        max_duration = None
-        errors = None
-        if obj:
-            q = obj.logs.all()
-            q = q.order_by('run_start_datetime')
-            q = q.only('duration_seconds', 'run_start_datetime')
-            max_duration = q.aggregate(models.Max('duration_seconds'))['duration_seconds__max']
-            errors = q.filter(success=False)
-
         media = self.media
 
+        # The durations are loaded separately from view_duration_graph_data().
         context = {
             'title': _('Change %s') % force_text(opts.verbose_name),
             'object_id': object_id,
@@ -371,24 +459,95 @@ class JobAdmin(admin.ModelAdmin):
             'media': media,
             'app_label': opts.app_label,
             'opts': opts,
-            'q': q,
-            'errors': errors,
-            'max_duration': max_duration,
         }
 
         return render(request, 'admin/chroniker/job/duration_graph.html', context)
 
+    def view_duration_graph_data(self, request, object_id):
+        """
+        Returns the job's run durations as JSON, for the optional start and end epoch milliseconds,
+        downsampled to at most the requested number of points, along with the merged intervals of failed runs.
+        """
+        try:
+            object_id = int(object_id)
+        except (TypeError, ValueError) as exc:
+            raise Http404 from exc
+        obj = self.get_object(request, object_id)
+        if obj is None:
+            raise Http404
+
+        q = obj.logs.exclude(duration_seconds=None)
+        try:
+            max_points = min(max(int(request.GET.get('points', _settings.CHRONIKER_DURATION_GRAPH_MAX_POINTS)), 10), _settings.CHRONIKER_DURATION_GRAPH_MAX_POINTS)
+            start = int(request.GET['start']) if request.GET.get('start') else None
+            end = int(request.GET['end']) if request.GET.get('end') else None
+        except ValueError:
+            return HttpResponseBadRequest('Invalid start, end or points.')
+
+        # Logs are never changed once recorded, so the range of ids identifies the data.
+        stamp = q.aggregate(min_id=models.Min('id'), max_id=models.Max('id'))
+        etag = quote_etag(hashlib.md5(repr((object_id, stamp['min_id'], stamp['max_id'], start, end, max_points)).encode('utf-8')).hexdigest())
+        if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+            response = HttpResponseNotModified()
+            response['ETag'] = etag
+            return response
+
+        if start is not None:
+            q = q.filter(run_start_datetime__gte=utils.from_timestamp_ms(start))
+        if end is not None:
+            q = q.filter(run_start_datetime__lte=utils.from_timestamp_ms(end))
+        series = q.order_by('run_start_datetime').values_list('run_start_datetime', 'duration_seconds')
+        count = series.count()
+        points = []
+        errors = []
+        gap = 0
+        if count:
+            if start is None or end is None:
+                bounds = q.aggregate(first=models.Min('run_start_datetime'), last=models.Max('run_start_datetime'))
+                start = utils.to_timestamp_ms(bounds['first']) if start is None else start
+                end = utils.to_timestamp_ms(bounds['last']) if end is None else end
+            series = ((utils.to_timestamp_ms(dt), duration) for dt, duration in series.iterator())
+            if count <= max_points:
+                points = [(ms, duration, duration, duration) for ms, duration in series]
+            else:
+                points = list(utils.downsample_series(series, start, end, max_points))
+                # Failures closer together than a point are indistinguishable, so are shown as one.
+                gap = (end - start) / float(max_points)
+            failures = q.filter(success=False).order_by('run_start_datetime').values_list('run_start_datetime', 'run_end_datetime')
+            errors = list(
+                utils.merge_intervals(
+                    ((utils.to_timestamp_ms(run_start), utils.to_timestamp_ms(run_end or run_start)) for run_start, run_end in failures.iterator()),
+                    gap=gap,
+                )
+            )
+
+        response = JsonResponse({
+            'start': start,
+            'end': end,
+            'count': count,
+            'downsampled': count > max_points,
+            'points': points,
+            'errors': errors,
+        })
+        response['ETag'] = etag
+        # Cached by the browser, but always revalidated, so new runs appear.
+        response['Cache-Control'] = 'private, no-cache'
+        return response
+
     def get_urls(self):
         urls = super().get_urls()
         my_urls = [
             url(r'^(.+)/run/$', self.admin_site.admin_view(self.run_job_view), name="chroniker_job_run"),
             url(r'^(.+)/stop/$', self.admin_site.admin_view(self.stop_job_view), name="chroniker_job_stop"),
             url(r'^(.+)/graph/duration/$', self.admin_site.admin_view(self.view_duration_graph), name='chroniker_job_duration_graph'),
+            url(r'^(.+)/graph/duration/data/$', self.admin_site.admin_view(self.view_duration_graph_data), name='chroniker_job_duration_graph_data'),
         ]
         return my_urls + urls
 
     def run_selected_jobs(self, request, queryset):
-        rows_updated = queryset.update(force_run=True)
+        job_ids = list(queryset.values_list('id', flat=True))
+        rows_updated = Job.objects.filter(id__in=job_ids).update(force_run=True, last_modified=timezone.now())
+        notify.notify(notify.RUN, *job_ids)
         if rows_updated == 1:
             message_bit = "1 job was"
         else:
@@ -422,7 +581,7 @@ class JobAdmin(admin.ModelAdmin):
     toggle_enabled.short_description = "Toggle enabled flag on selected jobs"
 
     def disable_jobs(self, request, queryset):
-        queryset.update(enabled=False)
+        queryset.update(enabled=False, last_modified=timezone.now())
         rows_updated = queryset.count()
         if rows_updated == 1:
             message_bit = "1 job was toggled"
@@ -433,7 +592,7 @@ class JobAdmin(admin.ModelAdmin):
     disable_jobs.short_description = "Disable selected jobs"
 
     def enable_jobs(self, request, queryset):
-        queryset.update(enabled=True)
+        queryset.update(enabled=True, last_modified=timezone.now())
         rows_updated = queryset.count()
         if rows_updated == 1:
             message_bit = "1 job was toggled"
@@ -469,6 +628,9 @@ class JobAdmin(admin.ModelAdmin):
 class LogAdmin(admin.ModelAdmin):
     list_display = ('job_name', 'run_start_datetime', 'run_end_datetime', 'duration_seconds', 'duration_str', 'job_success', 'on_time', 'hostname')
 
+    # Every row shows its job's name.
+    list_select_related = ('job',)
+
     list_filter = (
         'success',
         'on_time',
@@ -476,8 +638,8 @@ class LogAdmin(admin.ModelAdmin):
     )
 
     search_fields = (
-        'stdout',
-        'stderr',
+        'output__stdout',
+        'output__stderr',
         'job__name',
         'job__command',
     )
@@ -541,17 +703,54 @@ class LogAdmin(admin.ModelAdmin):
     stderr_link.allow_tags = True
     stderr_link.short_description = 'Stderr full'
 
-    def view_full_stdout(self, request, log_id):
-        log = Log.objects.get(id=log_id)
-        resp = HttpResponse(log.stdout, content_type='application/x-download')
-        resp['Content-Disposition'] = 'filename=log-%s-stdout.txt' % (log_id,)
+    def view_full_output(self, request, log_id, field):
+        """
+        Streams the full output of the given field, either 'stdout' or 'stderr', without loading the other.
+
+        Supports requests for a single byte range, such as `Range: bytes=-1000000` for the last megabyte,
+        and sends the whole output gzip-compressed to clients that accept it.
+        """
+        output = LogOutput.objects.only('log_id', field, field + '_ref', field + '_size').filter(log_id=log_id).first()
+        if output is None:
+            if not Log.objects.filter(id=log_id).exists():
+                raise Http404
+            # Nothing was recorded.
+            output = LogOutput(log_id=log_id)
+        size = output.get_size(field)
+        try:
+            byte_range = utils.parse_range_header(request.META.get('HTTP_RANGE'), size)
+        except ValueError:
+            resp = HttpResponse(status=416)
+            resp['Content-Range'] = 'bytes */%i' % size
+            return resp
+
+        if byte_range:
+            start, end = byte_range
+            resp = StreamingHttpResponse(utils.iter_file(output.open(field), start=start, length=end - start + 1), status=206)
+            resp['Content-Range'] = 'bytes %i-%i/%i' % (start, end, size)
+            resp['Content-Length'] = end - start + 1
+        elif 'gzip' in request.META.get('HTTP_ACCEPT_ENCODING', ''):
+            # Output stored compressed is sent as-is.
+            compressed = output.open_compressed(field)
+            if compressed is None:
+                resp = StreamingHttpResponse(utils.iter_gzip(utils.iter_file(output.open(field))))
+            else:
+                resp = StreamingHttpResponse(utils.iter_file(compressed))
+            resp['Content-Encoding'] = 'gzip'
+        else:
+            resp = StreamingHttpResponse(utils.iter_file(output.open(field)))
+            resp['Content-Length'] = size
+        resp['Content-Type'] = 'application/x-download'
+        resp['Content-Disposition'] = 'filename=log-%s-%s.txt' % (log_id, field)
+        resp['Accept-Ranges'] = 'bytes'
+        patch_vary_headers(resp, ('Accept-Encoding',))
         return resp
 
+    def view_full_stdout(self, request, log_id):
+        return self.view_full_output(request, log_id, 'stdout')
+
     def view_full_stderr(self, request, log_id):
-        log = Log.objects.get(id=log_id)
-        resp = HttpResponse(log.stderr, content_type='application/x-download')
-        resp['Content-Disposition'] = 'filename=log-%s-stderr.txt' % (log_id,)
-        return resp
+        return self.view_full_output(request, log_id, 'stderr')
 
     def get_urls(self):
         urls = super().get_urls()
@@ -585,6 +784,61 @@ except admin.sites.AlreadyRegistered:
 admin.site.register(Log, LogAdmin)
 
 
+class JobDailyStatsAdmin(admin.ModelAdmin):
+    list_display = (
+        'job',
+        'date',
+        'runs',
+        'failures',
+        'timeouts',
+        'mean_duration_str',
+        'p50_duration_str',
+        'p95_duration_str',
+        'max_duration',
+    )
+
+    list_select_related = ('job',)
+
+    list_filter = ('job',)
+
+    date_hierarchy = 'date'
+
+    readonly_fields = (
+        'job',
+        'date',
+        'runs',
+        'failures',
+        'timeouts',
+        'total_duration',
+        'min_duration',
+        'max_duration',
+        'mean_duration_str',
+        'p50_duration_str',
+        'p95_duration_str',
+    )
+
+    def mean_duration_str(self, obj):
+        return '%.1f' % obj.mean_duration if obj.runs else ''
+
+    mean_duration_str.short_description = _('mean duration')
+
+    def p50_duration_str(self, obj):
+        return '%.1f' % obj.p50_duration if obj.runs else ''
+
+    p50_duration_str.short_description = _('median duration')
+
+    def p95_duration_str(self, obj):
+        return '%.1f' % obj.p95_duration if obj.runs else ''
+
+    p95_duration_str.short_description = _('95th percentile duration')
+
+    def has_add_permission(self, request):
+        return False
+
+
+admin.site.register(JobDailyStats, JobDailyStatsAdmin)
+
+
 class MonitorAdmin(admin.ModelAdmin):
     list_display = (
         'name_str',
@@ -677,6 +931,7 @@ class MonitorAdmin(admin.ModelAdmin):
         # simply force the Job to be run by the next cron job
         job.force_run = True
         job.save()
+        notify.notify(notify.RUN, job.id)
         self.message_user(request, _('The monitor "%(job)s" will be checked.') % {'job': job})
         if 'inline' in request.GET:
             redirect = request.path + '../../'
@@ -0,0 +1,93 @@
+"""
+Estimates how long chains of dependent jobs take to run.
+
+The dependency graph is loaded in one query and every job's estimated run length in another,
+so a chain, or every chain, is calculated in a fixed number of queries however many jobs it has.
+"""
+from toposort import CircularDependencyError, toposort_flatten
+
+from chroniker.models import Job, estimate_run_length, get_chain
+
+
+def get_roots(graph):
+    """
+    Returns the ids of the jobs that start each chain in the graph: those with dependents that don't depend on any job themselves.
+    """
+    dependent_ids = set()
+    for ids in graph.values():
+        dependent_ids.update(ids)
+    return sorted(set(graph) - dependent_ids)
+
+
+def get_estimates(job_ids, samples=20):
+    """
+    Returns a dictionary of {job id: (name, estimated run length in seconds)} for the given jobs.
+    """
+    q = Job.objects.filter(id__in=job_ids).values_list('id', 'name', 'run_length_window')
+    return dict((job_id, (name, estimate_run_length(window, samples=samples))) for job_id, name, window in q.iterator())
+
+
+def get_critical_path(graph, job_ids, durations):
+    """
+    Returns the longest path, by total duration, through the given jobs of the graph,
+    as a tuple of its total duration and the list of its job ids, in the order they run.
+    """
+    # {dependent id: set(dependee ids)}, as expected by toposort.
+    dependees = dict((job_id, set()) for job_id in job_ids)
+    for dependee_id, dependent_ids in graph.items():
+        if dependee_id not in dependees:
+            continue
+        for dependent_id in dependent_ids:
+            if dependent_id in dependees:
+                dependees[dependent_id].add(dependee_id)
+    finishes = {}
+    previous = {}
+    for job_id in toposort_flatten(dependees):
+        # Each job starts once the last of its dependees finishes.
+        start = 0
+        for dependee_id in sorted(dependees[job_id]):
+            if job_id not in previous or finishes[dependee_id] > start:
+                start = finishes[dependee_id]
+                previous[job_id] = dependee_id
+        finishes[job_id] = start + (durations.get(job_id) or 0)
+    if not finishes:
+        return 0, []
+    job_id = max(finishes, key=lambda _: (finishes[_], -_))
+    total = finishes[job_id]
+    path = [job_id]
+    while job_id in previous:
+        job_id = previous[job_id]
+        path.append(job_id)
+    path.reverse()
+    return total, path
+
+
+def calculate_chains(root_ids=None, samples=20):
+    """
+    Calculates the critical path of the chain of jobs started by each of the given jobs, or by every root job.
+    Returns a list of dictionaries, one per chain.
+    """
+    graph = Job.objects.get_dependency_graph()
+    if root_ids is None:
+        root_ids = get_roots(graph)
+    chains = dict((root_id, [root_id] + sorted(get_chain(graph, root_id))) for root_id in root_ids)
+    estimates = get_estimates(set(job_id for job_ids in chains.values() for job_id in job_ids), samples=samples)
+    results = []
+    for root_id in root_ids:
+        job_ids = chains[root_id]
+        durations = dict((job_id, estimates.get(job_id, (None, None))[1]) for job_id in job_ids)
+        result = {
+            'root': root_id,
+            'name': estimates.get(root_id, (None, None))[0],
+            'jobs': [{
+                'id': job_id,
+                'name': estimates.get(job_id, (None, None))[0],
+                'estimate_seconds': durations[job_id],
+            } for job_id in job_ids],
+        }
+        try:
+            result['duration_seconds'], result['critical_path'] = get_critical_path(graph, job_ids, durations)
+        except CircularDependencyError as e:
+            result['error'] = str(e)
+        results.append(result)
+    return results
@@ -0,0 +1,32 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chroniker.models import Job, JobDailyStats, Log
+
+
+class Command(BaseCommand):
+    help = 'Recalculates the daily and run length statistics of jobs from their logs.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--job_ids', '--job-ids', dest='job_ids', default='', help='A comma-delimited list of job ids to limit to.')
+        parser.add_argument('--days',
+            dest='days',
+            type=int,
+            default=0,
+            help='If given, only recalculates this many of the most recent days. Otherwise recalculates every day with logs.')
+
+    def handle(self, *args, **options):
+        q = Log.objects.all()
+        job_ids = [int(_) for _ in options['job_ids'].split(',') if _.strip()]
+        if job_ids:
+            q = q.filter(job_id__in=job_ids)
+        if options['days']:
+            q = q.filter(run_start_datetime__gte=timezone.now() - timedelta(days=options['days']))
+        total = JobDailyStats.objects.backfill(q)
+        print('Recalculated %i days of job statistics.' % total)
+        job_ids = job_ids or list(Log.objects.values_list('job_id', flat=True).order_by().distinct())
+        for job_id in job_ids:
+            Job.objects.rebuild_run_length(job_id)
+        print('Recalculated the run length statistics of %i jobs.' % len(job_ids))
@@ -1,60 +1,53 @@
-import sys
+import json
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from chroniker.models import Job, JobDependency
-
-from criticalpath import Node
+from chroniker import settings as _settings
+from chroniker.chain import calculate_chains
+from chroniker.models import Job
 
 
 class Command(BaseCommand):
     help = 'Calculates the total time a series of chained jobs will take.'
 
     def add_arguments(self, parser):
-        parser.add_argument('root_job_id')
-        parser.add_argument('--samples', default=20, help='The number of log samples to use when estimating mean job run time.')
-
-    def handle(self, root_job_id, **options):
-        root_job = Job.objects.get(id=int(root_job_id))
-        samples = int(options['samples'])
-
-        # Add all system task nodes.
-        system = Node('system')
-        system.add(Node(root_job.id, duration=root_job.get_run_length_estimate(samples=samples)))
-        print('%s takes about %s seconds' \
-            % (root_job, root_job.get_run_length_estimate(samples=samples)))
-        chain = root_job.get_chained_jobs()
-        for job in chain:
-            print('%s takes about %s seconds' \
-                % (job, job.get_run_length_estimate(samples=samples)))
-            node = Node(job.id, duration=job.get_run_length_estimate(samples=samples))
-            node.description = job.name
-            system.add(node)
-
-        # Add all links between task nodes.
-        print('-' * 80)
-        for job in chain:
-            if not job.enabled:
+        parser.add_argument('root_job_id', nargs='?', type=int)
+        parser.add_argument('--samples',
+            type=int,
+            default=None,
+            help='The number of most recent run lengths to use when estimating each job\'s run time, '
+            'at most CHRONIKER_RUN_LENGTH_WINDOW, which is also the default.')
+        parser.add_argument('--all_roots',
+            '--all-roots',
+            dest='all_roots',
+            action='store_true',
+            default=False,
+            help='If given, calculates the chain started by every job that has dependents but no dependencies of its own.')
+        parser.add_argument('--json', dest='json', action='store_true', default=False, help='If given, prints the chains as JSON.')
+
+    def handle(self, root_job_id=None, **options):
+        if (root_job_id is None) == (not options['all_roots']):
+            raise CommandError('Either a root job id or --all_roots must be given.')
+        if root_job_id is not None and not Job.objects.filter(id=root_job_id).exists():
+            raise CommandError('Job %i does not exist.' % root_job_id)
+        samples = options['samples']
+        if samples is None:
+            samples = _settings.CHRONIKER_RUN_LENGTH_WINDOW
+        if not 1 <= samples <= _settings.CHRONIKER_RUN_LENGTH_WINDOW:
+            raise CommandError('--samples must be between 1 and CHRONIKER_RUN_LENGTH_WINDOW (%i).' % _settings.CHRONIKER_RUN_LENGTH_WINDOW)
+        chains = calculate_chains(root_ids=None if options['all_roots'] else [root_job_id], samples=samples)
+
+        if options['json']:
+            print(json.dumps(chains, indent=4))
+            return
+
+        for chain in chains:
+            print('Chain starting with %s %s' % (chain['root'], chain['name']))
+            for job in chain['jobs']:
+                print('%s %s takes about %s seconds' % (job['id'], job['name'], job['estimate_seconds']))
+            if 'error' in chain:
+                print('Unable to calculate the critical path: %s' % chain['error'])
                 continue
-            dependees = JobDependency.objects.filter(dependent=job, dependee__enabled=True)
-            dependees = dependees.values_list('dependee_id', flat=True)
-            print(job, dependees)
-            for dependee in dependees:
-                # Link dependent job to dependee.
-                assert job.id != 1
-                system.link(from_node=dependee, to_node=job.id)
-
-        root_node = system.lookup_node(1)
-        print('root_node:', root_node, root_node.to_nodes, root_node.incoming_nodes)
-        system.add_exit()
-        sys.stdout.flush()
-
-        #return
-        print('Updating values...')
-        system.update_all()
-
-        critical_path = system.get_critical_path()
-        print('critical_path:', critical_path)
-        system.print_times()
-
-        print('min hours:', system.duration * (1 / 60.) * (1 / 60.))
+            print('critical_path:', chain['critical_path'])
+            print('min hours:', chain['duration_seconds'] * (1 / 60.) * (1 / 60.))
+            print('-' * 80)
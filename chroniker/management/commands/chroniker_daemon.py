@@ -0,0 +1,376 @@
+import logging
+import time
+from datetime import timedelta
+from multiprocessing import Queue
+from multiprocessing.connection import wait
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.db.models import Count, Max
+from django.utils import timezone
+
+from chroniker import notify, settings as _settings, utils
+from chroniker.management.commands.cron import (
+    BatchHeartbeat, ConcurrencyBudget, OutputCollector, end_expired_process, kill_stalled_processes, new_output_map, run_job, start_job_process
+)
+from chroniker.models import Job
+from chroniker.pool import WorkerPool, preload_commands
+
+logger = logging.getLogger('chroniker.commands.chroniker_daemon')
+
+
+class JobDaemon:
+    """
+    A long-running supervisor that replaces calling `manage.py cron` once a minute.
+
+    The next run of every job this host may run is kept in an in-memory index,
+    so the daemon only wakes up when the earliest job is due or one of its own
+    job processes exits, plus a cheap periodic query of `Job.last_modified`
+    that picks up jobs added, changed or flagged to force run elsewhere.
+    Jobs are launched as soon as they're due, without waiting on jobs already running.
+    With `CHRONIKER_NOTIFIER` set, jobs flagged to run or stop in the admin also wake it up immediately.
+
+    If pool_size is given, jobs are run on that many reusable worker processes instead of a new process each,
+    and due jobs wait for a free worker.
+    Due jobs also wait while the host's concurrency limits are reached.
+    """
+
+    def __init__(self, update_heartbeat=True, poll_seconds=None, refresh_seconds=None, sync=False, pool_size=None):
+        self.update_heartbeat = update_heartbeat
+        self.poll_seconds = poll_seconds or _settings.CHRONIKER_DAEMON_POLL_SECONDS
+        self.refresh_seconds = refresh_seconds or _settings.CHRONIKER_DAEMON_REFRESH_SECONDS
+        self.sync = sync
+        self.index = utils.NextRunIndex()
+        self.blocked_ids = set() # Due jobs waiting on their dependencies or a free slot.
+        self.procs = {} # {job_id: JobProcess}
+        self.last_refresh = None
+        self.last_modified = None
+        self.job_count = None
+        self.stdout_map = new_output_map()
+        self.stderr_map = new_output_map()
+        self.stdout_queue = Queue()
+        self.stderr_queue = Queue()
+        self.collectors = []
+        self.notifier = None
+        self.budget = ConcurrencyBudget(max_concurrency=0, groups={}) if sync else ConcurrencyBudget()
+        # The heartbeats of all job processes are recorded by the daemon, instead of a thread in each.
+        self.heartbeat = BatchHeartbeat() if update_heartbeat and not sync else None
+        self.pool = None
+        if pool_size and not sync:
+            self.pool = WorkerPool(pool_size, update_heartbeat=update_heartbeat and not self.heartbeat, stdout_queue=self.stdout_queue, stderr_queue=self.stderr_queue)
+
+    def get_running_ids(self):
+        """
+        Returns the ids of the jobs this daemon is currently running.
+        """
+        running_ids = set(self.procs)
+        if self.pool:
+            running_ids.update(self.pool.running)
+        return running_ids
+
+    def get_change_stamp(self):
+        """
+        Returns the most recent modification time and the total number of jobs,
+        which together change whenever a job is created, deleted or modified.
+        """
+        stamp = Job.objects.aggregate(last_modified=Max('last_modified'), job_count=Count('id'))
+        return stamp['last_modified'], stamp['job_count']
+
+    def refresh(self):
+        """
+        Reloads the schedule of all enabled jobs this host may run.
+        """
+        if _settings.CHRONIKER_AUTO_END_STALE_JOBS:
+            Job.objects.end_all_stale()
+        self.last_modified, self.job_count = self.get_change_stamp()
+        self.index.clear()
+        self.blocked_ids.clear()
+        self.load_jobs(Job.objects.scheduled())
+        self.last_refresh = time.time()
+
+    def refresh_jobs(self, job_ids):
+        """
+        Reloads the scheduled next run of the given jobs.
+        """
+        for job_id in job_ids:
+            self.index.remove(job_id)
+            self.blocked_ids.discard(job_id)
+        self.load_jobs(Job.objects.scheduled().filter(id__in=job_ids))
+
+    def load_jobs(self, q):
+        now = timezone.now()
+        running_ids = self.get_running_ids()
+        for job_id, next_run, force_run in q.values_list('id', 'next_run', 'force_run'):
+            if job_id in running_ids:
+                # Reloaded once the job's process ends.
+                continue
+            self.index.push(job_id, now if force_run else next_run)
+
+    def check_for_changes(self):
+        """
+        Reloads any jobs modified since the last check.
+        Returns true if anything changed.
+        """
+        last_modified, job_count = self.get_change_stamp()
+        if job_count != self.job_count:
+            # A job was created or deleted.
+            self.refresh()
+            return True
+        if last_modified == self.last_modified:
+            return False
+        # Allow for modifications committed slightly out of order, or by hosts whose clocks differ.
+        since = self.last_modified - timedelta(seconds=_settings.CHRONIKER_DAEMON_CHANGE_OVERLAP_SECONDS)
+        self.last_modified = last_modified
+        self.refresh_jobs(list(Job.objects.filter(last_modified__gte=since).values_list('id', flat=True)))
+        return True
+
+    def get_sleep_seconds(self):
+        """
+        Returns the number of seconds until the daemon next needs to wake up on its own.
+        """
+        seconds = [self.poll_seconds]
+        if self.last_refresh is not None:
+            seconds.append(self.last_refresh + self.refresh_seconds - time.time())
+        top = self.index.peek()
+        if top is not None:
+            seconds.append((top[0] - timezone.now()).total_seconds())
+        for proc in self.procs.values():
+            if proc.deadline is not None:
+                # Past its deadline, a process timed by CPU time is rechecked every check_freq seconds.
+                remaining = proc.deadline - time.time()
+                seconds.append(remaining if remaining > 0 else proc.check_freq)
+        if self.pool and self.pool.get_seconds_remaining() is not None:
+            seconds.append(self.pool.get_seconds_remaining())
+        if self.heartbeat and self.heartbeat.get_seconds_remaining() is not None:
+            seconds.append(self.heartbeat.get_seconds_remaining())
+        return max(min(seconds), 0)
+
+    def launch_due(self):
+        """
+        Starts every due job whose dependencies are met and that isn't already running under this daemon.
+        """
+        running_ids = self.get_running_ids()
+        self.budget.refresh()
+        queued_ids = set()
+        for job in Job.objects.due_with_met_dependencies_ordered():
+            if job.id in running_ids:
+                continue
+            if self.pool and not self.pool.has_idle():
+                # The rest are launched as workers free up.
+                break
+            if not self.budget.allows(job) or any(dep.dependee_id in queued_ids for dep in job.dependencies.all()):
+                # Launched once a slot frees up, after any dependees also waiting for one.
+                queued_ids.add(job.id)
+                continue
+
+            # Re-check dependencies to incorporate any jobs launched during
+            # this pass.
+            job = Job.objects.get(id=job.id)
+            if not job.is_due_with_dependencies_met(running_ids=running_ids):
+                continue
+
+            if not Job.objects.claim(job):
+                # Another scheduler beat us to it. The job is reloaded once that run updates it.
+                utils.smart_print('Job {} {} was claimed by another process.'.format(job.id, job))
+                continue
+
+            utils.smart_print('Running job {} {}.'.format(job.id, job))
+            running_ids.add(job.id)
+            self.index.remove(job.id)
+            self.blocked_ids.discard(job.id)
+            job.is_running = True
+            self.budget.add(job)
+
+            if self.sync:
+                run_job(job, update_heartbeat=self.update_heartbeat, force_run=job.force_run)
+                self.refresh_jobs([job.id])
+                continue
+
+            if self.pool:
+                worker = self.pool.submit(job, force_run=job.force_run)
+                if self.heartbeat:
+                    self.heartbeat.add(job.id, worker.pid)
+                continue
+
+            # Each job process must open its own database connection.
+            connection.close()
+            # Output is only collected to record a log for jobs we may have to kill.
+            self.procs[job.id] = start_job_process(
+                job,
+                force_run=job.force_run,
+                update_heartbeat=self.update_heartbeat and not self.heartbeat,
+                stdout_queue=self.stdout_queue if job.timeout_seconds else None,
+                stderr_queue=self.stderr_queue if job.timeout_seconds else None,
+            )
+            if self.heartbeat:
+                self.heartbeat.add(job.id, self.procs[job.id].pid)
+
+    def reap(self):
+        """
+        Cleans up job processes that have exited or exceeded their timeout.
+        Returns the ids of the jobs that are no longer running.
+        """
+        ended_ids = set()
+        for job_id, proc in list(self.procs.items()):
+            if not proc.is_alive():
+                print('Process %s ended.' % (proc,))
+            elif proc.deadline is not None and proc.deadline <= time.time() and proc.is_expired:
+                # Checking the run time walks the process tree, so it's skipped until the deadline.
+                end_expired_process(proc, self.stdout_map, self.stderr_map)
+            else:
+                continue
+            del self.procs[job_id]
+            self.stdout_map.pop(proc.pid, None)
+            self.stderr_map.pop(proc.pid, None)
+            ended_ids.add(job_id)
+        if self.pool:
+            for worker in self.pool.expired():
+                # Killing the worker is the only way to stop its job, so it's replaced by a new one.
+                ended_ids.add(worker.job.id)
+                end_expired_process(worker, self.stdout_map, self.stderr_map)
+                self.pool.remove(worker)
+            for job, worker in self.pool.reap():
+                print('Job %s ended on %s.' % (job.id, worker))
+                if self.heartbeat:
+                    # Its worker lives on, so it mustn't be interrupted again for this job.
+                    self.heartbeat.remove(job.id)
+                self.stdout_map.pop(worker.pid, None)
+                self.stderr_map.pop(worker.pid, None)
+                ended_ids.add(job.id)
+        if self.heartbeat:
+            for job_id in ended_ids:
+                self.heartbeat.remove(job_id)
+        if ended_ids:
+            self.refresh_jobs(ended_ids)
+        return ended_ids
+
+    def wait(self, timeout):
+        """
+        Blocks until a job process exits, a notification arrives or the timeout elapses.
+        """
+        sentinels = [proc.sentinel for proc in self.procs.values()]
+        if self.pool:
+            sentinels.extend(self.pool.get_sentinels())
+        if self.notifier:
+            sentinels.append(self.notifier)
+        if sentinels:
+            wait(sentinels, timeout=timeout)
+        else:
+            time.sleep(timeout)
+
+    def receive_notifications(self):
+        """
+        Reloads any jobs notified as flagged to run, so they're launched by this pass.
+        Returns true if any job was notified as flagged to stop.
+        """
+        if not self.notifier:
+            return False
+        stop_notified = False
+        run_ids = set()
+        for action, job_id in self.notifier.receive():
+            if action == notify.RUN:
+                run_ids.add(job_id)
+            elif action == notify.STOP:
+                stop_notified = True
+        if run_ids:
+            self.refresh_jobs(run_ids)
+        return stop_notified
+
+    def step(self):
+        """
+        Performs one pass of the scheduling loop, launching any jobs that are ready.
+        """
+        stop_notified = self.receive_notifications()
+        ended_ids = self.reap()
+        if self.heartbeat:
+            self.heartbeat.beat(force=stop_notified)
+        if self.last_refresh is None or time.time() - self.last_refresh >= self.refresh_seconds:
+            self.refresh()
+            changed = True
+        else:
+            changed = self.check_for_changes()
+        due_ids = self.index.pop_due(timezone.now())
+        if due_ids or (self.blocked_ids and (ended_ids or changed)):
+            # Jobs left unlaunched have unmet dependencies or are waiting for a slot,
+            # so retry them whenever another job ends or the schedule changes.
+            self.blocked_ids.update(due_ids)
+            self.launch_due()
+
+    def start(self):
+        if self.pool:
+            # Import every command up front, so each worker inherits them instead of importing its own.
+            preload_commands(Job.objects.scheduled().exclude(command='').values_list('command', flat=True))
+        self.collectors = [
+            OutputCollector(self.stdout_queue, self.stdout_map),
+            OutputCollector(self.stderr_queue, self.stderr_map),
+        ]
+        for collector in self.collectors:
+            collector.start()
+        self.notifier = notify.listen()
+
+    def stop(self):
+        if self.pool:
+            self.pool.close()
+        for collector in self.collectors:
+            collector.stop()
+        self.collectors = []
+        if self.notifier:
+            self.notifier.close()
+            self.notifier = None
+
+    def run_forever(self):
+        self.start()
+        try:
+            while 1:
+                self.step()
+                self.wait(self.get_sleep_seconds())
+        finally:
+            self.stop()
+
+
+class Command(BaseCommand):
+    help = 'Runs a long-lived scheduler that launches jobs as soon as they are due.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--update_heartbeat',
+            dest='update_heartbeat',
+            default=1,
+            help='If given, launches a thread to asynchronously update ' + \
+                'job heartbeat status.')
+        parser.add_argument('--poll_seconds',
+            dest='poll_seconds',
+            type=float,
+            default=0,
+            help='The maximum number of seconds to wait before checking for forced jobs.')
+        parser.add_argument('--refresh_seconds',
+            dest='refresh_seconds',
+            type=float,
+            default=0,
+            help='The number of seconds between full reloads of the job schedule.')
+        parser.add_argument('--sync', action='store_true', default=False, help='If given, runs jobs one at a time.')
+        parser.add_argument('--pool_size',
+            dest='pool_size',
+            type=int,
+            default=_settings.CHRONIKER_POOL_SIZE,
+            help='If given, runs jobs on this many reusable worker processes instead of a new process per job.')
+        parser.add_argument('--verbose', action='store_true', default=False, help='If given, shows debugging info.')
+
+    def handle(self, *args, **options):
+        verbose = options['verbose']
+        if verbose:
+            logging.basicConfig(level=logging.DEBUG)
+
+        kill_stalled_processes(dryrun=False)
+
+        daemon = JobDaemon(
+            update_heartbeat=int(options['update_heartbeat']),
+            poll_seconds=options['poll_seconds'],
+            refresh_seconds=options['refresh_seconds'],
+            sync=options['sync'],
+            pool_size=options['pool_size'],
+        )
+        print('Starting chroniker daemon. Quit with CONTROL-C.')
+        try:
+            daemon.run_forever()
+        except KeyboardInterrupt:
+            logger.info('Exiting...')
@@ -1,19 +1,24 @@
+import heapq
 import logging
 import os
+import signal
 import socket
 import sys
+import threading
 import time
 from collections import defaultdict
 from functools import partial
 from multiprocessing import Queue
+from multiprocessing.connection import wait
 
 import psutil
 
 from django.core.management.base import BaseCommand
 from django.db import connection
+from django.db.models import Count
 from django.utils import timezone
 
-from chroniker import settings as _settings, utils
+from chroniker import notify, settings as _settings, utils
 from chroniker.models import Job, Log
 
 
@@ -26,16 +31,16 @@ def kill_stalled_processes(dryrun=True):
     and kill any associated with complete jobs.
     """
     pids = set(map(int, Job.objects\
-        .filter(is_running=False, current_pid__isnull=False)\
-        .exclude(current_pid='')\
-        .values_list('current_pid', flat=True)))
+        .filter(is_running=False, runtime__current_pid__isnull=False)\
+        .exclude(runtime__current_pid='')\
+        .values_list('runtime__current_pid', flat=True)))
     for pid in pids:
         try:
             if utils.pid_exists(pid): # and not utils.get_cpu_usage(pid):
                 p = psutil.Process(pid)
                 cmd = ' '.join(p.cmdline())
                 if 'manage.py cron' in cmd:
-                    jobs = Job.objects.filter(current_pid=pid)
+                    jobs = Job.objects.filter(runtime__current_pid=pid)
                     job = None
                     if jobs:
                         job = jobs[0]
@@ -91,6 +96,215 @@ def run_job(job, **kwargs):
     #TODO:normalize job termination and cleanup outside of handle_run()?
 
 
+def start_job_process(job, force_run=False, update_heartbeat=True, stdout_queue=None, stderr_queue=None):
+    """
+    Launches the job in a separate process and returns the started ``JobProcess``.
+    """
+    job_func = partial(
+        run_job,
+        job=job,
+        force_run=force_run,
+        update_heartbeat=update_heartbeat,
+        name=str(job),
+    )
+    proc = JobProcess(
+        job=job,
+        max_seconds=job.timeout_seconds,
+        target=job_func,
+        name=str(job),
+        kwargs=dict(
+            stdout_queue=stdout_queue,
+            stderr_queue=stderr_queue,
+        )
+    )
+    proc.start()
+    return proc
+
+
+def end_expired_process(proc, stdout_map, stderr_map):
+    """
+    Kills a job process that has exceeded its timeout, marks the job as no longer running
+    and records a failed log entry containing whatever output was collected from it.
+    """
+    print('Process %s expired.' % (proc,))
+    proc_id = proc.pid
+    proc.terminate()
+    run_end_datetime = timezone.now()
+
+    connection.close()
+    Job.objects.update()
+    j = Job.objects.get(id=proc.job.id)
+    run_start_datetime = j.last_run_start_timestamp
+    proc.job.is_running = False
+    proc.job.force_run = False
+    proc.job.force_stop = False
+    proc.job.save()
+
+    # Create log record since the job was killed before it had
+    # a chance to do so.
+    Log.objects.create(
+        job=proc.job,
+        run_start_datetime=run_start_datetime,
+        run_end_datetime=run_end_datetime,
+        success=False,
+        on_time=False,
+        hostname=socket.gethostname(),
+        stdout=get_collected_output(stdout_map, proc_id),
+        stderr=get_collected_output(stderr_map, proc_id) + 'Job exceeded timeout\n',
+    )
+
+
+# The most characters kept from the start, and from the end, of the output collected from each job process.
+# Pool workers run many jobs, so what's collected from them is also discarded as each job finishes.
+COLLECTED_OUTPUT_SIZE = 1024 * 1024
+
+
+def new_output_map():
+    """
+    Returns a map of {pid: HeadTailBuffer} for an OutputCollector to fill.
+    """
+    return defaultdict(lambda: utils.HeadTailBuffer(head_size=COLLECTED_OUTPUT_SIZE, tail_size=COLLECTED_OUTPUT_SIZE))
+
+
+def get_collected_output(output_map, proc_id):
+    """
+    Removes and returns the output collected from the given process.
+    """
+    buf = output_map.pop(proc_id, None)
+    return buf.getvalue() if buf is not None else ''
+
+
+class OutputCollector(threading.Thread):
+    """
+    Continuously drains the output chunks job processes send through a queue
+    into a map of {pid: HeadTailBuffer}, made by new_output_map().
+
+    Draining from a thread means the queue's pipe never fills up, so a job process
+    never blocks on exit waiting for the supervisor to read its output.
+    """
+
+    daemon = True
+
+    def __init__(self, queue, output_map, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.queue = queue
+        self.output_map = output_map
+
+    def run(self):
+        while 1:
+            data = self.queue.get()
+            if data is None:
+                return
+            proc_id, output = data
+            self.output_map[proc_id].write(output)
+
+    def stop(self):
+        self.queue.put(None)
+        self.join()
+
+
+class BatchHeartbeat:
+    """
+    Records the heartbeats of all of a supervisor's job processes together, in one query per interval,
+    instead of each job process running its own heartbeat thread.
+
+    Only processes that still exist are counted as alive.
+    Jobs flagged to stop are interrupted with SIGINT, as their own heartbeat thread would have done,
+    again on every heartbeat until they exit, since a process may miss a signal sent as it starts.
+    """
+
+    def __init__(self, interval=None):
+        self.interval = interval or _settings.CHRONIKER_HEARTBEAT_SECONDS
+        self.pids = {} # {job_id: pid}
+        self.stopping_ids = set()
+        self.last_beat = None
+
+    def add(self, job_id, pid):
+        self.pids[job_id] = pid
+
+    def remove(self, job_id):
+        self.pids.pop(job_id, None)
+        self.stopping_ids.discard(job_id)
+
+    def get_seconds_remaining(self):
+        """
+        Returns the number of seconds until the next heartbeat is due, or None if there are no processes to beat for.
+        """
+        if not self.pids:
+            return None
+        if self.last_beat is None:
+            return 0
+        return max(self.last_beat + self.interval - time.time(), 0)
+
+    def beat(self, force=False):
+        """
+        Records a heartbeat for every live job process, if one is due or forced, and interrupts those flagged to stop.
+        Returns the ids of the jobs stopped.
+        """
+        if not self.pids or (self.get_seconds_remaining() != 0 and not force):
+            return set()
+        self.last_beat = time.time()
+        alive = dict((job_id, pid) for job_id, pid in self.pids.items() if utils.pid_exists(pid))
+        stop_ids = Job.objects.heartbeat(alive)
+        for job_id in stop_ids:
+            utils.smart_print('Stopping job {}.'.format(job_id))
+        self.stopping_ids.update(stop_ids)
+        for job_id in self.stopping_ids & set(alive):
+            try:
+                os.kill(alive[job_id], signal.SIGINT)
+            except OSError:
+                pass
+        return stop_ids
+
+
+class ConcurrencyBudget:
+    """
+    Tracks the jobs running on this host against the CHRONIKER_MAX_CONCURRENCY
+    and CHRONIKER_CONCURRENCY_GROUPS limits, to decide whether another job may start.
+    """
+
+    def __init__(self, max_concurrency=None, groups=None):
+        self.max_concurrency = _settings.CHRONIKER_MAX_CONCURRENCY if max_concurrency is None else max_concurrency
+        self.groups = _settings.CHRONIKER_CONCURRENCY_GROUPS if groups is None else groups
+        self.total = 0
+        self.group_counts = defaultdict(int) # {group: running count}
+
+    @property
+    def enabled(self):
+        return bool(self.max_concurrency or self.groups)
+
+    def refresh(self):
+        """
+        Counts the jobs running on this host, including those started by other processes.
+        """
+        self.total = 0
+        self.group_counts.clear()
+        if not self.enabled:
+            return
+        q = Job.objects.filter(is_running=True, runtime__current_hostname=socket.gethostname())
+        for group, count in q.values_list('concurrency_group').annotate(count=Count('id')).order_by():
+            self.total += count
+            self.group_counts[group or ''] += count
+
+    def allows(self, job):
+        """
+        Returns true if the job may start without exceeding any limit.
+        """
+        if self.max_concurrency and self.total >= self.max_concurrency:
+            return False
+        limit = self.groups.get(job.concurrency_group) if job.concurrency_group else None
+        if limit and self.group_counts[job.concurrency_group] >= limit:
+            return False
+        return True
+
+    def add(self, job):
+        """
+        Counts a job that was just started.
+        """
+        self.total += 1
+        self.group_counts[job.concurrency_group or ''] += 1
+
+
 def run_cron(jobs=None, **kwargs):
 
     update_heartbeat = kwargs.pop('update_heartbeat', True)
@@ -99,6 +313,8 @@ def run_cron(jobs=None, **kwargs):
     clear_pid = kwargs.pop('clear_pid', False)
     sync = kwargs.pop('sync', False)
 
+    collectors = []
+    notifier = None
     try:
 
         # TODO: auto-kill inactive long-running cron processes whose
@@ -106,10 +322,17 @@ def run_cron(jobs=None, **kwargs):
         # Check for 0 cpu usage.
         #ps -p <pid> -o %cpu
 
-        stdout_map = defaultdict(list) # {prod_id:[]}
-        stderr_map = defaultdict(list) # {prod_id:[]}
+        stdout_map = new_output_map()
+        stderr_map = new_output_map()
         stdout_queue = Queue()
         stderr_queue = Queue()
+        # Drain output as it arrives, so job processes never block writing to a full queue.
+        collectors.extend([
+            OutputCollector(stdout_queue, stdout_map),
+            OutputCollector(stderr_queue, stderr_map),
+        ])
+        for collector in collectors:
+            collector.start()
 
         if _settings.CHRONIKER_AUTO_END_STALE_JOBS and not dryrun:
             Job.objects.end_all_stale()
@@ -149,8 +372,26 @@ def run_cron(jobs=None, **kwargs):
         else:
             q = Job.objects.due_with_met_dependencies_ordered(jobs=jobs)
 
+        budget = ConcurrencyBudget()
+        if sync or dryrun:
+            # Jobs run one at a time, or not at all.
+            budget = ConcurrencyBudget(max_concurrency=0, groups={})
+        budget.refresh()
+
         running_ids = set()
-        for job in q:
+        deadlines = [] # [(deadline, pid, proc)]
+
+        # Heartbeats of jobs run in their own process are recorded by this process, for all of them at once.
+        heartbeat = None
+        if update_heartbeat and not sync and not dryrun:
+            heartbeat = BatchHeartbeat()
+            # Jobs flagged to stop are then stopped right away, instead of at the next heartbeat.
+            notifier = notify.listen()
+
+        def launch(job):
+            """
+            Runs the job, unless its dependencies are no longer met or another process claimed it first.
+            """
 
             # This is necessary, otherwise we get the exception
             # DatabaseError: SSL error: sslv3 alert bad record mac
@@ -168,16 +409,19 @@ def run_cron(jobs=None, **kwargs):
             if not force_run and not job.is_due_with_dependencies_met(running_ids=running_ids):
                 utils.smart_print('Job {} {} is due but has unmet dependencies.'\
                     .format(job.id, job))
-                continue
+                return
 
             # Immediately mark the job as running so the next jobs can
             # update their dependency check.
             utils.smart_print('Running job {} {}.'.format(job.id, job))
             running_ids.add(job.id)
             if dryrun:
-                continue
+                return
+            if not Job.objects.claim(job, force=force_run):
+                utils.smart_print('Job {} {} was claimed by another process.'.format(job.id, job))
+                return
             job.is_running = True
-            Job.objects.filter(id=job.id).update(is_running=job.is_running)
+            budget.add(job)
 
             # Launch job.
             if sync:
@@ -191,78 +435,98 @@ def run_cron(jobs=None, **kwargs):
                 )
             else:
                 # Run job asynchronously.
-                job_func = partial(
-                    run_job,
-                    job=job,
+                proc = start_job_process(
+                    job,
                     force_run=force_run or job.force_run,
-                    update_heartbeat=update_heartbeat,
-                    name=str(job),
-                )
-                proc = JobProcess(
-                    job=job,
-                    max_seconds=job.timeout_seconds,
-                    target=job_func,
-                    name=str(job),
-                    kwargs=dict(
-                        stdout_queue=stdout_queue,
-                        stderr_queue=stderr_queue,
-                    )
+                    update_heartbeat=update_heartbeat and not heartbeat,
+                    stdout_queue=stdout_queue,
+                    stderr_queue=stderr_queue,
                 )
-                proc.start()
                 procs.append(proc)
+                if heartbeat:
+                    heartbeat.add(job.id, proc.pid)
+                if proc.deadline is not None:
+                    heapq.heappush(deadlines, (proc.deadline, proc.pid, proc))
+
+        def launch_or_queue(jobs_to_run):
+            """
+            Launches each job there's a free slot for, and returns the rest.
+            A job waiting on a queued job is queued too, so dependees still start first.
+            """
+            still_queued = []
+            for job in jobs_to_run:
+                queued_ids = set(_.id for _ in still_queued)
+                if budget.allows(job) and not any(dep.dependee_id in queued_ids for dep in job.dependencies.all()):
+                    launch(job)
+                else:
+                    still_queued.append(job)
+            return still_queued
 
-        if not dryrun:
-            print("%d Jobs are due." % len(procs))
-
-            # Wait for all job processes to complete.
-            while procs:
-
-                while not stdout_queue.empty():
-                    proc_id, proc_stdout = stdout_queue.get()
-                    stdout_map[proc_id].append(proc_stdout)
+        # Due jobs waiting for a free slot, in dependency order.
+        queued = launch_or_queue(q)
 
-                while not stderr_queue.empty():
-                    proc_id, proc_stderr = stderr_queue.get()
-                    stderr_map[proc_id].append(proc_stderr)
+        if not dryrun:
+            print("%d Jobs are due." % (len(procs) + len(queued)))
+            if queued:
+                print("%d Jobs are waiting for a free slot." % len(queued))
+
+            # Wait for all job processes to complete, only waking up when one exits,
+            # reaches its timeout or, while jobs are queued, to check for free slots.
+            while procs or queued:
+
+                timeout = None
+                if deadlines:
+                    timeout = max(deadlines[0][0] - time.time(), 0)
+                if queued:
+                    # Slots may also be freed by jobs run by other processes.
+                    timeout = 1 if timeout is None else min(timeout, 1)
+                if heartbeat and heartbeat.get_seconds_remaining() is not None:
+                    timeout = heartbeat.get_seconds_remaining() if timeout is None else min(timeout, heartbeat.get_seconds_remaining())
+                if procs:
+                    ended = set(wait([proc.sentinel for proc in procs] + ([notifier] if notifier else []), timeout=timeout))
+                else:
+                    time.sleep(timeout)
+                    ended = set()
+                stop_notified = notifier is not None and any(action == notify.STOP for action, _ in notifier.receive())
 
                 for proc in list(procs):
-
-                    if not proc.is_alive():
+                    if proc.sentinel in ended:
                         print('Process %s ended.' % (proc,))
                         procs.remove(proc)
-                    elif proc.is_expired:
-                        print('Process %s expired.' % (proc,))
-                        proc_id = proc.pid
-                        proc.terminate()
-                        run_end_datetime = timezone.now()
+                        running_ids.discard(proc.job.id)
+                        if heartbeat:
+                            heartbeat.remove(proc.job.id)
+
+                # Only processes whose deadline has passed need their run time checked.
+                while deadlines and deadlines[0][0] <= time.time():
+                    _, _, proc = heapq.heappop(deadlines)
+                    if proc not in procs or not proc.is_alive():
+                        continue
+                    if proc.is_expired:
                         procs.remove(proc)
+                        running_ids.discard(proc.job.id)
+                        if heartbeat:
+                            heartbeat.remove(proc.job.id)
+                        end_expired_process(proc, stdout_map, stderr_map)
+                    else:
+                        # Timed by CPU rather than wall-clock time, so check again later.
+                        heapq.heappush(deadlines, (time.time() + proc.check_freq, proc.pid, proc))
+
+                if heartbeat:
+                    heartbeat.beat(force=stop_notified)
+
+                # Start queued jobs as slots free up, including slots held by other processes.
+                if queued:
+                    budget.refresh()
+                    queued = launch_or_queue(queued)
 
-                        connection.close()
-                        Job.objects.update()
-                        j = Job.objects.get(id=proc.job.id)
-                        run_start_datetime = j.last_run_start_timestamp
-                        proc.job.is_running = False
-                        proc.job.force_run = False
-                        proc.job.force_stop = False
-                        proc.job.save()
-
-                        # Create log record since the job was killed before it had
-                        # a chance to do so.
-                        Log.objects.create(
-                            job=proc.job,
-                            run_start_datetime=run_start_datetime,
-                            run_end_datetime=run_end_datetime,
-                            success=False,
-                            on_time=False,
-                            hostname=socket.gethostname(),
-                            stdout=''.join(stdout_map[proc_id]),
-                            stderr=''.join(stderr_map[proc_id] + ['Job exceeded timeout\n']),
-                        )
-
-                time.sleep(1)
             print('!' * 80)
             print('All jobs complete!')
     finally:
+        for collector in collectors:
+            collector.stop()
+        if notifier:
+            notifier.close()
         if _settings.CHRONIKER_USE_PID and os.path.isfile(pid_fn) and clear_pid:
             os.unlink(pid_fn)
 
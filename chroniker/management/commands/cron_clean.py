@@ -1,21 +1,82 @@
+import time
 from datetime import timedelta
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import filesizeformat
 from django.utils import timezone
 
+from chroniker import settings as _settings
 from chroniker.models import Log
+from chroniker.retention import delete_logs, estimate_logs, prune_logs
 
 
 class Command(BaseCommand):
     help = 'Deletes old job logs.'
 
     def add_arguments(self, parser):
-        parser.add_argument('unit', choices=['minutes', 'hours', 'days', 'weeks'])
-        parser.add_argument('amount', type=int)
+        parser.add_argument('unit', nargs='?', choices=['minutes', 'hours', 'days', 'weeks'])
+        parser.add_argument('amount', nargs='?', type=int)
+        parser.add_argument('--max_entries',
+            dest='max_entries',
+            action='store_true',
+            default=False,
+            help='If given, also deletes all but the most recent logs of each job, as limited by its maximum log entries.')
+        parser.add_argument('--batch_size',
+            '--batch-size',
+            dest='batch_size',
+            type=int,
+            default=_settings.CHRONIKER_CLEAN_BATCH_SIZE,
+            help='The number of logs to delete at once.')
+        parser.add_argument('--sleep',
+            dest='sleep',
+            type=float,
+            default=_settings.CHRONIKER_CLEAN_SLEEP_SECONDS,
+            help='The number of seconds to wait between batches.')
+        parser.add_argument('--max_seconds',
+            '--max-seconds',
+            dest='max_seconds',
+            type=float,
+            default=0,
+            help='If given, stops after this many seconds, leaving the rest for the next run.')
+        parser.add_argument('--dryrun',
+            '--dry-run',
+            dest='dryrun',
+            action='store_true',
+            default=False,
+            help='If given, only estimates how many logs would be deleted.')
 
     def handle(self, *args, **options):
         unit = options['unit']
         amount = options['amount']
-        kwargs = {unit: amount}
-        time_ago = timezone.now() - timedelta(**kwargs)
-        Log.cleanup(time_ago)
+        if (unit is None) != (amount is None):
+            raise CommandError('Both a unit and an amount must be given.')
+        if unit is None and not options['max_entries']:
+            raise CommandError('Either a unit and an amount, or --max_entries, must be given.')
+        dryrun = options['dryrun']
+        deadline = None
+        if options['max_seconds']:
+            deadline = time.time() + options['max_seconds']
+        delete_kwargs = dict(batch_size=options['batch_size'], sleep_seconds=options['sleep'], deadline=deadline)
+
+        if unit is not None:
+            kwargs = {unit: amount}
+            time_ago = timezone.now() - timedelta(**kwargs)
+            q = Log.objects.filter(run_start_datetime__lte=time_ago)
+            estimate = estimate_logs(q, window=options['batch_size'])
+            if dryrun:
+                print('Would delete about %i logs, holding about %s of output.' % (estimate.rows, filesizeformat(estimate.bytes)))
+            else:
+
+                def progress(report):
+                    percent = 100. * report.rows / estimate.rows if estimate.rows else 100
+                    print('Deleted %i of about %i logs (%.0f%%), %s of output.' % (report.rows, estimate.rows, min(percent, 100), filesizeformat(report.bytes)))
+
+                print(delete_logs(q, progress=progress, **delete_kwargs))
+
+        if options['max_entries']:
+            verbose = int(options['verbosity']) > 1
+            if dryrun:
+                estimate = prune_logs(verbose=verbose, dryrun=True)
+                print('Would delete about %i expired logs, holding about %s of output.' % (estimate.rows, filesizeformat(estimate.bytes)))
+            else:
+                print(prune_logs(verbose=verbose, **delete_kwargs))
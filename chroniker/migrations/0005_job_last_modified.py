@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 03:11
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0004_auto_20240328_2035'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='last_modified',
+            field=models.DateTimeField(
+                db_index=True,
+                default=django.utils.timezone.now,
+                editable=False,
+                help_text="When the job's definition or schedule was last changed.<br/>Used by schedulers to cheaply detect changes.",
+                verbose_name='last modified'
+            ),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2.30 on 2026-10-18 05:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0005_job_last_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='concurrency_group',
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                default='',
+                help_text=
+                'If given, limits how many jobs in this group may run at once on a host,\n            to the number given for the group in the CHRONIKER_CONCURRENCY_GROUPS setting.',
+                max_length=100
+            ),
+        ),
+    ]
@@ -0,0 +1,43 @@
+# Generated by Django 4.2.30 on 2026-10-18 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0006_job_concurrency_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='log',
+            name='stdout_ref',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Where the full stdout is stored, if not above.', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='stdout_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, help_text='The size of the full stdout in bytes.', null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='stdout_data',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='stderr_ref',
+            field=models.CharField(blank=True, default='', editable=False, help_text='Where the full stderr is stored, if not above.', max_length=500),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='stderr_size',
+            field=models.PositiveBigIntegerField(blank=True, editable=False, help_text='The size of the full stderr in bytes.', null=True),
+        ),
+        migrations.AddField(
+            model_name='log',
+            name='stderr_data',
+            field=models.BinaryField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,81 @@
+# Generated by Django 4.2.30 on 2026-10-18 11:03
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+BATCH_SIZE = 500
+
+OUTPUT_FIELDS = ('stdout', 'stderr', 'stdout_ref', 'stdout_size', 'stdout_data', 'stderr_ref', 'stderr_size', 'stderr_data')
+
+
+def copy_output_to_logoutput(apps, schema_editor):
+    """
+    Copies the output of every log that has any into the new table, a batch at a time,
+    so the logs are never all loaded into memory at once.
+    """
+    Log = apps.get_model('chroniker', 'Log')
+    LogOutput = apps.get_model('chroniker', 'LogOutput')
+    db_alias = schema_editor.connection.alias
+    q = Log.objects.using(db_alias).exclude(stdout='', stderr='', stdout_ref='', stderr_ref='').order_by('id')
+    last_id = 0
+    while 1:
+        rows = list(q.filter(id__gt=last_id).values('id', *OUTPUT_FIELDS)[:BATCH_SIZE])
+        if not rows:
+            break
+        last_id = rows[-1]['id']
+        LogOutput.objects.using(db_alias).bulk_create([LogOutput(log_id=row.pop('id'), **row) for row in rows])
+
+
+def copy_logoutput_to_output(apps, schema_editor):
+    Log = apps.get_model('chroniker', 'Log')
+    LogOutput = apps.get_model('chroniker', 'LogOutput')
+    db_alias = schema_editor.connection.alias
+    q = LogOutput.objects.using(db_alias).order_by('log_id')
+    last_id = 0
+    while 1:
+        rows = list(q.filter(log_id__gt=last_id).values('log_id', *OUTPUT_FIELDS)[:BATCH_SIZE])
+        if not rows:
+            break
+        last_id = rows[-1]['log_id']
+        for row in rows:
+            Log.objects.using(db_alias).filter(id=row.pop('log_id')).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0007_log_output_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LogOutput',
+            fields=[
+                (
+                    'log',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name='output',
+                        serialize=False,
+                        to='chroniker.log'
+                    )
+                ),
+                ('stdout', models.TextField(blank=True)),
+                ('stderr', models.TextField(blank=True)),
+                (
+                    'stdout_ref',
+                    models.CharField(blank=True, default='', editable=False, help_text='Where the full stdout is stored, if not above.', max_length=500)
+                ),
+                ('stdout_size', models.PositiveBigIntegerField(blank=True, editable=False, help_text='The size of the full stdout in bytes.', null=True)),
+                ('stdout_data', models.BinaryField(blank=True, editable=False, null=True)),
+                (
+                    'stderr_ref',
+                    models.CharField(blank=True, default='', editable=False, help_text='Where the full stderr is stored, if not above.', max_length=500)
+                ),
+                ('stderr_size', models.PositiveBigIntegerField(blank=True, editable=False, help_text='The size of the full stderr in bytes.', null=True)),
+                ('stderr_data', models.BinaryField(blank=True, editable=False, null=True)),
+            ],
+        ),
+        migrations.RunPython(copy_output_to_logoutput, copy_logoutput_to_output),
+    ] + [migrations.RemoveField(model_name='log', name=name) for name in OUTPUT_FIELDS]
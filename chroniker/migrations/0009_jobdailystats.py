@@ -0,0 +1,34 @@
+# Generated by Django 4.2.30 on 2026-10-18 13:20
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0008_logoutput'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobDailyStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('runs', models.PositiveIntegerField(default=0)),
+                ('failures', models.PositiveIntegerField(default=0)),
+                ('timeouts', models.PositiveIntegerField(default=0, help_text='The number of runs killed for exceeding their timeout.')),
+                ('total_duration', models.FloatField(default=0, help_text='The total seconds of all runs.')),
+                ('min_duration', models.FloatField(blank=True, null=True)),
+                ('max_duration', models.FloatField(blank=True, null=True)),
+                ('duration_histogram', models.JSONField(blank=True, default=dict, editable=False)),
+                ('job', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_stats', to='chroniker.job')),
+            ],
+            options={
+                'verbose_name_plural': 'job daily stats',
+                'ordering': ('-date',),
+                'unique_together': {('job', 'date')},
+            },
+        ),
+    ]
@@ -0,0 +1,68 @@
+# Generated by Django 4.2.30 on 2026-10-18 14:05
+
+import math
+
+from django.db import migrations, models
+
+# The defaults of CHRONIKER_RUN_LENGTH_WINDOW and CHRONIKER_RUN_LENGTH_EWMA_ALPHA when this was written,
+# and the growth of each histogram bucket, as in chroniker.models.
+WINDOW = 20
+ALPHA = 0.2
+BUCKET_GROWTH = 1.1
+
+
+def seed_run_length_stats(apps, schema_editor):
+    """
+    Seeds each job's run length statistics from its most recent logs, so estimates don't wait on new runs.
+    """
+    Job = apps.get_model('chroniker', 'Job')
+    Log = apps.get_model('chroniker', 'Log')
+    db_alias = schema_editor.connection.alias
+    for job_id in Job.objects.using(db_alias).values_list('id', flat=True).iterator():
+        q = Log.objects.using(db_alias).filter(job_id=job_id).exclude(duration_seconds=None).order_by('-run_start_datetime')
+        durations = [float(_) for _ in reversed(q.values_list('duration_seconds', flat=True)[:WINDOW])]
+        if not durations:
+            continue
+        ewma = None
+        histogram = {}
+        for duration in durations:
+            ewma = duration if ewma is None else ALPHA * duration + (1 - ALPHA) * ewma
+            bucket = str(int(math.log(max(duration, 0) + 1, BUCKET_GROWTH)))
+            histogram[bucket] = histogram.get(bucket, 0) + 1
+        Job.objects.using(db_alias).filter(id=job_id).update(
+            run_length_count=len(durations),
+            run_length_ewma=ewma,
+            run_length_window=durations,
+            run_length_histogram=histogram,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0009_jobdailystats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='job',
+            name='run_length_count',
+            field=models.PositiveIntegerField(default=0, editable=False, help_text='The number of runs counted in the run length statistics.'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_length_ewma',
+            field=models.FloatField(blank=True, editable=False, help_text='The exponentially weighted moving average of run durations, in seconds.', null=True),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_length_histogram',
+            field=models.JSONField(blank=True, default=dict, editable=False, help_text='A decaying histogram of run durations, from which percentiles are estimated.'),
+        ),
+        migrations.AddField(
+            model_name='job',
+            name='run_length_window',
+            field=models.JSONField(blank=True, default=list, editable=False, help_text='The durations of the most recent runs, oldest first.'),
+        ),
+        migrations.RunPython(seed_run_length_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 4.2.30 on 2026-10-18 16:40
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+RUNTIME_FIELDS = (
+    'last_run_start_timestamp',
+    'last_heartbeat',
+    'lock_file',
+    'force_stop',
+    'current_hostname',
+    'current_pid',
+    'total_parts_complete',
+    'total_parts',
+)
+
+
+def copy_to_runtime_state(apps, schema_editor):
+    """
+    Copies each job's runtime fields into its new JobRuntimeState.
+    """
+    Job = apps.get_model('chroniker', 'Job')
+    JobRuntimeState = apps.get_model('chroniker', 'JobRuntimeState')
+    db_alias = schema_editor.connection.alias
+    states = [JobRuntimeState(job_id=values.pop('id'), **values) for values in Job.objects.using(db_alias).values('id', *RUNTIME_FIELDS).iterator()]
+    JobRuntimeState.objects.using(db_alias).bulk_create(states, batch_size=500)
+
+
+def copy_from_runtime_state(apps, schema_editor):
+    """
+    Copies each JobRuntimeState back into its job.
+    """
+    Job = apps.get_model('chroniker', 'Job')
+    JobRuntimeState = apps.get_model('chroniker', 'JobRuntimeState')
+    db_alias = schema_editor.connection.alias
+    for values in JobRuntimeState.objects.using(db_alias).values('job_id', *RUNTIME_FIELDS).iterator():
+        Job.objects.using(db_alias).filter(id=values.pop('job_id')).update(**values)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chroniker', '0010_job_run_length_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='JobRuntimeState',
+            fields=[
+                (
+                    'job',
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='runtime', serialize=False, to='chroniker.job'
+                    )
+                ),
+                ('last_run_start_timestamp', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='last run start timestamp')),
+                ('last_heartbeat', models.DateTimeField(blank=True, editable=False, null=True, verbose_name='last heartbeat')),
+                ('lock_file', models.CharField(blank=True, editable=False, max_length=255)),
+                ('force_stop', models.BooleanField(default=False, help_text='If checked, and running then this job will be stopped.')),
+                ('current_hostname', models.CharField(blank=True, editable=False, help_text='The name of the host currently running the job.', max_length=700, null=True)),
+                (
+                    'current_pid',
+                    models.CharField(
+                        blank=True, db_index=True, editable=False, help_text='The ID of the process currently running the job.', max_length=50, null=True
+                    )
+                ),
+                ('total_parts_complete', models.PositiveIntegerField(default=0, editable=False, help_text='The total number of complete parts.')),
+                ('total_parts', models.PositiveIntegerField(default=0, editable=False, help_text='The total number of parts of the task.')),
+            ],
+            options={
+                'verbose_name': 'job runtime state',
+            },
+        ),
+        migrations.RunPython(copy_to_runtime_state, copy_from_runtime_state),
+        migrations.RemoveField(
+            model_name='job',
+            name='current_hostname',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='current_pid',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='force_stop',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='last_heartbeat',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='last_run_start_timestamp',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='lock_file',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='total_parts',
+        ),
+        migrations.RemoveField(
+            model_name='job',
+            name='total_parts_complete',
+        ),
+    ]
@@ -1,7 +1,10 @@
 from __future__ import print_function
 
+import functools
+import io
 import itertools
 import logging
+import math
 import os
 import shlex
 import socket
@@ -10,7 +13,9 @@ import sys
 import tempfile
 import time
 import traceback
-from datetime import datetime, timedelta
+import warnings
+from collections import deque
+from datetime import datetime, timedelta, timezone as dt_timezone
 
 import threading
 try:
@@ -30,8 +35,10 @@ from django.conf import settings
 from django.contrib.sites.models import Site
 from django.core.mail import send_mail
 from django.core.management import call_command
-from django.db import models, connection, transaction
+from django.db import models, connection, connections, transaction
 from django.db.models import Q
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
 from django.template import loader, Template, Context
 from django.utils import timezone
 from django.utils.encoding import smart_str
@@ -44,6 +51,7 @@ from toposort import toposort_flatten
 
 import chroniker.constants as c
 from chroniker import utils
+from chroniker.storage import get_storage, parse_ref
 from chroniker.utils import import_string, clean_samples
 
 from . import settings as _settings # pylint: disable=unused-import
@@ -54,6 +62,7 @@ logger = logging.getLogger('chroniker.models')
 
 _state = {} # {thread_ident:job_id}
 _state_heartbeat = {} # {thread_ident:heartbeat thread object}
+_progress_reporters = {} # {job_id:progress reporter}
 
 
 def get_current_job():
@@ -98,6 +107,17 @@ def set_current_heartbeat(obj):
         _state_heartbeat[thread_ident] = obj
 
 
+def clear_current_job():
+    """
+    Disassociates any job and heartbeat from the current thread, so it can run another job.
+    """
+    thread_ident = thread.get_ident()
+    job_id = _state.pop(thread_ident, None)
+    _state_heartbeat.pop(thread_ident, None)
+    if job_id:
+        close_progress_reporter(job_id)
+
+
 def hostname_help_text_setter():
     return _('If given, ensures the job is only run on the server ' + \
              'with the equivalent host name.<br/>Not setting any hostname ' + \
@@ -108,6 +128,120 @@ def hostname_help_text_setter():
              % socket.gethostname()
 
 
+def param_to_int(param_value):
+    """
+    Converts a valid rrule parameter to an integer if it is not already
+    one, else raises a ``ValueError``.
+    """
+    if param_value in c.RRULE_WEEKDAY_DICT:
+        return c.RRULE_WEEKDAY_DICT[param_value]
+    try:
+        val = int(param_value)
+    except ValueError as exc:
+        raise ValueError('rrule parameter should be integer or weekday ' 'constant (e.g. MO, TU, etc.).  ' 'Error on: %s' % param_value) from exc
+    return val
+
+
+@functools.lru_cache(maxsize=_settings.CHRONIKER_RRULE_CACHE_SIZE)
+def parse_params(params):
+    """
+    Converts a string of rrule parameters into a tuple of (name, value) pairs.
+    Multi-valued parameters are returned as tuples so the cached result can't be modified.
+    """
+    if params is None:
+        return ()
+    param_dict = []
+    for param in params.split(';'):
+        if param.strip() == "":
+            continue # skip blanks
+        param = param.split(':')
+        if len(param) == 2:
+            param = (
+                str(param[0]).strip(),
+                tuple(param_to_int(p.strip()) for p in param[1].split(',')),
+            )
+            if len(param[1]) == 1:
+                param = (param[0], param[1][0])
+            param_dict.append(param)
+    return tuple(dict(param_dict).items())
+
+
+@functools.lru_cache(maxsize=_settings.CHRONIKER_RRULE_CACHE_SIZE)
+def compile_rrule(frequency, params, dtstart, tzinfo=None):
+    """
+    Returns the rrule for the given frequency, parameter string and start.
+
+    The tzinfo is part of the cache key because datetimes for the same instant in
+    different timezones compare equal, but produce different rules.
+    """
+    return rrule.rrule(getattr(rrule, frequency), dtstart=dtstart, **dict(parse_params(params)))
+
+
+# The distance between occurrences of each frequency whose occurrences,
+# without any other rrule params, are a fixed multiple of the interval apart.
+# Months and years vary in length, so those frequencies are excluded.
+FIXED_FREQUENCY_STEPS = {
+    c.SECONDLY: timedelta(seconds=1),
+    c.MINUTELY: timedelta(minutes=1),
+    c.HOURLY: timedelta(hours=1),
+    c.DAILY: timedelta(days=1),
+    c.WEEKLY: timedelta(weeks=1),
+}
+
+DST_MARGIN = timedelta(hours=2)
+
+
+def fast_forward_dtstart(frequency, params, dtstart, after):
+    """
+    Returns the latest occurrence of the rule before the given datetime, found with
+    arithmetic instead of iterating over every occurrence since dtstart,
+    so the rule can be restarted from there.
+
+    Only rules with a fixed interval between occurrences can be fast-forwarded.
+    For all others, including any using by* params, dtstart is returned unchanged.
+    """
+    step = FIXED_FREQUENCY_STEPS.get(frequency)
+    params = dict(parse_params(params))
+    interval = params.pop('interval', 1)
+    if step is None or params or not isinstance(interval, int) or interval < 1:
+        return dtstart
+    if dtstart is None or timezone.is_aware(dtstart) != timezone.is_aware(after):
+        return dtstart
+    step *= interval
+
+    # rrule counts occurrences in wall-clock time in dtstart's timezone.
+    if timezone.is_aware(dtstart):
+        elapsed = after.astimezone(dtstart.tzinfo).replace(tzinfo=None) - dtstart.replace(tzinfo=None)
+        if dtstart.tzinfo.utcoffset(None) is None:
+            # The offset may change, so stop short of any daylight saving time
+            # transition just before the datetime, where wall-clock order and real order differ.
+            elapsed -= DST_MARGIN
+    else:
+        elapsed = after - dtstart
+    skipped = elapsed // step - 1
+    if skipped <= 0:
+        return dtstart
+    start = dtstart + step * skipped
+
+    # Don't jump past the datetime we're looking for occurrences after,
+    # which can happen across a daylight saving time transition.
+    if timezone.is_aware(start):
+        jumped_past = start.astimezone(dt_timezone.utc) >= after.astimezone(dt_timezone.utc)
+    else:
+        jumped_past = start >= after
+    if jumped_past:
+        return dtstart
+    return start
+
+
+def clear_rrule_cache():
+    """
+    Empties the caches of parsed parameters and compiled rules.
+    """
+    parse_params.cache_clear()
+    compile_rrule.cache_clear()
+
+
 class JobHeartbeatThread(threading.Thread):
     """
     A very simple thread that updates a temporary "lock" file every second.
@@ -136,7 +270,7 @@ class JobHeartbeatThread(threading.Thread):
         """
         Do not call this directly; call ``start()`` instead.
         """
-        check_freq_secs = 5
+        check_freq_secs = _settings.CHRONIKER_HEARTBEAT_SECONDS
         while not self.halt:
 
             # If the current PID doesn't match the one we started with
@@ -150,14 +284,7 @@ class JobHeartbeatThread(threading.Thread):
 
             # Check job status and save heartbeat timestamp.
             with self.lock:
-                Job.objects.update()
-                job = Job.objects.only('id', 'force_stop').get(id=self.job_id)
-                force_stop = job.force_stop
-                Job.objects.filter(id=self.job_id).update(
-                    last_heartbeat=timezone.now(),
-                    force_stop=False,
-                    force_run=False,
-                )
+                force_stop = self.job_id in Job.objects.heartbeat([self.job_id])
 
             # If we noticed we're being forced to stop, then interrupt
             # the entire process.
@@ -179,16 +306,168 @@ class JobHeartbeatThread(threading.Thread):
             time.sleep(.1)
         self.lock_file.close()
 
-    def update_progress(self, total_parts, total_parts_complete, lock=True):
+    def update_progress(self, total_parts, total_parts_complete):
         """
         JobHeartbeatThread
         """
+        get_progress_reporter(self.job_id).update(total_parts, total_parts_complete)
+
+
+class ProgressReporter:
+    """
+    Coalesces the progress reported by a running job, writing only its latest value,
+    at most once every ``CHRONIKER_PROGRESS_SECONDS`` from a background thread.
+
+    Reporting progress only updates memory, so it's cheap enough to call on every iteration of a loop.
+    The latest value is always written when the reporter is flushed or closed.
+    """
+
+    def __init__(self, job_id, interval=None):
+        self.job_id = job_id
+        self.interval = _settings.CHRONIKER_PROGRESS_SECONDS if interval is None else interval
+        self.pid = os.getpid()
+        self.pending = None
+        self.written = None
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def update(self, total_parts, total_parts_complete):
+        """
+        Records the job's progress, to be written by the next flush.
+        """
         with self.lock:
-            Job.objects.filter(id=self.job_id).update(
-                total_parts=total_parts,
-                total_parts_complete=total_parts_complete,
-                last_heartbeat=timezone.now(),
-            )
+            self.pending = (total_parts, total_parts_complete)
+            if self.thread is None and self.interval > 0:
+                self.thread = threading.Thread(target=self.run, name='progress-%s' % self.job_id, daemon=True)
+                self.thread.start()
+        if self.interval <= 0:
+            self.flush()
+
+    def run(self):
+        """
+        Do not call this directly; it's run by the background thread.
+        """
+        try:
+            while not self.stopped.wait(self.interval):
+                self.flush()
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Writes the latest progress, if it's changed since it was last written.
+        """
+        # Held while writing, so an older value is never written after a newer one.
+        with self.flush_lock:
+            with self.lock:
+                pending, self.pending = self.pending, None
+            if pending is None or pending == self.written:
+                return
+            Job.objects.update_progress(self.job_id, *pending)
+            self.written = pending
+
+    def close(self):
+        """
+        Stops the background thread and writes the latest progress.
+        """
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.flush()
+
+
+def get_progress_reporter(job_id):
+    """
+    Returns the progress reporter of the given job in this process, creating it if needed.
+    """
+    reporter = _progress_reporters.get(job_id)
+    # A reporter inherited from the process this one was forked from has no thread here.
+    if reporter is None or reporter.pid != os.getpid():
+        reporter = _progress_reporters[job_id] = ProgressReporter(job_id)
+    return reporter
+
+
+def close_progress_reporter(job_id):
+    """
+    Writes the latest progress reported by the given job in this process, and stops its reporter.
+    """
+    reporter = _progress_reporters.pop(job_id, None)
+    if reporter is not None and reporter.pid == os.getpid():
+        reporter.close()
+
+
+class JobProgress:
+    """
+    Reports the progress of the current job through a fixed number of parts.
+
+    Usage:
+
+        with Job.progress(len(items)) as progress:
+            for item in items:
+                ...
+                progress.update()
+
+    or:
+
+        with Job.progress() as progress:
+            for item in progress.track(items):
+                ...
+
+    When not run by chroniker, progress is silently ignored.
+    """
+
+    def __init__(self, job_id, total_parts=0):
+        self.job_id = job_id
+        self.total_parts = total_parts
+        self.total_parts_complete = 0
+
+    def __enter__(self):
+        self.report()
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    def report(self):
+        if self.job_id:
+            get_progress_reporter(self.job_id).update(self.total_parts, self.total_parts_complete)
+
+    def update(self, parts=1):
+        """
+        Records that the given number of parts were completed.
+        """
+        self.total_parts_complete += parts
+        self.report()
+
+    def set(self, total_parts_complete, total_parts=None):
+        """
+        Records the total number of parts completed, and optionally a new number of parts.
+        """
+        self.total_parts_complete = total_parts_complete
+        if total_parts is not None:
+            self.total_parts = total_parts
+        self.report()
+
+    def track(self, iterable):
+        """
+        Yields each item of the iterable, counting it as a completed part once the next is requested.
+        If no number of parts was given, it's taken from the iterable's length where it has one.
+        """
+        if not self.total_parts and hasattr(iterable, '__len__'):
+            self.total_parts = len(iterable)
+            self.report()
+        for item in iterable:
+            yield item
+            self.update()
+
+    def flush(self):
+        """
+        Writes the latest progress now, instead of waiting for the next interval.
+        """
+        if self.job_id:
+            get_progress_reporter(self.job_id).flush()
 
 
 class JobDependency(models.Model):
@@ -247,6 +526,21 @@ class JobManager(models.Manager):
         kwargs = dict((_name, _value) for _name, _value in zip(_settings.CHRONIKER_JOB_NK, args))
         return self.get(**kwargs)
 
+    def local_hostname_q(self):
+        """
+        Returns a filter matching jobs that are allowed to run on the current host.
+        """
+        return Q(hostname__isnull=True) | \
+            Q(hostname='') | \
+            Q(hostname=socket.gethostname()) | \
+            Q(hostname='*')
+
+    def scheduled(self):
+        """
+        Returns a ``QuerySet`` of all enabled jobs this host may run, whether or not they're currently due.
+        """
+        return self.filter(self.local_hostname_q()).filter(enabled=True)
+
     def due(self, job=None, check_running=True):
         """
         Returns a ``QuerySet`` of all jobs waiting to be run.  NOTE: this may
@@ -265,12 +559,7 @@ class JobManager(models.Manager):
         else:
             q = self.all()
         q = q.filter(Q(next_run__lte=timezone.now()) | Q(force_run=True))
-        q = q.filter(
-            Q(hostname__isnull=True) | \
-            Q(hostname='') | \
-            Q(hostname=socket.gethostname()) | \
-            Q(hostname='*')
-            )
+        q = q.filter(self.local_hostname_q())
         q = q.filter(enabled=True)
         if check_running:
             # Get jobs that aren't running and potentially-running every-host jobs
@@ -281,6 +570,127 @@ class JobManager(models.Manager):
             q = q.filter(id=job.id)
         return q
 
+    def claim(self, job, force=False):
+        """
+        Atomically marks the job as running by this host, but only if no other
+        process has claimed it since it was found to be due.
+        Returns true if the job was claimed, in which case it's safe to run it.
+
+        Where the backend supports it, the row is locked with SKIP LOCKED, so a
+        row locked by another scheduler is skipped instead of waited on.
+        Otherwise, the UPDATE itself is conditional and its row count tells
+        whether the claim succeeded.
+        """
+        if not isinstance(job, int):
+            job = job.id
+        q = self.filter(id=job)
+        if not force:
+            # Every-host jobs may already be running on another host.
+            q = q.filter(Q(is_running=False) | Q(hostname='*'))
+        with transaction.atomic(using=self.db):
+            if connections[self.db].features.has_select_for_update_skip_locked:
+                if not list(q.select_for_update(skip_locked=True).values_list('id', flat=True)):
+                    return False
+                q = self.filter(id=job)
+            if q.update(is_running=True) != 1:
+                return False
+            JobRuntimeState.objects.using(self.db).update_or_create(job_id=job, defaults=dict(current_hostname=socket.gethostname()))
+        return True
+
+    def record_run_length(self, job, duration_seconds):
+        """
+        Adds the duration of a finished run to the job's run length statistics.
+        """
+        if not isinstance(job, int):
+            job = job.id
+        with transaction.atomic(using=self.db):
+            stats = self.select_for_update().filter(id=job).values(*RUN_LENGTH_FIELDS).first()
+            if stats is None:
+                return
+            add_run_length(stats, duration_seconds)
+            self.filter(id=job).update(**stats)
+
+    def rebuild_run_length(self, job):
+        """
+        Recalculates the job's run length statistics from its most recent logs.
+        """
+        if not isinstance(job, int):
+            job = job.id
+        stats = dict(run_length_count=0, run_length_ewma=None, run_length_window=[], run_length_histogram={})
+        q = Log.objects.filter(job_id=job).exclude(duration_seconds=None).order_by('-run_start_datetime')
+        durations = list(q.values_list('duration_seconds', flat=True)[:_settings.CHRONIKER_RUN_LENGTH_HISTOGRAM_SIZE])
+        for duration_seconds in reversed(durations):
+            add_run_length(stats, duration_seconds)
+        self.filter(id=job).update(**stats)
+
+    def heartbeat(self, job_ids):
+        """
+        Records a heartbeat for each of the given jobs still marked as running,
+        in a single UPDATE of their runtime state where the database can return the updated rows.
+        Returns the ids of those flagged to stop, whose force_stop flag is then cleared.
+
+        The jobs' own rows are only written when one was forced to run, to clear its force_run flag.
+        """
+        job_ids = list(job_ids)
+        if not job_ids:
+            return set()
+        now = timezone.now()
+        running_ids = self.filter(id__in=job_ids, is_running=True).values('id')
+        self.filter(id__in=job_ids, is_running=True, force_run=True).update(force_run=False)
+        conn = connections[self.db]
+        if conn.vendor == 'postgresql' or (conn.vendor == 'sqlite' and conn.Database.sqlite_version_info >= (3, 35)):
+            opts = JobRuntimeState._meta
+            qn = conn.ops.quote_name
+            subquery, subquery_params = running_ids.query.sql_with_params()
+            sql = 'UPDATE %s SET %s = %%s WHERE %s IN (%s) RETURNING %s, %s' % (
+                qn(opts.db_table),
+                qn(opts.get_field('last_heartbeat').column),
+                qn(opts.pk.column),
+                subquery,
+                qn(opts.pk.column),
+                qn(opts.get_field('force_stop').column),
+            )
+            params = [opts.get_field('last_heartbeat').get_db_prep_value(now, conn)] + list(subquery_params)
+            with conn.cursor() as cursor:
+                cursor.execute(sql, params)
+                stop_ids = set(job_id for job_id, force_stop in cursor.fetchall() if force_stop)
+            if stop_ids:
+                JobRuntimeState.objects.using(self.db).filter(job_id__in=stop_ids).update(force_stop=False)
+            return stop_ids
+        with transaction.atomic(using=self.db):
+            q = JobRuntimeState.objects.using(self.db).filter(job_id__in=running_ids)
+            stop_ids = set(q.select_for_update().filter(force_stop=True).values_list('job_id', flat=True))
+            q.update(last_heartbeat=now, force_stop=False)
+        return stop_ids
+
+    def update_progress(self, job, total_parts, total_parts_complete):
+        """
+        Records how much of the job's work is done, which also counts as a heartbeat.
+        """
+        if not isinstance(job, int):
+            job = job.id
+        kwargs = dict(total_parts=total_parts, total_parts_complete=total_parts_complete, last_heartbeat=timezone.now())
+        if not JobRuntimeState.objects.using(self.db).filter(job_id=job).update(**kwargs):
+            JobRuntimeState.objects.using(self.db).update_or_create(job_id=job, defaults=kwargs)
+
+    def get_dependency_graph(self):
+        """
+        Returns a dictionary of {dependee id: set(dependent ids)} of every enabled job waiting on another to complete,
+        loaded in one query.
+        """
+        graph = {}
+        q = JobDependency.objects.filter(dependent__enabled=True, wait_for_completion=True)
+        for dependee_id, dependent_id in q.values_list('dependee_id', 'dependent_id'):
+            graph.setdefault(dependee_id, set()).add(dependent_id)
+        return graph
+
+    def dependencies_prefetch(self):
+        """
+        Returns a prefetch of each job's dependency edges, along with the dependee job
+        of each edge, so dependency criteria can be evaluated in memory.
+        """
+        return models.Prefetch('dependencies', queryset=JobDependency.objects.select_related('dependee'))
+
     def due_with_met_dependencies(self, jobs=None):
         """
         Iterates over the results of due(), ignoring jobs
@@ -294,7 +704,7 @@ class JobManager(models.Manager):
         connection.close()
 
         skipped_job_ids = set()
-        for job in self.due():
+        for job in self.due().prefetch_related(self.dependencies_prefetch()):
             if jobs and job.id not in jobs:
                 skipped_job_ids.add(job.id)
                 continue
@@ -308,7 +718,7 @@ class JobManager(models.Manager):
 
             failed_dep = None
             for dep in deps:
-                if dep.dependee.id in skipped_job_ids:
+                if dep.dependee_id in skipped_job_ids:
                     continue
                 #elif dep.wait_for_completion and dep.dependee.is_due():
                 if not dep.criteria_met():
@@ -335,19 +745,23 @@ class JobManager(models.Manager):
         Returns a list of jobs sorted by dependency, with dependents after
         all their dependees.
         """
-        data = dict((j.id, set(_.dependee.id for _ in j.dependencies.all())) for j in self.due_with_met_dependencies(jobs=jobs))
-        lst = toposort_flatten(data)
-        lst = [Job.objects.get(id=_) for _ in lst]
-        return lst
+        return self.ordered_by_dependencies(list(self.due_with_met_dependencies(jobs=jobs)))
 
     def ordered_by_dependencies(self, jobs=None):
         """
         Orders the given jobs so that all dependents are ordered after their dependencies.
         """
-        jobs = jobs or []
-        data = dict((j.id, set(_.dependee.id for _ in j.dependencies.all())) for j in jobs)
+        jobs = list(jobs or [])
+        models.prefetch_related_objects(jobs, self.dependencies_prefetch())
+        job_map = dict((j.id, j) for j in jobs)
+        data = {}
+        for j in jobs:
+            data[j.id] = set()
+            for dep in j.dependencies.all():
+                data[j.id].add(dep.dependee_id)
+                job_map.setdefault(dep.dependee_id, dep.dependee)
         lst = toposort_flatten(data)
-        lst = [Job.objects.get(id=_) for _ in lst]
+        lst = [job_map[_] for _ in lst]
         return lst
 
     def stale(self):
@@ -355,13 +769,17 @@ class JobManager(models.Manager):
         Returns a set of jobs that have been running without properly updating their health status
         indicating that they've likely crashed or hung and need to be forcibly killed.
         """
+        return self.filter(self.stale_q()).select_related('runtime')
+
+    def stale_q(self):
+        """
+        Returns a filter matching running jobs that haven't recorded a heartbeat within ``CHRONIKER_STALE_MINUTES``.
+        """
         threshold = timezone.now() - timedelta(minutes=_settings.CHRONIKER_STALE_MINUTES)
-        q = self.filter(is_running=True)
-        q = q.filter(Q(last_heartbeat__isnull=True) | Q(last_heartbeat__lt=threshold))
-        return q
+        return Q(is_running=True) & (Q(runtime__last_heartbeat__isnull=True) | Q(runtime__last_heartbeat__lt=threshold))
 
     def all_running(self):
-        return self.filter(is_running=True)
+        return self.filter(is_running=True).select_related('runtime')
 
     def end_all_stale(self):
         """
@@ -413,6 +831,22 @@ class JobManager(models.Manager):
             #transaction.commit()
 
 
+def runtime_property(name):
+    """
+    Returns a property exposing the named field of the job's JobRuntimeState as if it were a field of the job.
+    Changes made through it are saved along with the job.
+    """
+
+    def fget(self):
+        return getattr(self.get_runtime(), name)
+
+    def fset(self, value):
+        setattr(self.get_runtime(), name, value)
+        self.__dict__.setdefault('_runtime_changed_fields', set()).add(name)
+
+    return property(fget, fset)
+
+
 class Job(models.Model):
     """
     A recurring ``django-admin`` command to be run.
@@ -456,11 +890,20 @@ class Job(models.Model):
 
     next_run = models.DateTimeField(_("next run"), blank=True, null=True, help_text=_("If you don't set this it will be determined automatically"))
 
-    last_run_start_timestamp = models.DateTimeField(_("last run start timestamp"), editable=False, blank=True, null=True)
+    # Fields rewritten while the job runs are kept in its JobRuntimeState, so heartbeats don't rewrite the job's own row.
+    last_run_start_timestamp = runtime_property('last_run_start_timestamp')
 
     last_run = models.DateTimeField(_("last run end timestamp"), editable=False, blank=True, null=True)
 
-    last_heartbeat = models.DateTimeField(_("last heartbeat"), editable=False, blank=True, null=True)
+    last_heartbeat = runtime_property('last_heartbeat')
+
+    last_modified = models.DateTimeField(
+        _("last modified"),
+        default=timezone.now,
+        editable=False,
+        db_index=True,
+        help_text=_('When the job\'s definition or schedule was last changed.<br/>Used by schedulers to cheaply detect changes.')
+    )
 
     is_running = models.BooleanField(
         default=False,
@@ -481,11 +924,11 @@ class Job(models.Model):
         help_text=_('If checked, the stdout of a job will ' + \
             'be emailed to the subscribers if not errors occur.'))
 
-    lock_file = models.CharField(max_length=255, blank=True, editable=False)
+    lock_file = runtime_property('lock_file')
 
     force_run = models.BooleanField(default=False, help_text=_("If checked, then this job will be run immediately."))
 
-    force_stop = models.BooleanField(default=False, help_text=_("If checked, and running then this job will be stopped."))
+    force_stop = runtime_property('force_stop')
 
     timeout_seconds = models.PositiveIntegerField(
         default=0,
@@ -497,15 +940,22 @@ class Job(models.Model):
 
     hostname = models.CharField(max_length=700, blank=True, null=True, verbose_name='target hostname', help_text=hostname_help_text_setter)
 
-    current_hostname = models.CharField(max_length=700, blank=True, null=True, editable=False, help_text=_('The name of the host currently running the job.'))
-
-    current_pid = models.CharField(
-        max_length=50, blank=True, null=True, editable=False, db_index=True, help_text=_('The ID of the process currently running the job.')
+    concurrency_group = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        db_index=True,
+        help_text=_('''If given, limits how many jobs in this group may run at once on a host,
+            to the number given for the group in the CHRONIKER_CONCURRENCY_GROUPS setting.''')
     )
 
-    total_parts_complete = models.PositiveIntegerField(default=0, editable=False, blank=False, null=False, help_text=_('The total number of complete parts.'))
+    current_hostname = runtime_property('current_hostname')
 
-    total_parts = models.PositiveIntegerField(default=0, editable=False, blank=False, null=False, help_text=_('The total number of parts of the task.'))
+    current_pid = runtime_property('current_pid')
+
+    total_parts_complete = runtime_property('total_parts_complete')
+
+    total_parts = runtime_property('total_parts')
 
     is_monitor = models.BooleanField(default=False, help_text=_('If checked, will appear in the monitors section.'))
 
@@ -539,6 +989,19 @@ class Job(models.Model):
     log_stderr = models.BooleanField(default=True, help_text=_('''If checked, all characters printed to stderr will be
             saved in a log record.'''))
 
+    # Running statistics of the durations of the job's runs, updated as each run is logged, so estimates never read its logs.
+    run_length_count = models.PositiveIntegerField(default=0, editable=False, help_text=_('The number of runs counted in the run length statistics.'))
+
+    run_length_ewma = models.FloatField(
+        blank=True, null=True, editable=False, help_text=_('The exponentially weighted moving average of run durations, in seconds.')
+    )
+
+    run_length_window = models.JSONField(default=list, blank=True, editable=False, help_text=_('The durations of the most recent runs, oldest first.'))
+
+    run_length_histogram = models.JSONField(
+        default=dict, blank=True, editable=False, help_text=_('A decaying histogram of run durations, from which percentiles are estimated.')
+    )
+
     class Meta:
         ordering = (
             'name',
@@ -602,36 +1065,21 @@ class Job(models.Model):
         Returns a list of jobs that depend on this job.
         Retrieves jobs recursively, stopping if it detects cycles.
         """
-        priors = set([self.id])
-        pending = list(self.dependents.all()\
-            .filter(dependent__enabled=True, wait_for_completion=True)\
-            .values_list('dependent_id', flat=True))
-        chained = set()
-        while pending:
-            job_id = pending.pop(0)
-            if job_id in priors:
-                continue
-            priors.add(job_id)
-            job = Job.objects.only('id').get(id=job_id)
-            chained.add(job)
-            pending.extend(job.dependents.all()\
-                .filter(dependent__enabled=True, wait_for_completion=True)\
-                .values_list('dependent_id', flat=True))
-        return chained
+        chained_ids = get_chain(Job.objects.get_dependency_graph(), self.id)
+        return set(Job.objects.only('id').filter(id__in=chained_ids))
 
     def get_run_length_estimate(self, samples=20):
         """
-        Returns the average run length in seconds.
+        Returns the average run length in seconds, over the given number of most recent runs,
+        up to the CHRONIKER_RUN_LENGTH_WINDOW kept in the job's run length statistics.
         """
-        q = sorted(list(self.logs.all()\
-            .values_list('duration_seconds', flat=True)\
-            .order_by('-run_end_datetime')[:samples]))
-        if len(q) >= 3:
-            # Drop the upper and lower extremes.
-            q = q[1:-1]
-        if not q:
-            return
-        return int(round(sum(q) / float(len(q))))
+        return estimate_run_length(self.run_length_window, samples=samples)
+
+    def get_run_length_quantile(self, quantile):
+        """
+        Returns the approximate run length in seconds at the given quantile, between 0 and 1, of recent runs.
+        """
+        return get_histogram_quantile(self.run_length_histogram, quantile)
 
     @property
     def estimated_seconds_to_completion(self):
@@ -699,7 +1147,8 @@ class Job(models.Model):
     def save(self, **kwargs):
         self.full_clean()
         # The `clean` method can update `self.frequency`
-        save_fields = ['frequency']
+        save_fields = ['frequency', 'last_modified']
+        self.last_modified = timezone.now()
 
         tz = timezone.get_default_timezone()
 
@@ -713,16 +1162,15 @@ class Job(models.Model):
                 next_run = self.next_run or timezone.now()
                 save_fields += ['next_run']
                 try:
-                    self.next_run = self.rrule.after(utils.make_aware(next_run, tz))
+                    self.next_run = self.get_next_run_after(utils.make_aware(next_run, tz))
                 except ValueError:
-                    self.next_run = utils.make_aware(self.rrule.after(utils.make_naive(next_run, tz)), tz)
+                    self.next_run = utils.make_aware(self.get_next_run_after(utils.make_naive(next_run, tz)), tz)
                 except TypeError:
-                    self.next_run = utils.make_aware(self.rrule.after(utils.make_naive(next_run, tz)), tz)
+                    self.next_run = utils.make_aware(self.get_next_run_after(utils.make_naive(next_run, tz)), tz)
 
-        if not self.is_running:
+        if not self.is_running and (self.current_hostname or self.current_pid):
             self.current_hostname = None
             self.current_pid = None
-            save_fields += ['current_hostname', 'current_pid']
 
         if self.next_run:
             self.next_run = utils.make_aware(self.next_run, tz)
@@ -730,27 +1178,46 @@ class Job(models.Model):
                 save_fields += ['next_run']
 
         update_fields = kwargs.get('update_fields')
+        if update_fields is None and not self._state.adding and not kwargs.get('force_insert'):
+            # Runs may have finished since this job was loaded, so leave their statistics to record_run_length().
+            deferred_fields = self.get_deferred_fields()
+            update_fields = [
+                f.name for f in self._meta.concrete_fields
+                if not f.primary_key and f.name not in RUN_LENGTH_FIELDS and f.attname not in deferred_fields
+            ]
+
         if update_fields is not None:
             extra_update_fields = [
                 field for field in save_fields if field not in update_fields
             ]
             # update_fields can be a tuple, or list, or set
+            # Runtime fields are saved to the job's JobRuntimeState instead.
             extended_update_fields = type(update_fields)(
-                itertools.chain(update_fields, extra_update_fields)
+                itertools.chain((name for name in update_fields if name not in RUNTIME_FIELDS), extra_update_fields)
             )
             kwargs['update_fields'] = extended_update_fields
 
         super().save(**kwargs)
 
-        # Delete expired logs.
-        if self.maximum_log_entries:
-            cutoff = self.maximum_log_entries - 1
-            log_q = self.logs.all().order_by('-run_start_datetime')[cutoff:]
-            if log_q.exists():
-                cutoff_dt = log_q[0].run_start_datetime
-                qs = Log.objects.filter(job=self.id, run_start_datetime__lte=cutoff_dt)
-                for o in qs:
-                    o.delete()
+        runtime_changed_fields = self.__dict__.pop('_runtime_changed_fields', None)
+        if runtime_changed_fields:
+            runtime = self.get_runtime()
+            values = dict((name, getattr(runtime, name)) for name in runtime_changed_fields)
+            if not JobRuntimeState.objects.filter(job_id=self.pk).update(**values):
+                runtime.job_id = self.pk
+                runtime.save(force_insert=True)
+            runtime._state.adding = False
+
+    def get_runtime(self):
+        """
+        Returns the job's JobRuntimeState, or a new unsaved one if it has never run.
+        """
+        try:
+            return self.runtime
+        except JobRuntimeState.DoesNotExist:
+            runtime = JobRuntimeState(job=self)
+            self.runtime = runtime
+            return runtime
 
     def dependencies_met(self, running_ids=None):
         """
@@ -789,7 +1256,7 @@ class Job(models.Model):
         delta = self.next_run - timezone.now()
         if delta.days < 0:
             # The job is past due and should be run as soon as possible
-            if self.check_is_running():
+            if self.check_is_running(save=False):
                 return _('running')
             return _('due')
         if delta.seconds < 60:
@@ -805,12 +1272,30 @@ class Job(models.Model):
         """
         Returns the rrule objects for this ``Job``.
         Can also be accessed via the ``rrule`` property of the ``Job``.
+
+        Compiled rules are cached on the frequency, params and next run,
+        so changing any of those fields yields a new rule.
         """
-        frequency = getattr(rrule, self.frequency)
-        return rrule.rrule(frequency, dtstart=self.next_run, **self.get_params())
+        if self.next_run is None:
+            # Without a start, rrule starts at the current time, so the rule can't be reused.
+            return rrule.rrule(getattr(rrule, self.frequency), dtstart=None, **self.get_params())
+        return compile_rrule(self.frequency, self.params, self.next_run, self.next_run.tzinfo)
 
     rrule = property(get_rrule)
 
+    def get_next_run_after(self, dt):
+        """
+        Returns the first occurrence of this ``Job``\'s schedule after the given datetime.
+
+        For a stale next run, such as after the job was disabled for weeks, the rule is
+        first fast-forwarded to just before the given datetime, rather than iterating
+        over every missed occurrence.
+        """
+        dtstart = fast_forward_dtstart(self.frequency, self.params, self.next_run, dt)
+        if dtstart is self.next_run:
+            return self.rrule.after(dt)
+        return rrule.rrule(getattr(rrule, self.frequency), dtstart=dtstart, **self.get_params()).after(dt)
+
     def param_to_int(self, param_value):
         """
         Converts a valid rrule parameter to an integer if it is not already
@@ -824,13 +1309,7 @@ class Job(models.Model):
         >>> job.get_params()
         {'byweekday': [1, 2, 4, 5]}
         """
-        if param_value in c.RRULE_WEEKDAY_DICT:
-            return c.RRULE_WEEKDAY_DICT[param_value]
-        try:
-            val = int(param_value)
-        except ValueError as exc:
-            raise ValueError('rrule parameter should be integer or weekday ' 'constant (e.g. MO, TU, etc.).  ' 'Error on: %s' % param_value) from exc
-        return val
+        return param_to_int(param_value)
 
     def get_params(self):
         """
@@ -840,23 +1319,7 @@ class Job(models.Model):
         >>> job.get_params()
         {'count': 1, 'byminute': [1, 2, 4, 5], 'bysecond': 1}
         """
-        if self.params is None:
-            return {}
-        params = self.params.split(';')
-        param_dict = []
-        for param in params:
-            if param.strip() == "":
-                continue # skip blanks
-            param = param.split(':')
-            if len(param) == 2:
-                param = (
-                    str(param[0]).strip(),
-                    [self.param_to_int(p.strip()) for p in param[1].split(',')],
-                )
-                if len(param[1]) == 1:
-                    param = (param[0], param[1][0])
-                param_dict.append(param)
-        return dict(param_dict)
+        return dict((name, list(value) if isinstance(value, tuple) else value) for name, value in parse_params(self.params))
 
     def get_args(self):
         """
@@ -948,26 +1411,29 @@ class Job(models.Model):
         Updates the record in the database to show it as running.
         Updates both the fields in the current instance as well as the fields in the database.
         """
+        now = timezone.now()
         kwargs = dict(
-            is_running=True,
-            last_run_start_timestamp=timezone.now(),
+            last_run_start_timestamp=now,
             current_hostname=socket.gethostname(),
             current_pid=str(os.getpid()),
             total_parts=0,
             total_parts_complete=0,
             lock_file=lock_file or '',
-            last_heartbeat=timezone.now(),
+            last_heartbeat=now,
         )
-        Job.objects.filter(id=self.id).update(**kwargs)
-        for name, value in kwargs.items():
-            setattr(self, name, value)
+        with transaction.atomic():
+            Job.objects.filter(id=self.id).update(is_running=True)
+            self.runtime, _ = JobRuntimeState.objects.update_or_create(job_id=self.id, defaults=kwargs)
+        self.is_running = True
 
-    def handle_run(self, update_heartbeat=True, stdout_queue=None, stderr_queue=None, *args, **kwargs):
+    def handle_run(self, update_heartbeat=True, stdout_queue=None, stderr_queue=None, close_connection=True, *args, **kwargs):
         """
         This method implements the code to actually run a ``Job``.  This is
         meant to be run, primarily, by the `run_job` management command as a
         subprocess, which can be invoked by calling this ``Job``\'s ``run``
         method.
+
+        Pool workers pass close_connection=False to keep their database connection open between jobs.
         """
         print('Handling run...')
 
@@ -980,12 +1446,17 @@ class Job(models.Model):
         original_pid = os.getpid()
 
         # Redirect output so that we can log and easily check for errors.
-        stdout = utils.TeeFile(sys.stdout, auto_flush=True, queue=stdout_queue, local=self.log_stdout)
-        stderr = utils.TeeFile(sys.stderr, auto_flush=True, queue=stderr_queue, local=self.log_stderr)
+        storage = get_storage()
+        raw_output = {}
+        stdout = utils.TeeFile(sys.stdout, auto_flush=True, queue=stdout_queue, local=self.log_stdout, spool=bool(storage) and self.log_stdout)
+        stderr = utils.TeeFile(sys.stderr, auto_flush=True, queue=stderr_queue, local=self.log_stderr, spool=bool(storage) and self.log_stderr)
         ostdout = sys.stdout
         ostderr = sys.stderr
         sys.stdout = stdout
         sys.stderr = stderr
+        # So output isn't left waiting for the next write if the job stalls and is killed.
+        stdout.start_flushing()
+        stderr.start_flushing()
 
         try:
             args, options = self.get_args()
@@ -993,6 +1464,8 @@ class Job(models.Model):
             heartbeat = None
             if update_heartbeat:
                 heartbeat = JobHeartbeatThread(job_id=self.id, lock=lock)
+            else:
+                set_current_job(self.id)
 
             lock_file = ''
             if heartbeat and heartbeat.lock_file:
@@ -1001,7 +1474,8 @@ class Job(models.Model):
             try:
                 with lock:
                     # Fixes MySQL error "Commands out of sync"?
-                    connection.close()
+                    if close_connection:
+                        connection.close()
 
                     self.mark_running(lock_file=lock_file)
 
@@ -1021,8 +1495,9 @@ class Job(models.Model):
                     completed_process = subprocess.run(
                         shlex.split(self.raw_command), stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=False, universal_newlines=True
                     )
-                    _stdout_str = completed_process.stdout
-                    _stderr_str = completed_process.stderr
+                    raw_output = {'stdout': completed_process.stdout, 'stderr': completed_process.stderr}
+                    _stdout_str = utils.trim_output(completed_process.stdout)
+                    _stderr_str = utils.trim_output(completed_process.stderr)
                     _raw_status = completed_process.returncode
 
                     if self.log_stdout:
@@ -1050,6 +1525,9 @@ class Job(models.Model):
                 heartbeat.stop()
                 heartbeat.join()
 
+            # Write the last progress reported, before it's read below.
+            close_progress_reporter(self.id)
+
             # If this was a forced run, then don't update the
             # next_run date.
             # next_run = self.next_run.replace(tzinfo=None)
@@ -1059,7 +1537,7 @@ class Job(models.Model):
                 if next_run < timezone.now():
                     next_run = timezone.now()
                 _next_run = next_run
-                next_run = self.rrule.after(next_run)
+                next_run = self.get_next_run_after(next_run)
                 print(_next_run, next_run)
                 assert next_run != _next_run, 'RRule failed to increment next run datetime.'
             # next_run = next_run.replace(tzinfo=timezone.get_current_timezone())
@@ -1069,17 +1547,18 @@ class Job(models.Model):
             try:
                 with lock:
                     Job.objects.update()
-                    job = Job.objects.only('id', 'total_parts', 'last_run_successful').get(id=self.id)
-                    tpc = (job.last_run_successful and job.total_parts) or 0 # pylint: disable=E0601
+                    job = Job.objects.only('id', 'last_run_successful').get(id=self.id)
+                    total_parts = JobRuntimeState.objects.filter(job_id=self.id).values_list('total_parts', flat=True).first()
+                    tpc = (job.last_run_successful and total_parts) or 0 # pylint: disable=E0601
                     Job.objects.filter(id=self.id).update(
                         is_running=False,
-                        lock_file='',
                         last_run=run_start_datetime,
                         force_run=False,
                         next_run=next_run,
+                        last_modified=timezone.now(),
                         last_run_successful=last_run_successful,
-                        total_parts_complete=tpc,
                     )
+                    JobRuntimeState.objects.filter(job_id=self.id).update(lock_file='', total_parts_complete=tpc)
             except Exception as e:
                 # The command failed to run; log the exception
                 t = loader.get_template('chroniker/error_message.txt')
@@ -1093,35 +1572,26 @@ class Job(models.Model):
                 return # pylint: disable=W0150
 
             # Redirect output back to default
+            stdout.stop_flushing()
+            stderr.stop_flushing()
+            stdout.flush()
+            stderr.flush()
             sys.stdout = ostdout
             sys.stderr = ostderr
 
             # Record run log.
             print('Recording log...')
 
+            # The captured output was already decoded, and trimmed to its head and tail, as it was written.
             if self.log_stdout:
-                if not stdout_str:
-                    stdout_str = stdout.getvalue()
-                if isinstance(stdout_str, str):
-                    stdout_str = stdout_str.encode('utf-8', 'replace')
-                else:
-                    stdout_str = str(stdout_str, 'utf-8', 'replace')
-                if isinstance(stdout_str, bytes):
-                    stdout_str = stdout_str.decode('utf-8')
+                stdout_str = stdout_str or stdout.getvalue()
 
             if self.log_stderr:
-                if not stderr_str:
-                    stderr_str = stderr.getvalue()
-                if isinstance(stderr_str, str):
-                    stderr_str = stderr_str.encode('utf-8', 'replace')
-                else:
-                    stderr_str = str(stderr_str, 'utf-8', 'replace')
-                if isinstance(stderr_str, bytes):
-                    stderr_str = stderr_str.decode('utf-8')
+                stderr_str = stderr_str or stderr.getvalue()
 
             run_end_datetime = timezone.now()
             duration_seconds = (run_end_datetime - run_start_datetime).total_seconds()
-            log = Log.objects.create(
+            log = Log(
                 job=self,
                 run_start_datetime=run_start_datetime,
                 run_end_datetime=run_end_datetime,
@@ -1131,6 +1601,34 @@ class Job(models.Model):
                 stderr=stderr_str,
                 success=last_run_successful,
             )
+            if storage:
+                for field, tee in (('stdout', stdout), ('stderr', stderr)):
+                    if not getattr(self, 'log_' + field):
+                        continue
+                    if field in raw_output:
+                        fileobj = io.BytesIO(
+                            (raw_output[field] or '').encode(_settings.CHRONIKER_OUTPUT_ENCODING, _settings.CHRONIKER_OUTPUT_ERRORS)
+                        )
+                    else:
+                        fileobj = tee.get_spooled()
+                    try:
+                        log.store_output(field, fileobj, storage)
+                    except Exception as e:
+                        # Fall back to storing the captured head and tail in the log itself.
+                        print('Error storing %s: %s' % (field, e), file=sys.stderr)
+                        traceback.print_exc()
+                    tee.close()
+            log.save()
+
+            # Delete expired logs, once enough have built up to be worth a delete.
+            if self.maximum_log_entries and _settings.CHRONIKER_LOG_PRUNE_MARGIN is not None:
+                try:
+                    from chroniker.retention import prune_job_logs # pylint: disable=import-outside-toplevel
+                    margin = max(1, int(self.maximum_log_entries * _settings.CHRONIKER_LOG_PRUNE_MARGIN))
+                    prune_job_logs(self.id, self.maximum_log_entries, margin=margin)
+                except Exception as e:
+                    print('Error deleting expired logs: %s' % e, file=sys.stderr)
+                    traceback.print_exc()
 
             # Email subscribers.
             try:
@@ -1163,11 +1661,15 @@ class Job(models.Model):
                     job.last_run_successful = False
                     job.save()
 
+            # So the next job run by this thread isn't mistaken for this one.
+            clear_current_job()
+
             print('Job done.')
 
-    def check_is_running(self):
+    def check_is_running(self, save=True):
         """
         This function actually checks to ensure that a job is running.
+        If save is false, a job found not to be running isn't updated, e.g. when only displaying it.
         """
         if _settings.CHRONIKER_CHECK_LOCK_FILE and self.is_running and self.lock_file:
             # The Job thinks that it is running, so lets actually check
@@ -1181,9 +1683,10 @@ class Job(models.Model):
                     return True
 
             # This job isn't running; update it's info
-            self.is_running = False
-            self.lock_file = ""
-            self.save()
+            if save:
+                self.is_running = False
+                self.lock_file = ""
+                self.save()
             return False
 
         # We already ignore is_running if hostname == * so this shouldn't be needed
@@ -1198,14 +1701,108 @@ class Job(models.Model):
 
     @classmethod
     def update_progress(cls, *args, **kwargs):
+        """
+        Records the progress of the job run by the current thread.
+        Progress is written in the background, at most once every ``CHRONIKER_PROGRESS_SECONDS``.
+        """
+        if 'lock' in kwargs:
+            warnings.warn('The lock argument of Job.update_progress() has no effect and will be removed.', DeprecationWarning, stacklevel=2)
+            del kwargs['lock']
         heartbeat = get_current_heartbeat()
         if heartbeat:
             return heartbeat.update_progress(*args, **kwargs)
+        # Jobs whose heartbeats are recorded by their supervisor have no heartbeat thread.
+        job_id = _state.get(thread.get_ident())
+        if job_id:
+            get_progress_reporter(job_id).update(*args, **kwargs)
+
+    @classmethod
+    def progress(cls, total_parts=0):
+        """
+        Returns a context manager reporting the progress of the job run by the current thread.
+        See JobProgress.
+        """
+        heartbeat = get_current_heartbeat()
+        return JobProgress(heartbeat.job_id if heartbeat else _state.get(thread.get_ident()), total_parts)
+
+
+RUNTIME_FIELDS = (
+    'last_run_start_timestamp',
+    'last_heartbeat',
+    'lock_file',
+    'force_stop',
+    'current_hostname',
+    'current_pid',
+    'total_parts_complete',
+    'total_parts',
+)
+
+
+class JobRuntimeState(models.Model):
+    """
+    The state of a job that changes while it runs, kept out of the job's own row so frequent heartbeats and progress
+    updates write a small row, and don't contend with schedulers and admins reading and saving the job.
+
+    These fields are also exposed as attributes of the job.
+    """
+
+    job = models.OneToOneField(Job, on_delete=models.CASCADE, primary_key=True, related_name='runtime')
+
+    last_run_start_timestamp = models.DateTimeField(_("last run start timestamp"), editable=False, blank=True, null=True)
+
+    last_heartbeat = models.DateTimeField(_("last heartbeat"), editable=False, blank=True, null=True)
+
+    lock_file = models.CharField(max_length=255, blank=True, editable=False)
+
+    force_stop = models.BooleanField(default=False, help_text=_("If checked, and running then this job will be stopped."))
+
+    current_hostname = models.CharField(max_length=700, blank=True, null=True, editable=False, help_text=_('The name of the host currently running the job.'))
+
+    current_pid = models.CharField(
+        max_length=50, blank=True, null=True, editable=False, db_index=True, help_text=_('The ID of the process currently running the job.')
+    )
+
+    total_parts_complete = models.PositiveIntegerField(default=0, editable=False, blank=False, null=False, help_text=_('The total number of complete parts.'))
+
+    total_parts = models.PositiveIntegerField(default=0, editable=False, blank=False, null=False, help_text=_('The total number of parts of the task.'))
+
+    class Meta:
+        verbose_name = _('job runtime state')
+
+    def __str__(self):
+        return str(self.job)
+
+
+def delete_stored_on_commit(outputs, using):
+    """
+    Removes the output kept outside the database by each of the given LogOutputs once the current transaction commits,
+    so a failed delete doesn't leave logs pointing at missing files.
+    """
+    if not outputs:
+        return
+
+    def delete_stored():
+        for output in outputs:
+            output.delete_stored()
+
+    transaction.on_commit(delete_stored, using=using)
+
+
+class LogQuerySet(models.QuerySet):
+
+    def delete(self):
+        stored = LogOutput.objects.using(self.db).filter(log__in=self).get_stored()
+        result = super().delete()
+        delete_stored_on_commit(stored, self.db)
+        return result
 
 
 class Log(models.Model):
     """
-    A record of stdout and stderr of a ``Job``.
+    A record of a run of a ``Job``.
+
+    Its stdout and stderr are kept in a separate ``LogOutput``, so queries of
+    run times and outcomes don't have to read through large text columns.
     """
 
     job = models.ForeignKey('chroniker.Job', related_name='logs', on_delete=models.CASCADE)
@@ -1216,10 +1813,6 @@ class Log(models.Model):
 
     duration_seconds = models.PositiveIntegerField(editable=False, db_index=True, verbose_name='duration (total seconds)', blank=True, null=True)
 
-    stdout = models.TextField(blank=True)
-
-    stderr = models.TextField(blank=True)
-
     hostname = models.CharField(max_length=700, blank=True, null=True, editable=False, help_text=_('The hostname this job was executed on.'))
 
     success = models.BooleanField(default=True, db_index=True, editable=False)
@@ -1235,6 +1828,11 @@ class Log(models.Model):
         )
     )
 
+    # Set when the output was changed, so it's saved along with the log.
+    _output_changed = False
+
+    objects = LogQuerySet.as_manager()
+
     class Meta:
         ordering = ('-run_start_datetime',)
 
@@ -1248,6 +1846,7 @@ class Log(models.Model):
         return self.__unicode__()
 
     def save(self, **kwargs):
+        adding = self._state.adding
         if self.run_start_datetime and self.run_end_datetime:
             assert self.run_start_datetime <= self.run_end_datetime, 'Job must start before it ends.'
             time_diff = (self.run_end_datetime - self.run_start_datetime)
@@ -1263,6 +1862,73 @@ class Log(models.Model):
 
         super().save(**kwargs)
 
+        if self._output_changed:
+            output = self.get_output()
+            # Runs without any output don't need a row.
+            if not output._state.adding or output.has_output():
+                output.log = self
+                output.save()
+            self._output_changed = False
+
+        if adding and self.duration_seconds is not None:
+            JobDailyStats.objects.record(self)
+            Job.objects.record_run_length(self.job_id, self.duration_seconds)
+
+    def delete(self, *args, **kwargs):
+        stored = LogOutput.objects.using(self._state.db).filter(log_id=self.pk).get_stored()
+        result = super().delete(*args, **kwargs)
+        delete_stored_on_commit(stored, self._state.db)
+        return result
+
+    def get_output(self):
+        """
+        Returns the log's output, which is empty and unsaved if nothing was recorded.
+        """
+        try:
+            return self.output
+        except LogOutput.DoesNotExist:
+            self.output = LogOutput(log=self)
+            return self.output
+
+    def set_output(self, **kwargs):
+        """
+        Sets the given fields of the log's output, which is saved along with the log.
+        """
+        output = self.get_output()
+        for name, value in kwargs.items():
+            setattr(output, name, value)
+        self._output_changed = True
+
+    @property
+    def stdout(self):
+        return self.get_output().stdout
+
+    @stdout.setter
+    def stdout(self, value):
+        self.set_output(stdout=value)
+
+    @property
+    def stderr(self):
+        return self.get_output().stderr
+
+    @stderr.setter
+    def stderr(self, value):
+        self.set_output(stderr=value)
+
+    def store_output(self, field, fileobj, storage):
+        """
+        Stores the contents of the binary file fileobj as the given field with the given storage backend.
+        """
+        self.get_output().store(field, fileobj, storage)
+        self._output_changed = True
+
+    def read_output(self, field, head_size=0, tail_size=0):
+        """
+        Returns the full output of the given field, wherever it's stored.
+        If head_size and tail_size are given, only the first and last that many characters are read into memory.
+        """
+        return self.get_output().read(field, head_size=head_size, tail_size=tail_size)
+
     def duration_str(self):
         sec = timedelta(seconds=self.duration_seconds)
         d = datetime(1, 1, 1) + sec
@@ -1290,6 +1956,7 @@ class Log(models.Model):
 
         args = self.__dict__.copy()
         args['job'] = self.job
+        args['stdout'] = self.stdout
         args['stderr'] = self.stderr if self.job.is_monitor else None
         args['url'] = mark_safe('http://%s%s' % (current_site.domain, self.job.monitor_url_rendered))
         ctx = Context(args)
@@ -1298,16 +1965,8 @@ class Log(models.Model):
         if is_error and self.job.is_monitor and self.job.monitor_error_template:
             body = Template(self.job.monitor_error_template).render(ctx)
         else:
-            stdout_str = self.stdout
-            try:
-                stdout_str = self.stdout.decode('utf-8')
-            except AttributeError:
-                pass
-            stderr_str = self.stderr
-            try:
-                stderr_str = self.stderr.decode('utf-8')
-            except AttributeError:
-                pass
+            stdout_str = self.read_output('stdout', head_size=_settings.CHRONIKER_LOG_HEAD_SIZE, tail_size=_settings.CHRONIKER_LOG_TAIL_SIZE)
+            stderr_str = self.read_output('stderr', head_size=_settings.CHRONIKER_LOG_HEAD_SIZE, tail_size=_settings.CHRONIKER_LOG_TAIL_SIZE)
             body = "Ouput:\n%s\nError output:\n%s" % (stdout_str, stderr_str)
 
         base_url = None
@@ -1345,24 +2004,378 @@ class Log(models.Model):
         return (result) or '(No errors)'
 
     def stdout_long_sample(self):
-        return clean_samples(self.stdout or '(No output)')
+        return clean_samples(self.read_output('stdout', head_size=10000, tail_size=10000) or '(No output)')
 
     stdout_long_sample.allow_tags = True
 
     def stderr_long_sample(self):
-        return clean_samples(str(self.stderr or '(No output)'))
+        return clean_samples(self.read_output('stderr', head_size=10000, tail_size=10000) or '(No output)')
 
     stderr_long_sample.allow_tags = True
 
     @classmethod
-    def cleanup(cls, time_ago=None):
+    def cleanup(cls, time_ago=None, **kwargs):
         """
-        Deletes all log entries older than the given date.
+        Deletes all log entries older than the given date, in batches.
+        Accepts the same options as chroniker.retention.delete_logs().
+        Returns a RetentionReport.
         """
+        from chroniker.retention import delete_logs # pylint: disable=import-outside-toplevel
         q = cls.objects.all()
         if time_ago:
             q = q.filter(run_start_datetime__lte=time_ago)
-        q.delete()
+        return delete_logs(q, **kwargs)
+
+
+class LogOutputQuerySet(models.QuerySet):
+
+    def get_stored(self):
+        """
+        Returns a list of the outputs kept outside the database by a storage backend,
+        with only the fields needed to remove them.
+        """
+        return list(self.exclude(stdout_ref='', stderr_ref='').only('log_id', 'stdout_ref', 'stderr_ref'))
+
+    def delete(self):
+        stored = self.get_stored()
+        result = super().delete()
+        delete_stored_on_commit(stored, self.db)
+        return result
+
+
+class LogOutput(models.Model):
+    """
+    The stdout and stderr of a ``Log``.
+    """
+
+    log = models.OneToOneField(Log, related_name='output', primary_key=True, on_delete=models.CASCADE)
+
+    stdout = models.TextField(blank=True)
+
+    stderr = models.TextField(blank=True)
+
+    # When output is kept by a storage backend, the text fields above only hold a preview.
+    stdout_ref = models.CharField(max_length=500, blank=True, default='', editable=False, help_text=_('Where the full stdout is stored, if not above.'))
+
+    stdout_size = models.PositiveBigIntegerField(blank=True, null=True, editable=False, help_text=_('The size of the full stdout in bytes.'))
+
+    stdout_data = models.BinaryField(blank=True, null=True, editable=False)
+
+    stderr_ref = models.CharField(max_length=500, blank=True, default='', editable=False, help_text=_('Where the full stderr is stored, if not above.'))
+
+    stderr_size = models.PositiveBigIntegerField(blank=True, null=True, editable=False, help_text=_('The size of the full stderr in bytes.'))
+
+    stderr_data = models.BinaryField(blank=True, null=True, editable=False)
+
+    objects = LogOutputQuerySet.as_manager()
+
+    def __str__(self):
+        return 'output of log %s' % self.log_id
+
+    def has_output(self):
+        return bool(self.stdout or self.stderr or self.stdout_ref or self.stderr_ref)
+
+    def store(self, field, fileobj, storage):
+        """
+        Stores the contents of the binary file fileobj as the given field, either 'stdout' or 'stderr',
+        with the given storage backend, keeping only a preview in the field itself.
+        """
+        fileobj.seek(0, os.SEEK_END)
+        size = fileobj.tell()
+        fileobj.seek(0)
+        # A character split at the end of the preview is dropped.
+        preview = fileobj.read(_settings.CHRONIKER_LOG_PREVIEW_SIZE).decode(_settings.CHRONIKER_OUTPUT_ENCODING, 'ignore')
+        fileobj.seek(0)
+        setattr(self, field + '_ref', storage.save(self, field, fileobj))
+        setattr(self, field + '_size', size)
+        setattr(self, field, preview[:_settings.CHRONIKER_LOG_PREVIEW_SIZE])
+
+    def open(self, field):
+        """
+        Returns a binary file object with the full output of the given field, wherever it's stored.
+        """
+        ref = getattr(self, field + '_ref')
+        if not ref:
+            return io.BytesIO((getattr(self, field) or '').encode(_settings.CHRONIKER_OUTPUT_ENCODING, _settings.CHRONIKER_OUTPUT_ERRORS))
+        storage, key = parse_ref(ref)
+        return storage.open(self, field, key)
+
+    def open_compressed(self, field):
+        """
+        Returns a binary file object with the gzip-compressed output of the given field,
+        or None if it's stored uncompressed.
+        """
+        ref = getattr(self, field + '_ref')
+        if not ref:
+            return None
+        storage, key = parse_ref(ref)
+        return storage.open_compressed(self, field, key)
+
+    def get_size(self, field):
+        """
+        Returns the size of the full output of the given field in bytes.
+        """
+        if getattr(self, field + '_ref'):
+            return getattr(self, field + '_size') or 0
+        return len((getattr(self, field) or '').encode(_settings.CHRONIKER_OUTPUT_ENCODING, _settings.CHRONIKER_OUTPUT_ERRORS))
+
+    def read(self, field, head_size=0, tail_size=0):
+        """
+        Returns the full output of the given field.
+        If head_size and tail_size are given, only the first and last that many characters are read into memory.
+        """
+        buf = utils.HeadTailBuffer(head_size=head_size, tail_size=tail_size)
+        with self.open(field) as fin:
+            reader = io.TextIOWrapper(fin, encoding=_settings.CHRONIKER_OUTPUT_ENCODING, errors=_settings.CHRONIKER_OUTPUT_ERRORS)
+            while 1:
+                chunk = reader.read(65536)
+                if not chunk:
+                    break
+                buf.write(chunk)
+        return buf.getvalue()
+
+    def delete_stored(self):
+        """
+        Removes any output kept outside the database by a storage backend.
+        """
+        for field in ('stdout', 'stderr'):
+            ref = getattr(self, field + '_ref')
+            if ref:
+                storage, key = parse_ref(ref)
+                storage.delete(self, field, key)
+
+
+@receiver(pre_delete, sender=Job)
+def delete_job_stored_output(sender, instance, using, **kwargs):
+    """
+    Removes the output its logs kept outside the database when a job, and so its logs, are deleted.
+    """
+    delete_stored_on_commit(LogOutput.objects.using(using).filter(log__job_id=instance.pk).get_stored(), using)
+
+
+def get_chain(graph, root_id):
+    """
+    Returns the ids of every job that depends on the given job, directly or not, in a graph from get_dependency_graph(),
+    stopping at cycles.
+    """
+    priors = set([root_id])
+    pending = deque(graph.get(root_id, ()))
+    chained = set()
+    while pending:
+        job_id = pending.popleft()
+        if job_id in priors:
+            continue
+        priors.add(job_id)
+        chained.add(job_id)
+        pending.extend(graph.get(job_id, ()))
+    return chained
+
+
+def estimate_run_length(window, samples=20):
+    """
+    Returns the mean of the given number of most recent durations, dropping the upper and lower extremes,
+    or None if there are none.
+    """
+    q = sorted(window[-samples:])
+    if len(q) >= 3:
+        # Drop the upper and lower extremes.
+        q = q[1:-1]
+    if not q:
+        return
+    return int(round(sum(q) / float(len(q))))
+
+
+# Run durations are counted in buckets whose bounds grow by this factor,
+# so percentiles are accurate to within about half of it, whatever the scale.
+DURATION_BUCKET_GROWTH = 1.1
+
+
+def get_local_date(dt):
+    """
+    Returns the date in the current timezone of the given datetime.
+    """
+    return timezone.localtime(dt).date() if timezone.is_aware(dt) else dt.date()
+
+
+def get_duration_bucket(seconds):
+    """
+    Returns the index of the histogram bucket counting the given duration.
+    """
+    return int(math.log(max(seconds, 0) + 1, DURATION_BUCKET_GROWTH))
+
+
+def get_bucket_duration(index):
+    """
+    Returns a representative duration for the histogram bucket with the given index, the middle of its bounds.
+    """
+    lower = DURATION_BUCKET_GROWTH**index - 1
+    upper = DURATION_BUCKET_GROWTH**(index + 1) - 1
+    return (lower + upper) / 2.
+
+
+def get_histogram_quantile(histogram, quantile):
+    """
+    Returns the approximate duration at the given quantile, between 0 and 1, of a histogram of {bucket: count},
+    or None if it's empty.
+    """
+    buckets = sorted((int(bucket), count) for bucket, count in histogram.items())
+    total = sum(count for _, count in buckets)
+    if not total:
+        return None
+    target = quantile * total
+    seen = 0
+    for bucket, count in buckets:
+        seen += count
+        if seen >= target:
+            return get_bucket_duration(bucket)
+    return get_bucket_duration(buckets[-1][0])
+
+
+RUN_LENGTH_FIELDS = ('run_length_count', 'run_length_ewma', 'run_length_window', 'run_length_histogram')
+
+
+def add_run_length(stats, duration_seconds):
+    """
+    Adds a run's duration to a dictionary of a job's run length statistics, in constant time.
+    """
+    duration_seconds = float(duration_seconds)
+    alpha = _settings.CHRONIKER_RUN_LENGTH_EWMA_ALPHA
+    ewma = stats['run_length_ewma']
+    stats['run_length_ewma'] = duration_seconds if ewma is None else alpha * duration_seconds + (1 - alpha) * ewma
+    stats['run_length_count'] += 1
+    stats['run_length_window'] = (stats['run_length_window'] + [duration_seconds])[-_settings.CHRONIKER_RUN_LENGTH_WINDOW:]
+    histogram = stats['run_length_histogram']
+    bucket = str(get_duration_bucket(duration_seconds))
+    histogram[bucket] = histogram.get(bucket, 0) + 1
+    if sum(histogram.values()) > _settings.CHRONIKER_RUN_LENGTH_HISTOGRAM_SIZE:
+        # Halve every count, so older runs fade out, and the histogram follows changes in the job.
+        stats['run_length_histogram'] = dict((bucket, count // 2) for bucket, count in histogram.items() if count // 2)
+
+
+class JobDailyStatsManager(models.Manager):
+
+    def record(self, log):
+        """
+        Adds a run recorded by the given log to its job's statistics for the day the run started.
+        """
+        date = get_local_date(log.run_start_datetime)
+        with transaction.atomic(using=self.db):
+            stats, _ = self.select_for_update().get_or_create(job_id=log.job_id, date=date)
+            stats.add(log.duration_seconds, success=log.success, on_time=log.on_time)
+            stats.save()
+        return stats
+
+    def backfill(self, logs):
+        """
+        Recalculates the statistics of every job and day with any of the given logs, from all of their logs.
+        Returns the number of days recalculated.
+        """
+        days = {}
+        for job_id, run_start_datetime in logs.exclude(duration_seconds=None).values_list('job_id', 'run_start_datetime').iterator():
+            date = get_local_date(run_start_datetime)
+            days.setdefault(job_id, set()).add(date)
+        total = 0
+        for job_id, dates in days.items():
+            totals = {}
+            q = Log.objects.filter(job_id=job_id, run_start_datetime__date__gte=min(dates), run_start_datetime__date__lte=max(dates))
+            for run_start_datetime, duration_seconds, success, on_time in q.exclude(duration_seconds=None)\
+                .values_list('run_start_datetime', 'duration_seconds', 'success', 'on_time').iterator():
+                date = get_local_date(run_start_datetime)
+                if date not in dates:
+                    continue
+                stats = totals.setdefault(date, JobDailyStats(job_id=job_id, date=date))
+                stats.add(duration_seconds, success=success, on_time=on_time)
+            with transaction.atomic(using=self.db):
+                self.filter(job_id=job_id, date__in=totals).delete()
+                self.bulk_create(totals.values())
+            total += len(totals)
+        return total
+
+
+class JobDailyStats(models.Model):
+    """
+    The number, outcomes and durations of a job's runs started on one day.
+
+    Maintained as each log is recorded, so estimates can be read from one row per day instead of every log.
+    """
+
+    job = models.ForeignKey(Job, related_name='daily_stats', on_delete=models.CASCADE)
+
+    date = models.DateField()
+
+    runs = models.PositiveIntegerField(default=0)
+
+    failures = models.PositiveIntegerField(default=0)
+
+    timeouts = models.PositiveIntegerField(default=0, help_text=_('The number of runs killed for exceeding their timeout.'))
+
+    total_duration = models.FloatField(default=0, help_text=_('The total seconds of all runs.'))
+
+    min_duration = models.FloatField(blank=True, null=True)
+
+    max_duration = models.FloatField(blank=True, null=True)
+
+    # A histogram of {bucket: count} of durations, from which percentiles across any number of days can be estimated.
+    duration_histogram = models.JSONField(default=dict, blank=True, editable=False)
+
+    objects = JobDailyStatsManager()
+
+    class Meta:
+        unique_together = (('job', 'date'),)
+        ordering = ('-date',)
+        verbose_name_plural = 'job daily stats'
+
+    def __str__(self):
+        return '%s on %s' % (self.job_id, self.date)
+
+    def add(self, duration_seconds, success=True, on_time=True):
+        """
+        Counts a run with the given outcome and duration.
+        """
+        duration_seconds = float(duration_seconds)
+        self.runs += 1
+        self.failures += not success
+        self.timeouts += not on_time
+        self.total_duration += duration_seconds
+        self.min_duration = duration_seconds if self.min_duration is None else min(self.min_duration, duration_seconds)
+        self.max_duration = duration_seconds if self.max_duration is None else max(self.max_duration, duration_seconds)
+        bucket = str(get_duration_bucket(duration_seconds))
+        self.duration_histogram[bucket] = self.duration_histogram.get(bucket, 0) + 1
+
+    @property
+    def mean_duration(self):
+        if not self.runs:
+            return None
+        return self.total_duration / self.runs
+
+    @property
+    def p50_duration(self):
+        return get_histogram_quantile(self.duration_histogram, 0.5)
+
+    @property
+    def p95_duration(self):
+        return get_histogram_quantile(self.duration_histogram, 0.95)
+
+    @classmethod
+    def summarize(cls, q):
+        """
+        Combines the given days of statistics into a dictionary of totals and percentiles.
+        """
+        summary = dict(runs=0, failures=0, timeouts=0, total_duration=0, min_duration=None, max_duration=None)
+        histogram = {}
+        for stats in q:
+            for name in ('runs', 'failures', 'timeouts', 'total_duration'):
+                summary[name] += getattr(stats, name)
+            if stats.min_duration is not None:
+                summary['min_duration'] = min(summary['min_duration'] if summary['min_duration'] is not None else stats.min_duration, stats.min_duration)
+            if stats.max_duration is not None:
+                summary['max_duration'] = max(summary['max_duration'] or 0, stats.max_duration)
+            for bucket, count in stats.duration_histogram.items():
+                histogram[bucket] = histogram.get(bucket, 0) + count
+        summary['mean_duration'] = summary['total_duration'] / summary['runs'] if summary['runs'] else None
+        summary['p50_duration'] = get_histogram_quantile(histogram, 0.5)
+        summary['p95_duration'] = get_histogram_quantile(histogram, 0.95)
+        return summary
 
 
 class MonitorManager(models.Manager):
@@ -0,0 +1,288 @@
+"""
+Channels that tell running supervisors about jobs flagged to run or stop, so they act on them immediately.
+
+Flags are always set in the database first, and supervisors still poll for them,
+so a notification only wakes a supervisor early. One that's lost only delays the job until the next poll,
+and one that's forged only causes an extra poll, since supervisors act on the flags, not the notification.
+
+With `CHRONIKER_NOTIFIER` set, `cron` and `chroniker_daemon` listen on one of these channels
+while they supervise jobs, and the admin's run and stop buttons send to it.
+"""
+import logging
+import os
+import socket
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from chroniker import settings as _settings
+
+logger = logging.getLogger('chroniker.notify')
+
+RUN = 'run'
+STOP = 'stop'
+
+
+def encode(action, job_id):
+    return '%s:%i' % (action, int(job_id))
+
+
+def decode(message):
+    """
+    Returns the (action, job id) of the notification, or None if it isn't one.
+    """
+    action, _, job_id = message.partition(':')
+    if action not in (RUN, STOP):
+        return None
+    try:
+        return action, int(job_id)
+    except ValueError:
+        return None
+
+
+class JobNotifier:
+    """
+    The base class for notification channels.
+
+    Supervisors call listen(), then wait until the notifier is readable,
+    e.g. with `multiprocessing.connection.wait()`, and call receive().
+    """
+
+    name = None
+
+    def send(self, action, job_id):
+        """
+        Tells listening supervisors the job was flagged for the given action.
+        """
+        raise NotImplementedError
+
+    def send_many(self, action, job_ids):
+        """
+        Tells listening supervisors each of the jobs was flagged for the given action.
+        """
+        for job_id in job_ids:
+            self.send(action, job_id)
+
+    def listen(self):
+        """
+        Starts receiving notifications.
+        """
+        raise NotImplementedError
+
+    def fileno(self):
+        """
+        Returns a file descriptor that's readable when notifications are waiting.
+        """
+        raise NotImplementedError
+
+    def receive(self):
+        """
+        Returns a list of the (action, job id) notifications received, without blocking.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Stops receiving notifications.
+        """
+
+
+class SocketNotifier(JobNotifier):
+    """
+    Sends each notification as a datagram to the Unix socket of every supervisor on this host,
+    each bound to its own file in `CHRONIKER_NOTIFY_SOCKET_DIR`.
+
+    The admin usually runs as a different user than the supervisors, so the directory must be shared by a group
+    both belong to. It's created group-writable, with the setgid bit so the sockets in it inherit its group.
+    """
+
+    name = 'socket'
+
+    def __init__(self, directory=None):
+        self.directory = directory or _settings.CHRONIKER_NOTIFY_SOCKET_DIR
+        if not self.directory:
+            raise ImproperlyConfigured('CHRONIKER_NOTIFY_SOCKET_DIR must be set to use the socket notifier.')
+        self.sock = None
+        self.path = None
+
+    def send(self, action, job_id):
+        self.send_many(action, [job_id])
+
+    def send_many(self, action, job_ids):
+        try:
+            paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.sock')]
+        except OSError as e:
+            logger.warning('Unable to list supervisors in %s: %s', self.directory, e)
+            return
+        if not paths:
+            logger.warning('No supervisors are listening in %s.', self.directory)
+            return
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.setblocking(False)
+            for path in paths:
+                try:
+                    for job_id in job_ids:
+                        sock.sendto(encode(action, job_id).encode('utf-8'), path)
+                except (ConnectionRefusedError, FileNotFoundError):
+                    # Left behind by a supervisor that didn't exit cleanly.
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+                except OSError as e:
+                    # e.g. permission denied, or the supervisor's buffer is full,
+                    # in which case it'll find the flag when it next polls.
+                    logger.warning('Unable to notify %s: %s', path, e)
+
+    def listen(self):
+        try:
+            os.makedirs(self.directory)
+            os.chmod(self.directory, 0o2770)
+        except FileExistsError:
+            pass
+        self.path = os.path.join(self.directory, '%i.sock' % os.getpid())
+        if os.path.exists(self.path):
+            # Left behind by an earlier process with the same id.
+            os.remove(self.path)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        self.sock.bind(self.path)
+        # Sending to a socket requires write permission on it.
+        os.chmod(self.path, 0o660)
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def receive(self):
+        notifications = []
+        while 1:
+            try:
+                data = self.sock.recv(256)
+            except BlockingIOError:
+                break
+            notification = decode(data.decode('utf-8', 'replace'))
+            if notification:
+                notifications.append(notification)
+        return notifications
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        if self.path is not None:
+            try:
+                os.remove(self.path)
+            except OSError:
+                pass
+            self.path = None
+
+
+class PostgresNotifier(JobNotifier):
+    """
+    Sends each notification with PostgreSQL's NOTIFY, received by supervisors on every host with LISTEN.
+
+    Notifications sent inside a transaction are only delivered once it commits.
+    """
+
+    name = 'postgres'
+
+    channel = 'chroniker_jobs'
+
+    def __init__(self, using=DEFAULT_DB_ALIAS):
+        self.using = using
+        if connections[using].vendor != 'postgresql':
+            raise ImproperlyConfigured('The postgres notifier requires a PostgreSQL database.')
+        self.conn = None
+
+    def send(self, action, job_id):
+        self.send_many(action, [job_id])
+
+    def send_many(self, action, job_ids):
+        with connections[self.using].cursor() as cursor:
+            for job_id in job_ids:
+                cursor.execute('SELECT pg_notify(%s, %s)', [self.channel, encode(action, job_id)])
+
+    def listen(self):
+        # A connection of its own, in autocommit mode, that nothing else uses or closes.
+        self.conn = connections.create_connection(self.using)
+        self.conn.ensure_connection()
+        with self.conn.cursor() as cursor:
+            cursor.execute('LISTEN %s' % self.channel)
+
+    def fileno(self):
+        return self.conn.connection.fileno()
+
+    def receive(self):
+        raw = self.conn.connection
+        if hasattr(raw, 'poll'):
+            # psycopg2
+            raw.poll()
+            payloads = [notify.payload for notify in raw.notifies]
+            del raw.notifies[:]
+        else:
+            # psycopg 3
+            raw.pgconn.consume_input()
+            payloads = []
+            while 1:
+                notify = raw.pgconn.notifies()
+                if notify is None:
+                    break
+                payloads.append(notify.extra.decode('utf-8'))
+        return [_ for _ in map(decode, payloads) if _]
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+
+NOTIFIERS = {
+    SocketNotifier.name: SocketNotifier,
+    PostgresNotifier.name: PostgresNotifier,
+}
+
+
+def get_notifier(name=None):
+    """
+    Returns the notifier with the given name, or the configured one,
+    or None if supervisors only poll.
+    """
+    name = name or _settings.CHRONIKER_NOTIFIER
+    if not name:
+        return None
+    if name not in NOTIFIERS:
+        raise ImproperlyConfigured('Unknown notifier %r. Choose one of: %s' % (name, ', '.join(sorted(NOTIFIERS))))
+    return NOTIFIERS[name]()
+
+
+def notify(action, *job_ids):
+    """
+    Tells running supervisors the jobs were flagged for the given action, if a notifier is configured.
+    Failures are only logged, since supervisors still find the flags when they next poll.
+    """
+    if not job_ids:
+        return
+    notifier = get_notifier()
+    if notifier is None:
+        return
+    try:
+        notifier.send_many(action, job_ids)
+    except Exception as e:
+        logger.warning('Unable to notify supervisors to %s jobs %s: %s', action, ', '.join(map(str, job_ids)), e)
+
+
+def listen():
+    """
+    Returns the configured notifier, listening for notifications,
+    or None if none is configured or it can't listen, in which case supervisors only poll.
+    """
+    notifier = get_notifier()
+    if notifier is None:
+        return None
+    try:
+        notifier.listen()
+    except Exception as e:
+        logger.warning('Unable to listen for job notifications, so only polling: %s', e)
+        notifier.close()
+        return None
+    return notifier
@@ -0,0 +1,292 @@
+"""
+A pool of long-lived worker processes that run jobs one at a time, so short
+jobs don't pay for forking a new process, importing their command and opening a
+new database connection on every run.
+"""
+import logging
+import os
+import signal
+import sys
+import time
+import traceback
+from multiprocessing import Pipe, Process
+
+import psutil
+
+from django.core.management import get_commands, load_command_class
+from django.db import connection
+
+from chroniker import settings as _settings
+from chroniker.models import Job, clear_current_job
+
+logger = logging.getLogger('chroniker.pool')
+
+
+class PoolBusy(Exception):
+    """
+    Raised when a job is submitted to a pool whose workers are all busy.
+    """
+
+
+def preload_commands(names):
+    """
+    Imports the given management commands, so workers forked afterwards don't have to.
+    """
+    commands = get_commands()
+    for name in set(names):
+        if name not in commands:
+            continue
+        try:
+            load_command_class(commands[name], name)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Unable to preload command %s.', name)
+
+
+def run_worker(conn, update_heartbeat=True, stdout_queue=None, stderr_queue=None):
+    """
+    The main loop of a worker process.
+
+    Receives (job_id, force_run) tuples, runs each job and replies with its resident memory in bytes,
+    until it receives None or the pool goes away.
+
+    Interrupts are only handled while a job runs, since they're how a job is forced to stop,
+    and one arriving late, after its job has finished, mustn't kill the idle worker.
+    """
+    while 1:
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            return
+        if msg is None:
+            return
+        job_id, force_run = msg
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        try:
+            # Reuse the connection from the last job, unless it's gone bad.
+            connection.close_if_unusable_or_obsolete()
+            job = Job.objects.get(id=job_id)
+            job.run(
+                update_heartbeat=update_heartbeat,
+                check_running=False,
+                stdout_queue=stdout_queue,
+                stderr_queue=stderr_queue,
+                force_run=force_run,
+                close_connection=False,
+            )
+        except (Exception, KeyboardInterrupt): # pylint: disable=broad-except
+            # A force stop interrupts the job's main thread, which is also ours.
+            traceback.print_exc()
+        finally:
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            clear_current_job()
+            sys.stdout.flush()
+            sys.stderr.flush()
+        conn.send(psutil.Process().memory_info().rss)
+
+
+class PoolWorker:
+    """
+    A handle on a single worker process, and the job it's currently running, if any.
+    """
+
+    def __init__(self, update_heartbeat=True, stdout_queue=None, stderr_queue=None):
+        self.conn, child_conn = Pipe()
+        self.process = Process(
+            target=run_worker,
+            args=(child_conn, update_heartbeat, stdout_queue, stderr_queue),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.t0 = None
+        self.jobs_run = 0
+        self.rss = 0
+
+    def __str__(self):
+        return 'worker %s' % self.pid
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    @property
+    def is_busy(self):
+        return self.job is not None
+
+    @property
+    def is_expired(self):
+        if not self.job or not self.job.timeout_seconds:
+            return False
+        return time.time() - self.t0 >= self.job.timeout_seconds
+
+    def get_seconds_remaining(self):
+        """
+        Returns the number of seconds until the current job times out, or None if it can't.
+        """
+        if not self.job or not self.job.timeout_seconds:
+            return None
+        return max(self.job.timeout_seconds - (time.time() - self.t0), 0)
+
+    def submit(self, job, force_run=False):
+        self.job = job
+        self.t0 = time.time()
+        self.conn.send((job.id, force_run))
+
+    def poll(self):
+        """
+        Returns true if the current job has finished, in which case the worker is idle again.
+        """
+        if not self.job or not self.conn.poll():
+            return False
+        try:
+            self.rss = self.conn.recv()
+        except (EOFError, OSError):
+            return False
+        self.job = None
+        self.t0 = None
+        self.jobs_run += 1
+        return True
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def close(self):
+        """
+        Asks an idle worker to exit once it's done.
+        """
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.terminate()
+        self.conn.close()
+
+    def terminate(self):
+        """
+        Kills the worker and any processes its job started.
+        """
+        try:
+            for child in psutil.Process(self.pid).children(recursive=True):
+                child.kill()
+        except psutil.NoSuchProcess:
+            pass
+        if self.process.is_alive():
+            os.kill(self.pid, signal.SIGKILL)
+        self.process.join()
+
+
+class WorkerPool:
+    """
+    Runs jobs on a bounded number of long-lived worker processes.
+
+    Workers are started as they're needed and replaced after running max_jobs jobs,
+    after their memory use reaches max_memory_mb, or after being killed for exceeding a job's timeout.
+    """
+
+    def __init__(self, size, update_heartbeat=True, max_jobs=None, max_memory_mb=None, stdout_queue=None, stderr_queue=None):
+        self.size = size
+        self.update_heartbeat = update_heartbeat
+        self.max_jobs = max_jobs or _settings.CHRONIKER_POOL_MAX_JOBS
+        self.max_memory_mb = max_memory_mb or _settings.CHRONIKER_POOL_MAX_MEMORY_MB
+        self.stdout_queue = stdout_queue
+        self.stderr_queue = stderr_queue
+        self.workers = []
+
+    @property
+    def running(self):
+        """
+        Returns a dictionary of {job_id: worker} for all jobs currently running.
+        """
+        return dict((worker.job.id, worker) for worker in self.workers if worker.is_busy)
+
+    def has_idle(self):
+        return len(self.running) < self.size
+
+    def submit(self, job, force_run=False):
+        """
+        Runs the job on an idle worker, starting one if needed.
+        Returns the worker.
+
+        Callers should check has_idle() first, since PoolBusy is raised if there's no idle worker.
+        """
+        for worker in list(self.workers):
+            if not worker.is_busy and not worker.is_alive():
+                self.remove(worker)
+        for worker in self.workers:
+            if not worker.is_busy:
+                break
+        else:
+            if len(self.workers) >= self.size:
+                raise PoolBusy('All %i workers are busy.' % self.size)
+            # Each worker must open its own database connection.
+            connection.close()
+            worker = PoolWorker(update_heartbeat=self.update_heartbeat, stdout_queue=self.stdout_queue, stderr_queue=self.stderr_queue)
+            self.workers.append(worker)
+        worker.submit(job, force_run=force_run)
+        return worker
+
+    def should_recycle(self, worker):
+        return worker.jobs_run >= self.max_jobs or worker.rss >= self.max_memory_mb * 1024 * 1024
+
+    def reap(self):
+        """
+        Collects the jobs that have finished and recycles worn out or dead workers.
+        Returns a list of (job, worker) tuples for the finished jobs.
+        """
+        ended = []
+        for worker in list(self.workers):
+            job = worker.job
+            if worker.poll():
+                ended.append((job, worker))
+                if not worker.is_alive():
+                    # Died after replying, so it can't run another job.
+                    self.remove(worker)
+                elif self.should_recycle(worker):
+                    logger.info('Recycling %s after %i jobs using %i bytes.', worker, worker.jobs_run, worker.rss)
+                    self.remove(worker)
+            elif not worker.is_alive():
+                self.remove(worker)
+                if job:
+                    ended.append((job, worker))
+        return ended
+
+    def expired(self):
+        """
+        Returns the workers whose job has exceeded its timeout.
+        """
+        return [worker for worker in self.workers if worker.is_expired]
+
+    def remove(self, worker):
+        """
+        Shuts down and forgets a worker, which is replaced the next time one is needed.
+        """
+        if worker.is_busy or not worker.is_alive():
+            worker.terminate()
+        else:
+            worker.close()
+        self.workers.remove(worker)
+
+    def get_sentinels(self):
+        """
+        Returns the objects to wait on for any worker to finish its job or die.
+        """
+        sentinels = []
+        for worker in self.workers:
+            if worker.is_busy:
+                sentinels.extend([worker.conn, worker.process.sentinel])
+        return sentinels
+
+    def get_seconds_remaining(self):
+        """
+        Returns the number of seconds until the next job times out, or None if none can.
+        """
+        seconds = [_ for _ in (worker.get_seconds_remaining() for worker in self.workers) if _ is not None]
+        return min(seconds) if seconds else None
+
+    def close(self):
+        for worker in list(self.workers):
+            self.remove(worker)
@@ -0,0 +1,177 @@
+"""
+Deletes old logs, in a few set-based statements rather than one row at a time.
+
+Each job keeps only its `maximum_log_entries` most recent logs. These are pruned for all jobs at once
+by `manage.py cron_clean --max_entries`, and after a run of a job once it's `CHRONIKER_LOG_PRUNE_MARGIN` over its maximum.
+
+Large sets of logs are deleted in chunks of consecutive ids, each in its own short transaction,
+so no single statement holds locks on, or writes the journal for, millions of rows.
+"""
+import time
+
+from django.db import transaction
+from django.db.models import BigIntegerField, F, Max, Min, Q, Sum, Value
+from django.db.models.functions import Coalesce, Length
+from django.template.defaultfilters import filesizeformat
+
+from chroniker import settings as _settings
+from chroniker.models import Job, Log, LogOutput
+
+
+class RetentionReport:
+    """
+    The number of logs deleted and the approximate number of bytes of output they held.
+
+    If complete is false, deleting stopped early because it ran out of time.
+    """
+
+    def __init__(self, rows=0, bytes=0, complete=True): # pylint: disable=redefined-builtin
+        self.rows = rows
+        self.bytes = bytes
+        self.complete = complete
+
+    def __add__(self, other):
+        return RetentionReport(rows=self.rows + other.rows, bytes=self.bytes + other.bytes, complete=self.complete and other.complete)
+
+    def __str__(self):
+        s = 'Deleted %i logs, reclaiming %s of output.' % (self.rows, filesizeformat(self.bytes))
+        if not self.complete:
+            s += ' Stopped early after running out of time.'
+        return s
+
+
+def measure_output(q):
+    """
+    Returns the approximate number of bytes of output held by the given logs, wherever it's stored.
+    Output kept in text columns is counted in characters.
+    """
+    stdout_size = Coalesce(F('stdout_size'), Length('stdout'), Value(0), output_field=BigIntegerField())
+    stderr_size = Coalesce(F('stderr_size'), Length('stderr'), Value(0), output_field=BigIntegerField())
+    return LogOutput.objects.filter(log__in=q).aggregate(total=Sum(stdout_size + stderr_size))['total'] or 0
+
+
+def estimate_logs(q, samples=10, window=None):
+    """
+    Estimates how many of the given logs there are and how many bytes of output they hold, without counting them all,
+    by counting those in a few evenly spaced windows of ids.
+    Returns a RetentionReport.
+    """
+    window = window or _settings.CHRONIKER_CLEAN_BATCH_SIZE
+    bounds = q.aggregate(min_id=Min('id'), max_id=Max('id'))
+    if bounds['min_id'] is None:
+        return RetentionReport()
+    id_span = bounds['max_id'] - bounds['min_id'] + 1
+    if id_span <= window * samples:
+        # Small enough to count exactly.
+        return RetentionReport(rows=q.count(), bytes=measure_output(q))
+    step = id_span // samples
+    rows = 0
+    size = 0
+    for i in range(samples):
+        lo = bounds['min_id'] + i * step
+        sample_q = q.filter(id__gte=lo, id__lt=lo + window)
+        rows += sample_q.count()
+        size += measure_output(sample_q)
+    scale = id_span / float(window * samples)
+    return RetentionReport(rows=int(round(rows * scale)), bytes=int(round(size * scale)))
+
+
+def delete_chunk(q):
+    """
+    Deletes the given logs, along with their output and any output stored outside the database.
+    Returns a RetentionReport.
+    """
+    with transaction.atomic():
+        report = RetentionReport(bytes=measure_output(q))
+        # Deleted by themselves first, so deleting the logs doesn't have to look them up.
+        # Either removes any stored output once the transaction commits.
+        LogOutput.objects.filter(log__in=q).delete()
+        _, counts = q.delete()
+        report.rows = counts.get(Log._meta.label, 0)
+    return report
+
+
+def delete_logs(q, batch_size=None, sleep_seconds=None, deadline=None, progress=None):
+    """
+    Deletes the given logs in chunks of at most batch_size consecutive ids, sleeping sleep_seconds between chunks.
+
+    Stops early, marking the report incomplete, once the time.time() deadline passes.
+    If given, progress is called with the running RetentionReport after each chunk.
+    Returns a RetentionReport.
+    """
+    batch_size = batch_size or _settings.CHRONIKER_CLEAN_BATCH_SIZE
+    sleep_seconds = _settings.CHRONIKER_CLEAN_SLEEP_SECONDS if sleep_seconds is None else sleep_seconds
+    report = RetentionReport()
+    q = q.order_by('id')
+    while 1:
+        # The last id of the next chunk, found with the primary key index.
+        last_ids = list(q.values_list('id', flat=True)[batch_size - 1:batch_size])
+        chunk_q = q.filter(id__lte=last_ids[0]) if last_ids else q
+        report += delete_chunk(chunk_q.order_by())
+        if progress:
+            progress(report)
+        if not last_ids:
+            break
+        q = q.filter(id__gt=last_ids[0])
+        if deadline is not None and time.time() >= deadline:
+            report.complete = False
+            break
+        if sleep_seconds:
+            time.sleep(sleep_seconds)
+    return report
+
+
+def get_expired_logs(job_id, maximum_log_entries):
+    """
+    Returns the logs of the given job beyond its maximum_log_entries most recent,
+    or None if there are none.
+    """
+    if not maximum_log_entries:
+        return None
+    q = Log.objects.filter(job_id=job_id)
+    newest_expired = q.order_by('-run_start_datetime', '-id').values_list('run_start_datetime', 'id')[maximum_log_entries:maximum_log_entries + 1]
+    if not newest_expired:
+        return None
+    run_start_datetime, log_id = newest_expired[0]
+    return q.filter(Q(run_start_datetime__lt=run_start_datetime) | Q(run_start_datetime=run_start_datetime, id__lte=log_id))
+
+
+def prune_job_logs(job_id, maximum_log_entries, margin=0, **kwargs):
+    """
+    Deletes all but the given number of most recent logs of the given job,
+    but only if it has more than margin logs beyond them.
+    Accepts the same options as delete_logs().
+    Returns a RetentionReport.
+    """
+    if margin and get_expired_logs(job_id, maximum_log_entries + margin) is None:
+        return RetentionReport()
+    q = get_expired_logs(job_id, maximum_log_entries)
+    if q is None:
+        return RetentionReport()
+    return delete_logs(q, **kwargs)
+
+
+def prune_logs(verbose=False, dryrun=False, deadline=None, **kwargs):
+    """
+    Deletes all but the most recent logs of every job that limits them.
+    If dryrun is true, only estimates what would be deleted.
+    Accepts the same options as delete_logs().
+    Returns a RetentionReport.
+    """
+    report = RetentionReport()
+    for job_id, maximum_log_entries in Job.objects.filter(maximum_log_entries__gt=0).values_list('id', 'maximum_log_entries'):
+        if deadline is not None and time.time() >= deadline:
+            report.complete = False
+            break
+        if dryrun:
+            q = get_expired_logs(job_id, maximum_log_entries)
+            job_report = RetentionReport() if q is None else estimate_logs(q)
+        else:
+            job_report = prune_job_logs(job_id, maximum_log_entries, deadline=deadline, **kwargs)
+        if verbose and job_report.rows:
+            if dryrun:
+                print('Job %i: about %i expired logs.' % (job_id, job_report.rows))
+            else:
+                print('Job %i: %s' % (job_id, job_report))
+        report += job_report
+    return report
@@ -48,8 +48,8 @@ CHRONIKER_SELECT_FOR_UPDATE = settings.CHRONIKER_SELECT_FOR_UPDATE = getattr(set
 
 # Set this to false for use on multiple hosts, since
 # the lock file will only be accessible on a single host.
-# The database will be used effectively as the lock.
-# Recommend setting CHRONIKER_SELECT_FOR_UPDATE = True.
+# The database will be used effectively as the lock, since each scheduler
+# atomically claims a job before running it.
 # Only set this to true if only a single host will ever read and write
 # to the Job table.
 CHRONIKER_CHECK_LOCK_FILE = settings.CHRONIKER_CHECK_LOCK_FILE = getattr(settings, 'CHRONIKER_CHECK_LOCK_FILE', False)
@@ -66,3 +66,98 @@ CHRONIKER_AUTO_END_STALE_JOBS = settings.CHRONIKER_AUTO_END_STALE_JOBS = getattr
 CHRONIKER_JOB_NK = settings.CHRONIKER_JOB_NK = getattr(settings, 'CHRONIKER_JOB_NK', ('name',))
 
 CHRONIKER_JOB_ERROR_CALLBACK = settings.CHRONIKER_JOB_ERROR_CALLBACK = getattr(settings, 'CHRONIKER_JOB_ERROR_CALLBACK', None)
+
+# The maximum number of compiled job rrules, and parsed rrule parameter strings, to cache.
+CHRONIKER_RRULE_CACHE_SIZE = settings.CHRONIKER_RRULE_CACHE_SIZE = getattr(settings, 'CHRONIKER_RRULE_CACHE_SIZE', 10000)
+
+# The maximum number of seconds the chroniker_daemon command will sleep
+# before checking for jobs that have been changed, added or flagged to force run.
+CHRONIKER_DAEMON_POLL_SECONDS = settings.CHRONIKER_DAEMON_POLL_SECONDS = getattr(settings, 'CHRONIKER_DAEMON_POLL_SECONDS', 5)
+
+# The number of seconds between full reloads of the job schedule held in memory
+# by the chroniker_daemon command. Changes are normally detected between reloads
+# from each job's last_modified timestamp, so this is only a safety net.
+CHRONIKER_DAEMON_REFRESH_SECONDS = settings.CHRONIKER_DAEMON_REFRESH_SECONDS = getattr(settings, 'CHRONIKER_DAEMON_REFRESH_SECONDS', 3600)
+
+# When checking for changed jobs, the chroniker_daemon command also reloads jobs modified this
+# many seconds before the last change it saw, to allow for out of order commits and clock skew between hosts.
+CHRONIKER_DAEMON_CHANGE_OVERLAP_SECONDS = settings.CHRONIKER_DAEMON_CHANGE_OVERLAP_SECONDS = getattr(settings, 'CHRONIKER_DAEMON_CHANGE_OVERLAP_SECONDS', 10)
+
+# The number of long-lived worker processes chroniker_daemon runs jobs on.
+# If 0, each job is run in a new process instead.
+CHRONIKER_POOL_SIZE = settings.CHRONIKER_POOL_SIZE = getattr(settings, 'CHRONIKER_POOL_SIZE', 0)
+
+# The number of jobs a pool worker runs before it's replaced with a fresh process.
+CHRONIKER_POOL_MAX_JOBS = settings.CHRONIKER_POOL_MAX_JOBS = getattr(settings, 'CHRONIKER_POOL_MAX_JOBS', 100)
+
+# The resident memory, in megabytes, after which a pool worker is replaced with a fresh process.
+CHRONIKER_POOL_MAX_MEMORY_MB = settings.CHRONIKER_POOL_MAX_MEMORY_MB = getattr(settings, 'CHRONIKER_POOL_MAX_MEMORY_MB', 512)
+
+# The maximum number of jobs that may run at once on each host.
+# Jobs that are due while this many jobs are running wait until one finishes.
+# If 0, there's no limit.
+CHRONIKER_MAX_CONCURRENCY = settings.CHRONIKER_MAX_CONCURRENCY = getattr(settings, 'CHRONIKER_MAX_CONCURRENCY', 0)
+
+# The maximum number of jobs in each concurrency group that may run at once on each host.
+# e.g. {'etl': 4, 'reports': 2}
+# Groups not listed here have no limit of their own.
+CHRONIKER_CONCURRENCY_GROUPS = settings.CHRONIKER_CONCURRENCY_GROUPS = getattr(settings, 'CHRONIKER_CONCURRENCY_GROUPS', {})
+
+# The encoding, and the error handler for characters it can't represent, applied to the output captured from jobs.
+CHRONIKER_OUTPUT_ENCODING = settings.CHRONIKER_OUTPUT_ENCODING = getattr(settings, 'CHRONIKER_OUTPUT_ENCODING', 'utf-8')
+CHRONIKER_OUTPUT_ERRORS = settings.CHRONIKER_OUTPUT_ERRORS = getattr(settings, 'CHRONIKER_OUTPUT_ERRORS', 'replace')
+
+# Output captured from jobs is flushed, and passed to the supervising process, in chunks of
+# this many characters or whatever was written in this many seconds, whichever comes first.
+CHRONIKER_OUTPUT_CHUNK_SIZE = settings.CHRONIKER_OUTPUT_CHUNK_SIZE = getattr(settings, 'CHRONIKER_OUTPUT_CHUNK_SIZE', 65536)
+CHRONIKER_OUTPUT_CHUNK_SECONDS = settings.CHRONIKER_OUTPUT_CHUNK_SECONDS = getattr(settings, 'CHRONIKER_OUTPUT_CHUNK_SECONDS', 1)
+
+# If both are set, only the first and last this many characters of each job's stdout and stderr are kept in memory and recorded in its log,
+# so jobs that write a lot of output don't use a lot of memory. By default, 0, everything is kept.
+CHRONIKER_LOG_HEAD_SIZE = settings.CHRONIKER_LOG_HEAD_SIZE = getattr(settings, 'CHRONIKER_LOG_HEAD_SIZE', 0)
+CHRONIKER_LOG_TAIL_SIZE = settings.CHRONIKER_LOG_TAIL_SIZE = getattr(settings, 'CHRONIKER_LOG_TAIL_SIZE', 0)
+
+# Where the output of each job run is stored.
+# '' stores it in the stdout and stderr columns of the log's LogOutput.
+# 'db' spools it to a temporary file while the job runs, then stores it compressed in its binary columns.
+# 'file' does the same, but stores it as compressed files under CHRONIKER_LOG_DIR.
+# With either, those stdout and stderr columns only keep the first CHRONIKER_LOG_PREVIEW_SIZE characters.
+CHRONIKER_LOG_STORAGE = settings.CHRONIKER_LOG_STORAGE = getattr(settings, 'CHRONIKER_LOG_STORAGE', '')
+CHRONIKER_LOG_DIR = settings.CHRONIKER_LOG_DIR = getattr(settings, 'CHRONIKER_LOG_DIR', None)
+CHRONIKER_LOG_PREVIEW_SIZE = settings.CHRONIKER_LOG_PREVIEW_SIZE = getattr(settings, 'CHRONIKER_LOG_PREVIEW_SIZE', 1000)
+
+# Old logs are deleted in chunks of this many, sleeping this many seconds between chunks,
+# so deleting millions of logs doesn't hold long locks or swamp the database.
+CHRONIKER_CLEAN_BATCH_SIZE = settings.CHRONIKER_CLEAN_BATCH_SIZE = getattr(settings, 'CHRONIKER_CLEAN_BATCH_SIZE', 1000)
+CHRONIKER_CLEAN_SLEEP_SECONDS = settings.CHRONIKER_CLEAN_SLEEP_SECONDS = getattr(settings, 'CHRONIKER_CLEAN_SLEEP_SECONDS', 0)
+
+# After a run, a job's expired logs are only deleted once it has more than this fraction (at least one) over its maximum_log_entries,
+# so most runs don't delete anything. Set to None to leave pruning to `cron_clean --max_entries`.
+CHRONIKER_LOG_PRUNE_MARGIN = settings.CHRONIKER_LOG_PRUNE_MARGIN = getattr(settings, 'CHRONIKER_LOG_PRUNE_MARGIN', 0.1)
+
+# The duration graph is drawn from at most this many points per request,
+# with longer histories summarized as the min, mean and max duration of each span of time.
+CHRONIKER_DURATION_GRAPH_MAX_POINTS = settings.CHRONIKER_DURATION_GRAPH_MAX_POINTS = getattr(settings, 'CHRONIKER_DURATION_GRAPH_MAX_POINTS', 2000)
+
+# Each job keeps the durations of this many of its most recent runs, from which its run length is estimated,
+# an exponentially weighted moving average of all its durations, weighting each new run by this much,
+# and a histogram of about this many recent durations, halving its counts whenever it grows beyond that.
+CHRONIKER_RUN_LENGTH_WINDOW = settings.CHRONIKER_RUN_LENGTH_WINDOW = getattr(settings, 'CHRONIKER_RUN_LENGTH_WINDOW', 20)
+CHRONIKER_RUN_LENGTH_EWMA_ALPHA = settings.CHRONIKER_RUN_LENGTH_EWMA_ALPHA = getattr(settings, 'CHRONIKER_RUN_LENGTH_EWMA_ALPHA', 0.2)
+CHRONIKER_RUN_LENGTH_HISTOGRAM_SIZE = settings.CHRONIKER_RUN_LENGTH_HISTOGRAM_SIZE = getattr(settings, 'CHRONIKER_RUN_LENGTH_HISTOGRAM_SIZE', 1000)
+
+# The number of seconds between heartbeats, recorded for each running job to show it's still alive
+# and to check whether it's been asked to stop.
+CHRONIKER_HEARTBEAT_SECONDS = settings.CHRONIKER_HEARTBEAT_SECONDS = getattr(settings, 'CHRONIKER_HEARTBEAT_SECONDS', 5)
+
+# The minimum number of seconds between writes of a running job's progress.
+# Progress reported more often is kept in memory, and only the latest value is written.
+CHRONIKER_PROGRESS_SECONDS = settings.CHRONIKER_PROGRESS_SECONDS = getattr(settings, 'CHRONIKER_PROGRESS_SECONDS', 1)
+
+# How running supervisors are told about jobs flagged to run or stop in the admin, so they act without waiting to poll.
+# '' only polls.
+# 'socket' sends a datagram to a Unix socket of each supervisor on the same host, in CHRONIKER_NOTIFY_SOCKET_DIR,
+# which must be set to a directory shared by the users running the admin and the supervisors.
+# 'postgres' uses PostgreSQL's LISTEN/NOTIFY, reaching supervisors on every host.
+CHRONIKER_NOTIFIER = settings.CHRONIKER_NOTIFIER = getattr(settings, 'CHRONIKER_NOTIFIER', '')
+CHRONIKER_NOTIFY_SOCKET_DIR = settings.CHRONIKER_NOTIFY_SOCKET_DIR = getattr(settings, 'CHRONIKER_NOTIFY_SOCKET_DIR', None)
@@ -0,0 +1,146 @@
+"""
+Storage backends for job output.
+
+By default a log's output is stored in its `stdout` and `stderr` text columns.
+With `CHRONIKER_LOG_STORAGE` set, a job's output is spooled to a temporary file while it runs,
+then compressed and stored by one of these backends. The log's output keeps a short preview
+in its text columns, along with its size and a reference to where the rest was stored.
+"""
+import gzip
+import os
+import shutil
+import uuid
+from io import BytesIO
+
+from django.core.exceptions import ImproperlyConfigured
+
+from chroniker import settings as _settings
+
+
+def compress(fileobj, dst):
+    """
+    Writes the gzip-compressed contents of the binary file fileobj to the binary file dst.
+    """
+    with gzip.GzipFile(fileobj=dst, mode='wb') as gz:
+        shutil.copyfileobj(fileobj, gz)
+
+
+class LogStorage:
+    """
+    The base class for log output storage backends.
+
+    Each backend is registered under a short name, which prefixes the references it returns,
+    so stored output can still be read after the setting is changed.
+    """
+
+    name = None
+
+    def save(self, output, field, fileobj):
+        """
+        Stores the uncompressed contents of the binary file fileobj as the given field of the LogOutput.
+        Returns a reference to the stored content.
+        """
+        raise NotImplementedError
+
+    def open(self, output, field, key):
+        """
+        Returns a binary file object with the uncompressed content stored under the given key.
+        """
+        raise NotImplementedError
+
+    def open_compressed(self, output, field, key):
+        """
+        Returns a binary file object with the gzip-compressed content stored under the given key.
+        """
+        raise NotImplementedError
+
+    def delete(self, output, field, key):
+        """
+        Removes the content stored under the given key, if it's stored outside the database.
+        """
+
+
+class DatabaseLogStorage(LogStorage):
+    """
+    Stores compressed output in the binary `stdout_data` and `stderr_data` columns of the log's output.
+    """
+
+    name = 'db'
+
+    def save(self, output, field, fileobj):
+        data = BytesIO()
+        compress(fileobj, data)
+        setattr(output, field + '_data', data.getvalue())
+        return '%s:' % self.name
+
+    def open(self, output, field, key):
+        return gzip.GzipFile(fileobj=self.open_compressed(output, field, key), mode='rb')
+
+    def open_compressed(self, output, field, key):
+        return BytesIO(getattr(output, field + '_data') or b'')
+
+
+class FileLogStorage(LogStorage):
+    """
+    Stores compressed output as files under `CHRONIKER_LOG_DIR`.
+    """
+
+    name = 'file'
+
+    def __init__(self, directory=None):
+        self.directory = directory or _settings.CHRONIKER_LOG_DIR
+        if not self.directory:
+            raise ImproperlyConfigured('CHRONIKER_LOG_DIR must be set to store logs as files.')
+
+    def get_path(self, key):
+        return os.path.join(self.directory, key)
+
+    def save(self, output, field, fileobj):
+        key = os.path.join(str(output.log.job_id), '%s-%s.txt.gz' % (uuid.uuid4().hex, field))
+        path = self.get_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written under a temporary name, so a partially written file is never read.
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as fout:
+            compress(fileobj, fout)
+        os.replace(tmp_path, path)
+        return '%s:%s' % (self.name, key)
+
+    def open(self, output, field, key):
+        return gzip.open(self.get_path(key), 'rb')
+
+    def open_compressed(self, output, field, key):
+        return open(self.get_path(key), 'rb')
+
+    def delete(self, output, field, key):
+        try:
+            os.remove(self.get_path(key))
+        except FileNotFoundError:
+            pass
+
+
+LOG_STORAGES = {
+    DatabaseLogStorage.name: DatabaseLogStorage,
+    FileLogStorage.name: FileLogStorage,
+}
+
+
+def get_storage(name=None):
+    """
+    Returns the storage backend with the given name, or the configured one,
+    or None if output is stored in the log's text columns.
+    """
+    name = name or _settings.CHRONIKER_LOG_STORAGE
+    if not name:
+        return None
+    if name not in LOG_STORAGES:
+        raise ImproperlyConfigured('Unknown log storage %r. Choose one of: %s' % (name, ', '.join(sorted(LOG_STORAGES))))
+    return LOG_STORAGES[name]()
+
+
+def parse_ref(ref):
+    """
+    Splits a reference into its storage and key.
+    """
+    name, _, key = ref.partition(':')
+    return get_storage(name), key
@@ -6,14 +6,19 @@ Quick run with:
 """
 from __future__ import print_function
 
+import gzip
+import json
 import os
+import signal
 import socket
+import stat
 import sys
 import tempfile
 import time
 import warnings
 from datetime import datetime, timedelta
 from multiprocessing import Process
+from unittest import mock
 
 from dateutil import zoneinfo
 import pytz
@@ -29,13 +34,14 @@ from django.conf import settings
 from django.contrib.auth.models import User
 from django.core import mail
 from django.core.management import call_command
+from django.db import connection
 from django.db.models import Max
 from django.test import TestCase
 from django.test.client import Client
 from django.utils import timezone
 
 from chroniker import constants as c, settings as _settings, utils
-from chroniker.models import Job, Log
+from chroniker.models import Job, JobDailyStats, JobRuntimeState, Log, LogOutput, fast_forward_dtstart
 
 warnings.simplefilter('error', RuntimeWarning)
 
@@ -241,7 +247,7 @@ class JobTestCase(TestCase):
 
         # Everything just ran, and they shouldn't run again for an hour, so we should
         # find nothing due.
-        Job.objects.update(is_running=False, last_heartbeat=timezone.now())
+        Job.objects.update(is_running=False)
         Job.objects.update()
         due = list(Job.objects.due_with_met_dependencies())
         print('dueB:', due)
@@ -265,6 +271,59 @@ class JobTestCase(TestCase):
             ]
         )
 
+    def testDueWithMetDependenciesQueryCount(self):
+        """
+        Confirm the due job planner loads jobs and their dependencies in a fixed number of queries.
+        """
+        expected = [_.id for _ in Job.objects.due_with_met_dependencies_ordered()]
+
+        # Adding more due jobs and dependencies should not add more queries.
+        for i in range(10):
+            job = Job.objects.create(
+                name='Sleep extra %i' % i,
+                command='test_sleeper',
+                args='0',
+                frequency=c.HOURLY,
+                next_run=timezone.now() - timedelta(minutes=1),
+            )
+            job.dependencies.create(dependee=Job.objects.get(id=4), wait_for_success=False, wait_for_next_run=False)
+            expected.append(job.id)
+
+        # One query for the due jobs, one for their dependencies and dependees.
+        with self.assertNumQueries(2):
+            due = Job.objects.due_with_met_dependencies_ordered()
+        self.assertEqual(sorted(_.id for _ in due), sorted(expected))
+
+        # Dependees are always ordered before their dependents.
+        due_ids = [_.id for _ in due]
+        self.assertTrue(due_ids.index(1) < due_ids.index(2))
+        self.assertTrue(due_ids.index(3) < due_ids.index(2))
+        self.assertTrue(due_ids.index(4) < due_ids.index(3))
+        for job_id in expected[-10:]:
+            self.assertTrue(due_ids.index(4) < due_ids.index(job_id))
+
+    def testClaim(self):
+        """
+        Confirm only one scheduler can claim a due job.
+        """
+        for skip_locked in (False, True):
+            Job.objects.update(is_running=False, hostname='')
+            JobRuntimeState.objects.update(current_hostname='')
+            with mock.patch.object(connection.features, 'has_select_for_update_skip_locked', skip_locked):
+                job = Job.objects.get(id=1)
+                self.assertTrue(Job.objects.claim(job))
+                self.assertFalse(Job.objects.claim(job))
+                self.assertFalse(Job.objects.claim(job.id))
+                job = Job.objects.get(id=1)
+                self.assertTrue(job.is_running)
+                self.assertEqual(job.current_hostname, 'localhost')
+                self.assertNotIn(job, Job.objects.due())
+
+                # Forced claims and every-host jobs may run more than once.
+                self.assertTrue(Job.objects.claim(job, force=True))
+                Job.objects.filter(id=1).update(hostname='*')
+                self.assertTrue(Job.objects.claim(job))
+
     def testStaleCleanup(self):
         """
         Confirm that stale jobs are correctly resolved.
@@ -411,6 +470,41 @@ class JobTestCase(TestCase):
         finally:
             settings.USE_TZ = _USE_TZ
 
+    def testRRuleCache(self):
+        job = Job.objects.get(id=1)
+        rule = job.rrule
+        self.assertIs(job.rrule, rule)
+        self.assertIs(Job.objects.get(id=1).rrule, rule)
+        self.assertEqual(job.get_params(), {'interval': 10})
+
+        # Changing any field the rule depends on yields a new rule.
+        job.params = 'interval:5'
+        self.assertIsNot(job.rrule, rule)
+        self.assertEqual(job.rrule.after(job.next_run), job.next_run + timedelta(hours=5))
+        job.frequency = c.MINUTELY
+        self.assertEqual(job.rrule.after(job.next_run), job.next_run + timedelta(minutes=5))
+        job.next_run += timedelta(minutes=1)
+        self.assertEqual(job.rrule.after(job.next_run), job.next_run + timedelta(minutes=5))
+
+        # Parsed multi-valued params can't be modified through the cache.
+        job.params = 'byhour:7,8,9'
+        job.get_params()['byhour'].append(10)
+        self.assertEqual(job.get_params(), {'byhour': [7, 8, 9]})
+
+    def testFastForward(self):
+        now = timezone.now()
+        stale = (now - timedelta(days=30)).replace(microsecond=0)
+        for frequency, params in ((c.SECONDLY, 'interval:7'), (c.MINUTELY, None), (c.HOURLY, 'interval:3'), (c.HOURLY, 'byminute:0,30')):
+            job = Job(frequency=frequency, params=params, next_run=stale)
+            next_run = job.get_next_run_after(now)
+            self.assertGreater(next_run, now)
+            self.assertEqual(next_run, job.rrule.after(now))
+
+        # Rules using by* params are not fast-forwarded.
+        self.assertEqual(fast_forward_dtstart(c.HOURLY, 'byminute:0,30', stale, now), stale)
+        self.assertEqual(fast_forward_dtstart(c.MONTHLY, None, stale, now), stale)
+        self.assertGreater(fast_forward_dtstart(c.HOURLY, None, stale, now), stale)
+
     def testWriteLock(self):
         lock_file = tempfile.NamedTemporaryFile()
         utils.write_lock(lock_file)
@@ -558,6 +652,920 @@ class JobTestCase(TestCase):
         self.assertEqual(job.last_run_successful, True)
         self.assertTrue(job.last_run_start_timestamp)
 
+    def testNextRunIndex(self):
+        now = timezone.now()
+        index = utils.NextRunIndex()
+        index.push(1, now + timedelta(minutes=5))
+        index.push(2, now - timedelta(minutes=1))
+        index.push(3, now + timedelta(minutes=1))
+        index.push(4, None)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.peek(), (now - timedelta(minutes=1), 2))
+
+        # Rescheduling or removing a job replaces its old entry.
+        index.push(2, now + timedelta(minutes=10))
+        index.remove(3)
+        self.assertEqual(index.peek(), (now + timedelta(minutes=5), 1))
+        self.assertEqual(index.pop_due(now), [])
+        self.assertEqual(index.pop_due(now + timedelta(minutes=10)), [1, 2])
+        self.assertEqual(len(index), 0)
+        self.assertEqual(index.peek(), None)
+
+    def testDaemon(self):
+        from chroniker.management.commands.chroniker_daemon import JobDaemon # pylint: disable=import-outside-toplevel
+
+        Job.objects.all().delete()
+        job = Job.objects.create(
+            name='test',
+            raw_command='ls',
+            frequency=c.HOURLY,
+            enabled=True,
+            log_stdout=True,
+            log_stderr=True,
+        )
+
+        daemon = JobDaemon(update_heartbeat=0, poll_seconds=30, refresh_seconds=300, sync=True)
+        daemon.step()
+        self.assertEqual(daemon.index.peek(), (job.next_run, job.id))
+        self.assertEqual(job.logs.all().count(), 0)
+
+        # Nothing is due for an hour, so the daemon should sleep until the next poll.
+        self.assertEqual(daemon.get_sleep_seconds(), 30)
+        daemon.poll_seconds = 7200
+        self.assertTrue(abs(daemon.get_sleep_seconds() - 300) <= 5)
+        daemon.refresh_seconds = 7200
+        self.assertTrue(abs(daemon.get_sleep_seconds() - 3600) <= 5)
+
+        # While nothing changes, checking for changes is a single query.
+        with self.assertNumQueries(1):
+            self.assertEqual(daemon.check_for_changes(), False)
+
+        # A job forced to run through admin is noticed on the next step and run immediately.
+        client, user = self.get_superuser_client()
+        response = client.get('/admin/chroniker/job/%i/run/' % job.id)
+        self.assertEqual(response.status_code, 302)
+        daemon.step()
+        self.assertEqual(job.logs.all().count(), 1)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.force_run, False)
+        self.assertEqual(job.is_running, False)
+
+        # A job reaching its next_run is noticed without querying the job table.
+        next_run = timezone.now()
+        daemon.index.push(job.id, next_run)
+        Job.objects.filter(id=job.id).update(next_run=next_run)
+        daemon.step()
+        self.assertEqual(job.logs.all().count(), 2)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(daemon.index.peek(), (job.next_run, job.id))
+        self.assertTrue(job.next_run > timezone.now())
+
+        # Disabling or deleting a job removes it from the schedule.
+        job.enabled = False
+        job.save()
+        self.assertEqual(daemon.check_for_changes(), True)
+        self.assertEqual(len(daemon.index), 0)
+        job2 = Job.objects.create(name='test2', raw_command='ls', frequency=c.HOURLY)
+        self.assertEqual(daemon.check_for_changes(), True)
+        self.assertEqual(daemon.index.peek(), (job2.next_run, job2.id))
+        job2.delete()
+        self.assertEqual(daemon.check_for_changes(), True)
+        self.assertEqual(len(daemon.index), 0)
+
+    def testConcurrencyLimits(self):
+        from chroniker.management.commands.chroniker_daemon import ConcurrencyBudget, JobDaemon # pylint: disable=import-outside-toplevel
+
+        Job.objects.filter(id__in=[1, 4]).update(concurrency_group='etl')
+        daemon = JobDaemon(update_heartbeat=0)
+        daemon.budget = ConcurrencyBudget(max_concurrency=3, groups={'etl': 1})
+
+        launched = []
+
+        def start_job_process(job, **kwargs):
+            launched.append(job.id)
+            return mock.Mock(max_seconds=0)
+
+        with mock.patch('chroniker.management.commands.chroniker_daemon.start_job_process', side_effect=start_job_process):
+            # Job 4 waits for job 1 to free the etl slot, and job 3 waits for job 4 since it depends on it.
+            daemon.launch_due()
+            self.assertEqual(launched, [1, 6])
+            self.assertEqual(daemon.budget.total, 2)
+            self.assertEqual(daemon.budget.group_counts['etl'], 1)
+
+            # Simulate job 1 finishing.
+            Job.objects.filter(id=1).update(is_running=False, next_run=timezone.now() + timedelta(hours=1))
+            del daemon.procs[1]
+            daemon.launch_due()
+            self.assertEqual(launched[:3], [1, 6, 4])
+            self.assertNotIn(3, launched)
+
+        # The global limit applies to jobs in every group.
+        daemon.budget.refresh()
+        self.assertEqual(daemon.budget.total, len(daemon.procs))
+        daemon.budget.max_concurrency = len(daemon.procs) + 1
+        self.assertTrue(daemon.budget.allows(Job.objects.get(id=3)))
+        daemon.budget.max_concurrency = len(daemon.procs)
+        self.assertFalse(daemon.budget.allows(Job.objects.get(id=3)))
+
+    def testCronWait(self):
+        """
+        Confirm run_cron notices job processes ending or timing out as soon as they do.
+        """
+        from chroniker.management.commands.cron import run_cron # pylint: disable=import-outside-toplevel
+
+        Job.objects.all().delete()
+        quick = Job.objects.create(name='quick', command='test_sleeper', args='0', frequency=c.HOURLY, force_run=True)
+        slow = Job.objects.create(name='slow', command='test_sleeper', args='30', frequency=c.HOURLY, force_run=True, timeout_seconds=2)
+        # Job processes can't write to the in-memory test database.
+        for job in (quick, slow):
+            JobRuntimeState.objects.create(job=job, last_run_start_timestamp=timezone.now())
+
+        t0 = time.time()
+        with mock.patch('chroniker.utils.TimedProcess.is_expired', new_callable=mock.PropertyMock, return_value=True) as is_expired:
+            run_cron([quick.id, slow.id], update_heartbeat=0)
+        seconds = time.time() - t0
+        self.assertTrue(2 <= seconds < 4, seconds)
+
+        # The run time of each process is only checked once its deadline has passed.
+        self.assertEqual(is_expired.call_count, 1)
+        log = Log.objects.get(job=slow)
+        self.assertFalse(log.on_time)
+        self.assertIn('Job exceeded timeout', log.stderr)
+        # Output written before the job stalled was sent while it waited, so it's kept.
+        self.assertIn('Sleeping for 30', log.stdout)
+
+    def testWorkerPool(self):
+        from chroniker.pool import PoolBusy, WorkerPool # pylint: disable=import-outside-toplevel
+
+        job = Job.objects.create(name='quick', command='test_sleeper', args='0', frequency=c.HOURLY)
+        slow_job = Job.objects.create(name='slow', command='test_sleeper', args='30', frequency=c.HOURLY, timeout_seconds=1)
+
+        def wait_for_jobs(pool):
+            for _ in range(100):
+                ended = pool.reap()
+                if ended:
+                    return ended
+                time.sleep(0.1)
+            raise Exception('Timed out waiting for pool.')
+
+        pool = WorkerPool(1, update_heartbeat=0, max_jobs=2)
+        try:
+            # Workers are reused until they've run max_jobs jobs.
+            worker = pool.submit(job, force_run=True)
+            self.assertFalse(pool.has_idle())
+            self.assertEqual(list(pool.running), [job.id])
+            with self.assertRaises(PoolBusy):
+                pool.submit(job, force_run=True)
+            self.assertEqual(wait_for_jobs(pool), [(job, worker)])
+            self.assertTrue(pool.has_idle())
+            self.assertIs(pool.submit(job, force_run=True), worker)
+            self.assertEqual(wait_for_jobs(pool), [(job, worker)])
+            self.assertEqual(pool.workers, [])
+            self.assertFalse(worker.is_alive())
+
+            # An interrupt meant for a job that's already finished doesn't kill its idle worker.
+            worker = pool.submit(job, force_run=True)
+            self.assertEqual(wait_for_jobs(pool), [(job, worker)])
+            os.kill(worker.pid, signal.SIGINT)
+            time.sleep(0.5)
+            self.assertTrue(worker.is_alive())
+            self.assertIs(pool.submit(job, force_run=True), worker)
+            self.assertEqual(wait_for_jobs(pool), [(job, worker)])
+            pool.close()
+
+            # Idle workers that died are replaced.
+            worker = pool.submit(job, force_run=True)
+            self.assertEqual(wait_for_jobs(pool), [(job, worker)])
+            worker.terminate()
+            new_worker = pool.submit(job, force_run=True)
+            self.assertIsNot(new_worker, worker)
+            self.assertEqual(wait_for_jobs(pool), [(job, new_worker)])
+            pool.close()
+
+            # Jobs exceeding their timeout are killed along with their worker.
+            worker = pool.submit(slow_job, force_run=True)
+            self.assertIsNot(worker, None)
+            time.sleep(1.5)
+            self.assertEqual(pool.expired(), [worker])
+            pool.remove(worker)
+            self.assertFalse(worker.is_alive())
+            self.assertEqual(pool.workers, [])
+        finally:
+            pool.close()
+
+    def testTeeFile(self):
+        from queue import Queue # pylint: disable=import-outside-toplevel
+
+        out = StringIO()
+        queue = Queue()
+        tee = utils.TeeFile(out, auto_flush=True, queue=queue, chunk_size=10, chunk_seconds=60)
+
+        # Non-ASCII text is kept, bytes are decoded and unencodable characters are replaced.
+        tee.write('caf\xe9 ')
+        self.assertTrue(queue.empty())
+        tee.write(b'\xc3\xa9t\xc3\xa9 ')
+        tee.write('\ud800\n')
+        self.assertEqual(tee.getvalue(), 'caf\xe9 \xe9t\xe9 ?\n')
+        self.assertEqual(out.getvalue(), tee.getvalue())
+        self.assertEqual(tee.length, 11)
+
+        # Queued output is sent in chunks, and whatever's left on flush.
+        self.assertEqual(queue.get_nowait()[1], 'caf\xe9 \xe9t\xe9 ?\n')
+        tee.write('x')
+        self.assertTrue(queue.empty())
+        tee.flush()
+        self.assertEqual(queue.get_nowait()[1], 'x')
+
+        # Output left waiting after the last write is sent once it's waited chunk_seconds.
+        tee = utils.TeeFile(StringIO(), auto_flush=True, queue=queue, chunk_size=10, chunk_seconds=0.1)
+        tee.start_flushing()
+        try:
+            tee.write('y')
+            self.assertEqual(queue.get(timeout=2)[1], 'y')
+        finally:
+            tee.close()
+
+        # Content isn't stored locally, but is still counted.
+        tee = utils.TeeFile(StringIO(), local=False)
+        tee.write('abc')
+        self.assertEqual(tee.getvalue(), '')
+        self.assertEqual(tee.length, 3)
+
+    def testOutputCollector(self):
+        from queue import Queue # pylint: disable=import-outside-toplevel
+        from chroniker.management.commands.cron import OutputCollector, get_collected_output, new_output_map # pylint: disable=import-outside-toplevel
+
+        # Output collected from long-lived workers is bounded.
+        queue = Queue()
+        with mock.patch('chroniker.management.commands.cron.COLLECTED_OUTPUT_SIZE', 5):
+            output_map = new_output_map()
+            collector = OutputCollector(queue, output_map)
+            collector.start()
+            for i in range(1000):
+                queue.put((123, '%i\n' % i))
+            collector.stop()
+        self.assertEqual(get_collected_output(output_map, 123), '0\n1\n2\n... 3880 characters omitted ...\n\n999\n')
+        self.assertEqual(get_collected_output(output_map, 123), '')
+
+    def testHeadTailBuffer(self):
+        tee = utils.TeeFile(StringIO(), head_size=5, tail_size=4)
+        tee.write('abc')
+        self.assertEqual(tee.getvalue(), 'abc')
+        tee.write('defg')
+        tee.write('hi')
+        self.assertEqual(tee.getvalue(), 'abcdefghi')
+        self.assertEqual(tee.dropped, 0)
+        for i in range(1000):
+            tee.write('%i\n' % i)
+        self.assertEqual(tee.length, 9 + 3890)
+        self.assertEqual(tee.dropped, tee.length - 9)
+        self.assertEqual(tee.getvalue(), 'abcde\n... %i characters omitted ...\n999\n' % tee.dropped)
+        self.assertLessEqual(len(tee.local_file.tail), 2)
+
+        # Writes larger than the whole buffer.
+        buf = utils.HeadTailBuffer(head_size=2, tail_size=3)
+        buf.write('x' * 100 + 'yz')
+        self.assertEqual(buf.getvalue(), 'xx\n... 97 characters omitted ...\nxyz')
+        self.assertEqual(utils.trim_output('abcdef', head_size=0, tail_size=3), 'abcdef')
+
+        # Logs are recorded from the trimmed output, but anything written to stderr still counts as a failure.
+        job = Job.objects.create(name='chatty', command='test_sleeper', args='0', frequency=c.HOURLY)
+        with mock.patch.object(_settings, 'CHRONIKER_LOG_HEAD_SIZE', 5), mock.patch.object(_settings, 'CHRONIKER_LOG_TAIL_SIZE', 5):
+            job.run(update_heartbeat=0, force_run=True)
+        log = Log.objects.get(job=job)
+        self.assertIn('characters omitted', log.stdout)
+        self.assertLess(len(log.stdout), 60)
+
+    def testLogStorage(self):
+        client, _ = self.get_superuser_client()
+        job = Job.objects.create(name='stored', command='test_sleeper', args='0', frequency=c.HOURLY)
+        raw_job = Job.objects.create(name='stored raw', raw_command='echo caf\xe9', frequency=c.HOURLY)
+        log_dir = tempfile.mkdtemp()
+        for storage in ('db', 'file'):
+            with mock.patch.object(_settings, 'CHRONIKER_LOG_STORAGE', storage), \
+                mock.patch.object(_settings, 'CHRONIKER_LOG_DIR', log_dir), \
+                mock.patch.object(_settings, 'CHRONIKER_LOG_PREVIEW_SIZE', 10):
+                Log.objects.all().delete()
+                job.run(update_heartbeat=0, force_run=True)
+                raw_job.run(update_heartbeat=0, force_run=True)
+
+                # Only a preview is kept in the log itself.
+                log = Log.objects.get(job=job)
+                self.assertTrue(log.output.stdout_ref.startswith(storage + ':'))
+                self.assertEqual(log.stdout, 'Sleeping f')
+                stdout = log.read_output('stdout')
+                self.assertIn('Job ran for', stdout)
+                self.assertEqual(log.output.stdout_size, len(stdout.encode('utf-8')))
+                self.assertIn('Job ran for', log.stdout_long_sample())
+                self.assertEqual(log.read_output('stderr'), '')
+
+                response = client.get('/admin/chroniker/log/%i/stdout/' % log.id)
+                self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), stdout)
+
+                # Compressed output is sent as-is.
+                response = client.get('/admin/chroniker/log/%i/stdout/' % log.id, HTTP_ACCEPT_ENCODING='gzip, deflate')
+                self.assertEqual(response['Content-Encoding'], 'gzip')
+                self.assertEqual(gzip.decompress(b''.join(response.streaming_content)).decode('utf-8'), stdout)
+
+                response = client.get('/admin/chroniker/log/%i/stdout/' % log.id, HTTP_RANGE='bytes=-5')
+                self.assertEqual(response.status_code, 206)
+                self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), stdout[-5:])
+
+                raw_log = Log.objects.get(job=raw_job)
+                self.assertEqual(raw_log.read_output('stdout'), 'caf\xe9\n')
+
+                # Stored files are removed along with their log, however it's deleted, once the deletion commits.
+                with self.captureOnCommitCallbacks(execute=True):
+                    Log.cleanup()
+                self.assertEqual(Log.objects.count(), 0)
+                self.assertEqual([files for _, _, files in os.walk(log_dir) if files], [])
+
+                job.run(update_heartbeat=0, force_run=True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    Log.objects.filter(job=job).delete()
+                job.run(update_heartbeat=0, force_run=True)
+                with self.captureOnCommitCallbacks(execute=True):
+                    client.post('/admin/chroniker/log/', {'action': 'delete_selected', '_selected_action': [Log.objects.get(job=job).id], 'post': 'yes'})
+                self.assertFalse(Log.objects.filter(job=job).exists())
+                self.assertEqual([files for _, _, files in os.walk(log_dir) if files], [])
+
+        # Deleting a job removes the files of its logs.
+        doomed = Job.objects.create(name='doomed', command='test_sleeper', args='0', frequency=c.HOURLY)
+        with mock.patch.object(_settings, 'CHRONIKER_LOG_STORAGE', 'file'), mock.patch.object(_settings, 'CHRONIKER_LOG_DIR', log_dir):
+            doomed.run(update_heartbeat=0, force_run=True)
+            self.assertNotEqual([files for _, _, files in os.walk(log_dir) if files], [])
+            with self.captureOnCommitCallbacks(execute=True):
+                doomed.delete()
+        self.assertEqual([files for _, _, files in os.walk(log_dir) if files], [])
+
+    def testLogOutput(self):
+        job = Job.objects.get(id=1)
+        log = Log.objects.create(job=job, stdout='out', stderr='err')
+        self.assertEqual(LogOutput.objects.get(log=log).stdout, 'out')
+
+        log = Log.objects.get(id=log.id)
+        self.assertEqual((log.stdout, log.stderr), ('out', 'err'))
+        log.stderr = ''
+        log.save()
+        self.assertEqual(LogOutput.objects.get(log=log).stderr, '')
+
+        # Runs without output don't get a row.
+        quiet_log = Log.objects.create(job=job, stdout='', stderr='')
+        self.assertFalse(LogOutput.objects.filter(log=quiet_log).exists())
+        self.assertEqual(Log.objects.get(id=quiet_log.id).stdout, '')
+
+        # The log table holds no output.
+        self.assertFalse({'stdout', 'stderr'} & set(f.name for f in Log._meta.concrete_fields))
+
+        log.delete()
+        self.assertFalse(LogOutput.objects.exists())
+
+    def testLogRetention(self):
+        from chroniker.retention import prune_job_logs # pylint: disable=import-outside-toplevel
+
+        job = Job.objects.create(name='pruned', command='test_sleeper', args='0', frequency=c.HOURLY, maximum_log_entries=3)
+        other_job = Job.objects.get(id=1)
+        now = timezone.now()
+        logs = [Log.objects.create(job=job, run_start_datetime=now - timedelta(hours=i), stdout='x' * 10, stderr='') for i in range(6)]
+        Log.objects.create(job=other_job, run_start_datetime=now - timedelta(days=1), stdout='y')
+
+        # Saving a job no longer deletes its logs.
+        job.save()
+        self.assertEqual(job.logs.count(), 6)
+
+        report = prune_job_logs(job.id, job.maximum_log_entries)
+        self.assertEqual((report.rows, report.bytes), (3, 30))
+        self.assertEqual(set(job.logs.values_list('id', flat=True)), set(log.id for log in logs[:3]))
+        self.assertEqual(LogOutput.objects.filter(log__job=job).count(), 3)
+        self.assertEqual(other_job.logs.count(), 1)
+        self.assertEqual(prune_job_logs(job.id, job.maximum_log_entries).rows, 0)
+
+        # Runs only delete their job's expired logs once there are more than the margin (at least one) of them.
+        job.run(update_heartbeat=0, force_run=True)
+        self.assertEqual(job.logs.count(), 4)
+        job.run(update_heartbeat=0, force_run=True)
+        self.assertEqual(job.logs.count(), 3)
+        self.assertFalse(job.logs.filter(id=logs[1].id).exists())
+        with mock.patch('chroniker.settings.CHRONIKER_LOG_PRUNE_MARGIN', None):
+            job.run(update_heartbeat=0, force_run=True)
+            job.run(update_heartbeat=0, force_run=True)
+        self.assertEqual(job.logs.count(), 5)
+
+        Job.objects.filter(id=job.id).update(maximum_log_entries=1)
+        call_command('cron_clean', max_entries=True)
+        self.assertEqual(job.logs.count(), 1)
+        self.assertEqual(other_job.logs.count(), 1)
+
+    def testJobDailyStats(self):
+        job = Job.objects.create(name='timed', command='test_sleeper', args='0', frequency=c.HOURLY)
+        start = timezone.now().replace(hour=12, minute=0, second=0, microsecond=0) - timedelta(days=2)
+        durations = [10, 20, 30, 40, 1000]
+        for i, seconds in enumerate(durations):
+            run_start_datetime = start + timedelta(minutes=i)
+            Log.objects.create(
+                job=job,
+                run_start_datetime=run_start_datetime,
+                run_end_datetime=run_start_datetime + timedelta(seconds=seconds),
+                success=i != 1,
+                on_time=i != 4,
+            )
+        # Logs of runs still in progress aren't counted.
+        Log.objects.create(job=job, run_start_datetime=start)
+
+        stats = job.daily_stats.get()
+        self.assertEqual((stats.runs, stats.failures, stats.timeouts), (5, 1, 1))
+        self.assertEqual((stats.total_duration, stats.min_duration, stats.max_duration), (1100, 10, 1000))
+        self.assertEqual(stats.mean_duration, 220)
+        self.assertAlmostEqual(stats.p50_duration, 30, delta=30 * 0.1)
+        self.assertAlmostEqual(stats.p95_duration, 1000, delta=1000 * 0.1)
+
+        # Recalculating from the logs corrects them.
+        JobDailyStats.objects.filter(id=stats.id).update(runs=1, total_duration=5)
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('backfill_job_stats', job_ids=str(job.id))
+        self.assertIn('Recalculated 1 days', out.getvalue())
+        stats = job.daily_stats.get()
+        self.assertEqual((stats.runs, stats.failures, stats.timeouts, stats.total_duration), (5, 1, 1, 1100))
+        self.assertEqual(sum(stats.duration_histogram.values()), 5)
+
+        summary = JobDailyStats.summarize(job.daily_stats.all())
+        self.assertEqual((summary['runs'], summary['min_duration'], summary['max_duration']), (5, 10, 1000))
+
+        client, _ = self.get_superuser_client()
+        response = client.get('/admin/chroniker/job/%i/change/' % job.id)
+        self.assertContains(response, '5 runs, 1 failed, 1 timed out')
+        response = client.get('/admin/chroniker/jobdailystats/')
+        self.assertEqual(response.status_code, 200)
+
+    def testRunLengthStats(self):
+        job = Job.objects.create(name='estimated', command='test_sleeper', args='0', frequency=c.HOURLY)
+        self.assertEqual(job.get_run_length_estimate(), None)
+        start = timezone.now() - timedelta(days=1)
+        durations = [100] + [10] * 25
+        for i, seconds in enumerate(durations):
+            run_start_datetime = start + timedelta(minutes=i)
+            Log.objects.create(job=job, run_start_datetime=run_start_datetime, run_end_datetime=run_start_datetime + timedelta(seconds=seconds))
+
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.run_length_count, 26)
+        self.assertEqual(len(job.run_length_window), _settings.CHRONIKER_RUN_LENGTH_WINDOW)
+        self.assertAlmostEqual(job.run_length_ewma, 10 + 90 * 0.8**25, places=3)
+        self.assertAlmostEqual(job.get_run_length_quantile(0.5), 10, delta=1)
+
+        # Estimates are read from the job alone.
+        with self.assertNumQueries(0):
+            self.assertEqual(job.get_run_length_estimate(), 10)
+            self.assertEqual(job.get_run_length_estimate(samples=3), 10)
+
+        # Saving a job loaded before a run doesn't discard the run.
+        stale_job = Job.objects.get(id=job.id)
+        now = timezone.now()
+        Log.objects.create(job=job, run_start_datetime=now, run_end_datetime=now + timedelta(seconds=40))
+        stale_job.save()
+        # Full saves leave the statistics out, rather than reloading them.
+        self.assertEqual(stale_job.run_length_count, 26)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.run_length_count, 27)
+        self.assertEqual(job.run_length_window[-1], 40)
+
+        Job.objects.filter(id=job.id).update(run_length_count=0, run_length_window=[])
+        Job.objects.rebuild_run_length(job.id)
+        job = Job.objects.get(id=job.id)
+        self.assertEqual(job.run_length_count, 27)
+        self.assertEqual(job.run_length_window[-2:], [10, 40])
+
+    def testCalculateJobChain(self):
+        from django.core.management.base import CommandError # pylint: disable=import-outside-toplevel
+        from chroniker.chain import calculate_chains # pylint: disable=import-outside-toplevel
+        from chroniker.models import JobDependency # pylint: disable=import-outside-toplevel
+
+        # a -> b -> d, a -> c -> d, with c the slow branch, and e -> f separately.
+        jobs = {}
+        for name, seconds in (('a', 10), ('b', 20), ('c', 300), ('d', 40), ('e', 5), ('f', 6)):
+            jobs[name] = Job.objects.create(name='chain-' + name, command='test_sleeper', frequency=c.HOURLY)
+            Job.objects.filter(id=jobs[name].id).update(run_length_window=[seconds])
+        for dependee, dependent in (('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd'), ('e', 'f')):
+            JobDependency.objects.create(dependee=jobs[dependee], dependent=jobs[dependent])
+
+        self.assertEqual(jobs['a'].get_chained_jobs(), set([jobs['b'], jobs['c'], jobs['d']]))
+
+        root_ids = [jobs['a'].id, jobs['e'].id]
+        with self.assertNumQueries(2):
+            chains = calculate_chains(root_ids=root_ids)
+        self.assertEqual(chains[0]['critical_path'], [jobs['a'].id, jobs['c'].id, jobs['d'].id])
+        self.assertEqual(chains[0]['duration_seconds'], 350)
+        self.assertEqual(chains[1]['duration_seconds'], 11)
+
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('calculate_job_chain', all_roots=True, json=True)
+        chains = dict((chain['root'], chain) for chain in json.loads(out.getvalue()))
+        self.assertEqual(set(root_ids), set(chains) & set(root_ids))
+        self.assertEqual(chains[jobs['e'].id]['critical_path'], [jobs['e'].id, jobs['f'].id])
+
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('calculate_job_chain', str(jobs['a'].id), samples=5)
+        self.assertIn('min hours:', out.getvalue())
+
+        # Only the run lengths in each job's window are kept, so more samples can't be used.
+        with self.assertRaises(CommandError):
+            call_command('calculate_job_chain', str(jobs['a'].id), samples=_settings.CHRONIKER_RUN_LENGTH_WINDOW + 1)
+        with self.assertRaises(CommandError):
+            call_command('calculate_job_chain', str(jobs['a'].id), samples=0)
+
+    def testBatchHeartbeat(self):
+        from chroniker.management.commands.cron import BatchHeartbeat # pylint: disable=import-outside-toplevel
+        from chroniker.models import clear_current_job, set_current_job # pylint: disable=import-outside-toplevel
+
+        old = timezone.now() - timedelta(hours=1)
+        running = Job.objects.create(name='running', command='test_sleeper', frequency=c.HOURLY)
+        stopping = Job.objects.create(name='stopping', command='test_sleeper', frequency=c.HOURLY)
+        ended = Job.objects.create(name='ended', command='test_sleeper', frequency=c.HOURLY)
+        Job.objects.filter(id__in=[running.id, stopping.id]).update(is_running=True, force_run=True)
+        for job in (running, stopping, ended):
+            JobRuntimeState.objects.create(job=job, last_heartbeat=old, force_stop=job != running)
+
+        # One UPDATE clears force_run, one records every heartbeat and returns the stop flags, then one clears those flags.
+        with self.assertNumQueries(3):
+            self.assertEqual(Job.objects.heartbeat([running.id, stopping.id, ended.id]), set([stopping.id]))
+        flags = dict((_['job_id'], _) for _ in JobRuntimeState.objects.filter(job_id__in=[running.id, stopping.id, ended.id]).values())
+        self.assertTrue(flags[running.id]['last_heartbeat'] > old)
+        self.assertFalse(Job.objects.get(id=running.id).force_run)
+        self.assertFalse(flags[stopping.id]['force_stop'])
+        # Jobs that already ended are left alone.
+        self.assertEqual(flags[ended.id]['last_heartbeat'], old)
+        self.assertTrue(flags[ended.id]['force_stop'])
+
+        # Databases without UPDATE ... RETURNING select the flags first.
+        JobRuntimeState.objects.filter(job_id=stopping.id).update(force_stop=True)
+        with mock.patch.object(connection.Database, 'sqlite_version_info', (3, 31, 0)):
+            self.assertEqual(Job.objects.heartbeat([running.id, stopping.id]), set([stopping.id]))
+        self.assertFalse(Job.objects.get(id=stopping.id).force_stop)
+
+        # The supervisor beats for live processes, and interrupts those flagged to stop.
+        child = Process(target=time.sleep, args=(30,))
+        child.start()
+        dead = Process(target=time.sleep, args=(0,))
+        dead.start()
+        dead.join()
+        JobRuntimeState.objects.filter(job_id=running.id).update(last_heartbeat=old)
+        JobRuntimeState.objects.filter(job_id=stopping.id).update(force_stop=True)
+        heartbeat = BatchHeartbeat(interval=60)
+        heartbeat.add(stopping.id, child.pid)
+        heartbeat.add(running.id, dead.pid)
+        self.assertEqual(heartbeat.get_seconds_remaining(), 0)
+        self.assertEqual(heartbeat.beat(), set([stopping.id]))
+        self.assertEqual(Job.objects.get(id=running.id).last_heartbeat, old)
+        self.assertTrue(heartbeat.get_seconds_remaining() > 50)
+        self.assertEqual(heartbeat.beat(), set())
+        # A process that missed the signal is interrupted again on the next heartbeat.
+        for _ in range(10):
+            child.join(1)
+            if not child.is_alive():
+                break
+            heartbeat.last_beat = None
+            self.assertEqual(heartbeat.beat(), set())
+        self.assertFalse(child.is_alive())
+
+        # Without a heartbeat thread, progress is recorded directly.
+        set_current_job(running.id)
+        try:
+            Job.update_progress(10, 4)
+            # Progress is written by a single thread, so there's nothing to lock.
+            with self.assertWarns(DeprecationWarning):
+                Job.update_progress(10, 4, lock=False)
+        finally:
+            clear_current_job()
+        running = Job.objects.get(id=running.id)
+        self.assertEqual((running.total_parts, running.total_parts_complete), (10, 4))
+
+    def testJobRuntimeState(self):
+        job = Job.objects.create(name='runtime', command='test_sleeper', args='0', frequency=c.HOURLY)
+        # A job that has never run has no runtime state, but still has its defaults.
+        self.assertFalse(JobRuntimeState.objects.filter(job=job).exists())
+        job = Job.objects.get(id=job.id)
+        self.assertEqual((job.total_parts, job.force_stop, job.last_heartbeat), (0, False, None))
+
+        # Runtime fields set on the job are saved to its runtime state.
+        job.is_running = True
+        job.last_heartbeat = timezone.now() - timedelta(days=1)
+        job.current_hostname = socket.gethostname()
+        job.save()
+        runtime = JobRuntimeState.objects.get(job=job)
+        self.assertEqual(runtime.current_hostname, socket.gethostname())
+        self.assertIn(job, Job.objects.stale())
+        self.assertIn(job, Job.objects.all_running())
+        job.total_parts = 5
+        job.save(update_fields=['total_parts'])
+        self.assertEqual(JobRuntimeState.objects.get(job=job).total_parts, 5)
+
+        # Heartbeats and progress only write the runtime state.
+        last_modified = Job.objects.get(id=job.id).last_modified
+        Job.objects.heartbeat([job.id])
+        Job.objects.update_progress(job.id, 10, 3)
+        job = Job.objects.select_related('runtime').get(id=job.id)
+        self.assertEqual(job.last_modified, last_modified)
+        self.assertEqual((job.total_parts, job.total_parts_complete), (10, 3))
+        self.assertNotIn(job, Job.objects.stale())
+
+        # Jobs that stop running forget their process.
+        job.is_running = False
+        job.save()
+        runtime = JobRuntimeState.objects.get(job=job)
+        self.assertEqual((runtime.current_hostname, runtime.current_pid), (None, None))
+
+        # The admin edits the force_stop flag along with the job.
+        client, _ = self.get_superuser_client()
+        response = client.get('/admin/chroniker/job/%i/change/' % job.id)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'name="force_stop"')
+        response = client.get('/admin/chroniker/job/%i/stop/' % job.id)
+        self.assertTrue(JobRuntimeState.objects.get(job=job).force_stop)
+        response = client.get('/admin/chroniker/job/%i/run/' % job.id)
+        self.assertFalse(JobRuntimeState.objects.get(job=job).force_stop)
+        response = client.get('/admin/chroniker/job/?q=%s' % socket.gethostname())
+        self.assertEqual(response.status_code, 200)
+
+    def testProgressReporting(self):
+        from chroniker.models import clear_current_job, get_progress_reporter, set_current_job # pylint: disable=import-outside-toplevel
+
+        job = Job.objects.create(name='progress', command='test_sleeper', args='0', frequency=c.HOURLY)
+        JobRuntimeState.objects.create(job=job)
+        set_current_job(job.id)
+        try:
+            with mock.patch('chroniker.settings.CHRONIKER_PROGRESS_SECONDS', 60):
+                # Progress is coalesced in memory, and only the latest value is written.
+                with self.assertNumQueries(0):
+                    for i in range(1000):
+                        Job.update_progress(1000, i)
+                with self.assertNumQueries(1):
+                    get_progress_reporter(job.id).flush()
+                runtime = JobRuntimeState.objects.get(job=job)
+                self.assertEqual((runtime.total_parts, runtime.total_parts_complete), (1000, 999))
+                # Unchanged progress isn't written again.
+                Job.update_progress(1000, 999)
+                with self.assertNumQueries(0):
+                    get_progress_reporter(job.id).flush()
+
+                # The final value is written when the block exits.
+                with Job.progress() as progress:
+                    for _ in progress.track(['a', 'b', 'c']):
+                        pass
+                runtime = JobRuntimeState.objects.get(job=job)
+                self.assertEqual((runtime.total_parts, runtime.total_parts_complete), (3, 3))
+
+                # And when the job finishes.
+                Job.update_progress(10, 7)
+        finally:
+            clear_current_job()
+        runtime = JobRuntimeState.objects.get(job=job)
+        self.assertEqual((runtime.total_parts, runtime.total_parts_complete), (10, 7))
+
+        # Without a current job, progress is ignored.
+        with Job.progress(2) as progress:
+            progress.update()
+        self.assertEqual(progress.total_parts_complete, 1)
+
+    def testJobNotifications(self):
+        from django.core.exceptions import ImproperlyConfigured # pylint: disable=import-outside-toplevel
+        from chroniker import notify # pylint: disable=import-outside-toplevel
+        from chroniker.management.commands.chroniker_daemon import JobDaemon # pylint: disable=import-outside-toplevel
+
+        self.assertEqual(notify.decode(notify.encode(notify.STOP, 12)), (notify.STOP, 12))
+        self.assertEqual(notify.decode('restart:12'), None)
+        self.assertEqual(notify.get_notifier(), None)
+        self.assertEqual(notify.listen(), None)
+        with self.assertRaises(ImproperlyConfigured):
+            notify.get_notifier('carrier-pigeon')
+        with self.assertRaises(ImproperlyConfigured):
+            notify.get_notifier('postgres')
+        # The socket directory has no default, since it must be shared by the admin and the supervisors.
+        with self.assertRaises(ImproperlyConfigured):
+            notify.get_notifier('socket')
+
+        parent = tempfile.mkdtemp()
+        directory = os.path.join(parent, 'sockets')
+        with self.assertLogs('chroniker.notify', level='WARNING'):
+            notify.SocketNotifier(directory).send(notify.RUN, 3)
+        listener = notify.SocketNotifier(directory)
+        listener.listen()
+        self.assertEqual(stat.S_IMODE(os.stat(directory).st_mode), 0o2770)
+        self.assertEqual(stat.S_IMODE(os.stat(listener.path).st_mode), 0o660)
+        try:
+            # Sockets left behind by supervisors that have exited are removed.
+            stale_path = os.path.join(directory, '1.sock')
+            stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            stale.bind(stale_path)
+            stale.close()
+            notify.SocketNotifier(directory).send(notify.STOP, 3)
+            self.assertFalse(os.path.exists(stale_path))
+            self.assertEqual(listener.receive(), [(notify.STOP, 3)])
+            self.assertEqual(listener.receive(), [])
+        finally:
+            listener.close()
+        self.assertEqual(os.listdir(directory), [])
+
+        # A job flagged to run in the admin wakes the daemon, which launches it without waiting for its next poll.
+        Job.objects.all().delete()
+        job = Job.objects.create(name='notified', command='test_sleeper', args='0', frequency=c.HOURLY)
+        client, _ = self.get_superuser_client()
+        with mock.patch('chroniker.settings.CHRONIKER_NOTIFIER', 'socket'), mock.patch('chroniker.settings.CHRONIKER_NOTIFY_SOCKET_DIR', directory):
+            daemon = JobDaemon(update_heartbeat=0, poll_seconds=30, refresh_seconds=300, sync=True)
+            daemon.refresh()
+            daemon.notifier = notify.listen()
+            try:
+                self.assertEqual(daemon.index.peek(), (job.next_run, job.id))
+                client.get('/admin/chroniker/job/%i/run/' % job.id)
+                t0 = time.time()
+                daemon.wait(30)
+                self.assertTrue(time.time() - t0 < 5)
+                self.assertFalse(daemon.receive_notifications())
+                self.assertTrue(daemon.index.peek()[0] <= timezone.now())
+
+                client.get('/admin/chroniker/job/%i/stop/' % job.id)
+                daemon.wait(30)
+                self.assertTrue(daemon.receive_notifications())
+            finally:
+                daemon.stop()
+
+            # Running several jobs from the changelist sends them all through one notifier.
+            other = Job.objects.create(name='notified too', command='test_sleeper', args='0', frequency=c.HOURLY)
+            listener = notify.listen()
+            try:
+                with mock.patch('chroniker.notify.get_notifier', wraps=notify.get_notifier) as get_notifier:
+                    client.post('/admin/chroniker/job/', {'action': 'run_selected_jobs', '_selected_action': [job.id, other.id]})
+                self.assertEqual(get_notifier.call_count, 1)
+                self.assertEqual(sorted(listener.receive()), [(notify.RUN, job.id), (notify.RUN, other.id)])
+            finally:
+                listener.close()
+        with self.assertLogs('chroniker.notify', level='WARNING'):
+            notify.SocketNotifier(directory).send(notify.RUN, job.id)
+        os.rmdir(directory)
+        os.rmdir(parent)
+
+    def testChangelistQueries(self):
+        from django.contrib import admin # pylint: disable=import-outside-toplevel
+        from django.test.utils import CaptureQueriesContext # pylint: disable=import-outside-toplevel
+
+        def add_jobs(count):
+            now = timezone.now()
+            for i in range(count):
+                job = Job.objects.create(name='listed %i' % i, command='test_sleeper', args='0', frequency=c.HOURLY, last_run=now)
+                Log.objects.bulk_create([Log(job=job, run_start_datetime=now - timedelta(hours=_)) for _ in range(3)])
+            return job
+
+        client, _ = self.get_superuser_client()
+        job = add_jobs(2)
+        Job.objects.filter(id=job.id).update(is_running=True)
+        client.get('/admin/chroniker/job/')
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get('/admin/chroniker/job/')
+        self.assertEqual(response.status_code, 200)
+        latest_log = job.logs.order_by('-run_start_datetime').first()
+        self.assertContains(response, '/admin/chroniker/log/%i/change/' % latest_log.id)
+        self.assertContains(response, 'View&nbsp;3')
+
+        qs = admin.site._registry[Job].get_queryset(None)
+        self.assertEqual(qs.get(id=job.id).log_count, 3)
+        self.assertEqual(qs.get(id=job.id).latest_log_id, latest_log.id)
+        self.assertTrue(qs.get(id=job.id).stale)
+        self.assertFalse(qs.get(id=1).stale)
+        self.assertEqual(qs.get(id=1).log_count, None)
+
+        # More jobs, with more logs, don't take more queries.
+        add_jobs(5)
+        with CaptureQueriesContext(connection) as more_queries:
+            response = client.get('/admin/chroniker/job/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(more_queries), len(queries))
+
+    def testDurationGraphData(self):
+        self.assertEqual(list(utils.downsample_series([(0, 1), (1, 3), (5, 2), (9, 8)], 0, 9, 2)), [(0, 1, 2, 3), (5, 2, 5, 8)])
+        self.assertEqual(list(utils.merge_intervals([(0, 1), (1, 2), (4, 5), (10, 11)], gap=2)), [(0, 5), (10, 11)])
+
+        job = Job.objects.create(name='graphed', command='test_sleeper', args='0', frequency=c.HOURLY)
+        start = timezone.now().replace(microsecond=0) - timedelta(days=2)
+        for i in range(40):
+            run_start_datetime = start + timedelta(hours=i)
+            Log.objects.create(
+                job=job,
+                run_start_datetime=run_start_datetime,
+                run_end_datetime=run_start_datetime + timedelta(seconds=i + 1),
+                success=i not in (10, 11, 30),
+            )
+
+        client, _ = self.get_superuser_client()
+        response = client.get('/admin/chroniker/job/%i/graph/duration/' % job.id)
+        self.assertContains(response, 'graph_div')
+        self.assertNotContains(response, 'new Date("')
+
+        url = '/admin/chroniker/job/%i/graph/duration/data/' % job.id
+        response = client.get(url, {'points': 10})
+        data = response.json()
+        self.assertEqual(data['count'], 40)
+        self.assertTrue(data['downsampled'])
+        self.assertTrue(len(data['points']) <= 10)
+        self.assertEqual(data['points'][0][1], 1)
+        self.assertEqual(data['points'][-1][3], 40)
+        # Neighbouring failures merge into one interval.
+        self.assertEqual(len(data['errors']), 2)
+        self.assertEqual(data['errors'][0][0], utils.to_timestamp_ms(start + timedelta(hours=10)))
+
+        # Unchanged data isn't sent again.
+        response = client.get(url, {'points': 10}, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        # Zooming in fetches every run in the window.
+        window = (utils.to_timestamp_ms(start + timedelta(hours=5)), utils.to_timestamp_ms(start + timedelta(hours=9)))
+        data = client.get(url, {'points': 10, 'start': window[0], 'end': window[1]}).json()
+        self.assertFalse(data['downsampled'])
+        self.assertEqual([point[2] for point in data['points']], [6, 7, 8, 9, 10])
+        self.assertEqual(data['errors'], [])
+
+        self.assertEqual(client.get(url, {'start': 'yesterday'}).status_code, 400)
+
+    def testCronCleanBatches(self):
+        from chroniker.retention import delete_logs, estimate_logs # pylint: disable=import-outside-toplevel
+
+        job = Job.objects.get(id=1)
+        old = timezone.now() - timedelta(days=30)
+        for _ in range(25):
+            Log.objects.create(job=job, run_start_datetime=old, stdout='abcd')
+        Log.objects.create(job=job, stdout='new')
+        q = Log.objects.filter(run_start_datetime__lte=old)
+
+        estimate = estimate_logs(q, samples=2, window=5)
+        self.assertEqual(estimate.bytes, estimate.rows * 4)
+        self.assertTrue(15 <= estimate.rows <= 35, estimate.rows)
+
+        # A dry run deletes nothing.
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('cron_clean', 'days', '1', dryrun=True)
+        self.assertIn('Would delete about 25 logs', out.getvalue())
+        self.assertEqual(Log.objects.count(), 26)
+
+        # Stops after the first batch once out of time.
+        report = delete_logs(q, batch_size=10, deadline=time.time())
+        self.assertEqual((report.rows, report.bytes, report.complete), (10, 40, False))
+
+        progress = []
+        report = delete_logs(q, batch_size=10, progress=lambda r: progress.append(r.rows))
+        self.assertEqual(progress, [10, 15])
+        self.assertTrue(report.complete)
+        self.assertEqual(list(Log.objects.values_list('output__stdout', flat=True)), ['new'])
+
+        out = StringIO()
+        with mock.patch('sys.stdout', out):
+            call_command('cron_clean', 'minutes', '0', batch_size=1)
+        self.assertIn('Deleted 1 of about 1 logs (100%)', out.getvalue())
+        self.assertEqual(Log.objects.count(), 0)
+
+    def testLogDownload(self):
+        client, _ = self.get_superuser_client()
+        job = Job.objects.get(id=1)
+        log = Log.objects.create(job=job, stdout='0123456789' * 10000, stderr='caf\xe9')
+        url = '/admin/chroniker/log/%i/stdout/' % log.id
+
+        response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Length'], '100000')
+        self.assertEqual(b''.join(response.streaming_content), log.stdout.encode('utf-8'))
+
+        # Byte ranges, including the tail.
+        for header, expected, content_range in (
+            ('bytes=10-14', '01234', 'bytes 10-14/100000'),
+            ('bytes=99995-', '56789', 'bytes 99995-99999/100000'),
+            ('bytes=-3', '789', 'bytes 99997-99999/100000'),
+            ('bytes=99998-200000', '89', 'bytes 99998-99999/100000'),
+        ):
+            response = client.get(url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 206)
+            self.assertEqual(response['Content-Range'], content_range)
+            self.assertEqual(b''.join(response.streaming_content).decode('utf-8'), expected)
+        # Valid ranges beyond the end can't be satisfied.
+        for header in ('bytes=100000-', 'bytes=100000-100005'):
+            response = client.get(url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 416)
+            self.assertEqual(response['Content-Range'], 'bytes */100000')
+
+        # Multiple ranges, and malformed ones, are ignored, sending the whole output.
+        for header in ('bytes=0-1,5-6', 'bytes=-0', 'bytes=5-2', 'bytes=-', 'bytes=a-b', 'bytes=1--5', 'lines=0-1'):
+            response = client.get(url, HTTP_RANGE=header)
+            self.assertEqual(response.status_code, 200, header)
+            self.assertEqual(response['Content-Length'], '100000')
+
+        # Output stored as text is compressed on the fly.
+        response = client.get('/admin/chroniker/log/%i/stderr/' % log.id, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(b''.join(response.streaming_content)).decode('utf-8'), 'caf\xe9')
+
+        self.assertEqual(client.get('/admin/chroniker/log/0/stdout/').status_code, 404)
+
     def testHourly(self):
 
         Job.objects.all().delete()
@@ -1,18 +1,20 @@
 from __future__ import print_function
 import html
 import errno
+import heapq
+import io
 import os
 import signal
 import sys
+import tempfile
+import threading
 import time
 import warnings
-from datetime import timedelta
+import zlib
+from collections import deque
+from datetime import datetime, timedelta, timezone as dt_timezone
 from importlib import import_module
 from multiprocessing import Process, current_process
-try:
-    from io import StringIO
-except ImportError:
-    from cStringIO import StringIO
 
 import psutil
 
@@ -25,7 +27,7 @@ from django.utils import timezone
 from django.utils.encoding import smart_str
 from django.utils.html import format_html
 
-from . import constants as c
+from . import constants as c, settings as _settings
 
 
 def get_etc(complete_parts, total_parts, start_datetime, current_datetime=None, as_seconds=False):
@@ -72,52 +74,226 @@ def get_admin_changelist_url(obj):
     return reverse(list_url_name)
 
 
-class TeeFile(StringIO):
+class HeadTailBuffer:
     """
-    A helper class for allowing output to be stored in a StringIO instance
+    A file-like buffer that keeps only the first head_size and the last tail_size characters written to it,
+    so the memory used to capture output is bounded no matter how much is written.
+
+    The characters in between are counted in dropped, and getvalue() marks where they were omitted.
+    If either size is 0, everything is kept.
+    """
+
+    def __init__(self, head_size=None, tail_size=None):
+        self.head_size = _settings.CHRONIKER_LOG_HEAD_SIZE if head_size is None else head_size
+        self.tail_size = _settings.CHRONIKER_LOG_TAIL_SIZE if tail_size is None else tail_size
+        self.head = []
+        self.head_length = 0
+        self.tail = deque()
+        self.tail_length = 0
+        self.length = 0
+
+    @property
+    def bounded(self):
+        return bool(self.head_size and self.tail_size)
+
+    @property
+    def dropped(self):
+        """
+        The number of characters written but not kept.
+        """
+        if not self.bounded:
+            return 0
+        return max(self.length - self.head_size - self.tail_size, 0)
+
+    def write(self, s):
+        n = len(s)
+        self.length += n
+        if not self.bounded:
+            self.head.append(s)
+            return n
+        if self.head_length < self.head_size:
+            part = s[:self.head_size - self.head_length]
+            self.head.append(part)
+            self.head_length += len(part)
+            s = s[len(part):]
+            if not s:
+                return n
+        # Discard whole chunks that have fallen out of the tail.
+        if len(s) >= self.tail_size:
+            self.tail.clear()
+            self.tail_length = 0
+            s = s[-self.tail_size:]
+        self.tail.append(s)
+        self.tail_length += len(s)
+        while self.tail_length - len(self.tail[0]) >= self.tail_size:
+            self.tail_length -= len(self.tail.popleft())
+        return n
+
+    def flush(self):
+        pass
+
+    def getvalue(self):
+        head = ''.join(self.head)
+        tail = ''.join(self.tail)
+        if len(tail) > self.tail_size:
+            tail = tail[-self.tail_size:]
+        if self.dropped:
+            return '%s\n... %i characters omitted ...\n%s' % (head, self.dropped, tail)
+        return head + tail
+
+
+def trim_output(s, head_size=None, tail_size=None):
+    """
+    Returns the given output trimmed to its head and tail, the same as output captured by a TeeFile.
+    """
+    buf = HeadTailBuffer(head_size=head_size, tail_size=tail_size)
+    buf.write(s or '')
+    return buf.getvalue()
+
+
+class TeeFile:
+    """
+    A helper class for allowing output to be stored in a buffer
     while still be directed to a second file object, such as sys.stdout.
+
+    Text is stored as-is, except characters that can't be encoded with the given
+    encoding, which are handled according to the given errors policy.
+
+    If a queue is given, output is also sent to it in chunks of about
+    chunk_size characters, or whatever was written in the last chunk_seconds.
+    Call start_flushing() to also send output left waiting after the last write,
+    such as by a job that stalls until it's killed for exceeding its timeout.
+
+    Only the first head_size and last tail_size characters are stored locally, but length counts everything written.
+    If spool is true, all output is also written to a temporary file, encoded, for storing once the job ends.
+
+    This wraps its buffer rather than subclassing StringIO, since attribute lookups on
+    subclasses of C types are several times slower, and write() is called for every print().
     """
 
-    def __init__(self, file, auto_flush=False, queue=None, local=True): # pylint: disable=W0622
-        super().__init__()
+    def __init__(self, file, auto_flush=False, queue=None, local=True, encoding=None, errors=None, chunk_size=None, chunk_seconds=None,
+        head_size=None, tail_size=None, spool=False): # pylint: disable=W0622
         self.file = file
         self.auto_flush = auto_flush
         self.length = 0
         self.queue = queue
         self.queue_buffer = []
+        self.queue_buffer_length = 0
+        self.output_encoding = encoding or _settings.CHRONIKER_OUTPUT_ENCODING
+        self.output_errors = errors or _settings.CHRONIKER_OUTPUT_ERRORS
+        self.chunk_size = chunk_size or _settings.CHRONIKER_OUTPUT_CHUNK_SIZE
+        self.chunk_seconds = _settings.CHRONIKER_OUTPUT_CHUNK_SECONDS if chunk_seconds is None else chunk_seconds
+        self.last_flush = time.monotonic()
+        # Guards the queue buffer, which the flushing thread also sends.
+        self.queue_lock = threading.Lock()
+        self.flushing = None
+        self.local_file = HeadTailBuffer(head_size=head_size, tail_size=tail_size)
+        self.spool_file = None
+        if spool:
+            self.spool_file = io.TextIOWrapper(tempfile.TemporaryFile(), encoding=self.output_encoding, errors=self.output_errors)
 
         # If False, tracks length, but doesn't store content locally.
         # Useful if you want to keep track of whether or not data was written
         # but don't care about the content, especially if it's expected to be massive.
         self.local = local
 
+    @property
+    def dropped(self):
+        return self.local_file.dropped
+
+    @property
+    def encoding(self):
+        return self.output_encoding
+
+    def isatty(self):
+        return False
+
     def write(self, s):
+        if isinstance(s, bytes):
+            s = s.decode(self.output_encoding, self.output_errors)
+        elif not s.isascii():
+            # Applies the error policy to anything the encoding can't represent, such as lone surrogates.
+            s = s.encode(self.output_encoding, self.output_errors).decode(self.output_encoding, self.output_errors)
+        n = len(s)
+        self.length += n
         try:
-            #import chardet
-            #encoding_opinion = chardet.detect(s)
-            #encoding = encoding_opinion['encoding']
-            #TODO:fix? not stripping out non-ascii characters result in error
-            #'ascii' codec can't encode character ? in position ?: ordinal not in range(128)
-            s = ''.join(_ for _ in s if ord(_) < 128)
-            #s = s.encode(encoding, 'ignore')
-        except ImportError:
-            pass
-        self.length += len(s)
-        self.file.write(s)
+            self.file.write(s)
+        except UnicodeEncodeError:
+            # The file's encoding is narrower than ours, such as an ASCII terminal.
+            file_encoding = getattr(self.file, 'encoding', None) or 'ascii'
+            self.file.write(s.encode(file_encoding, 'replace').decode(file_encoding))
         if self.local:
-            StringIO.write(self, s)
-        if self.auto_flush:
-            self.flush()
+            self.local_file.write(s)
+            if self.spool_file is not None:
+                self.spool_file.write(s)
         if self.queue is not None:
-            self.queue_buffer.append(s)
+            with self.queue_lock:
+                self.queue_buffer.append(s)
+                self.queue_buffer_length += n
+        if self.auto_flush and (self.queue_buffer_length >= self.chunk_size or time.monotonic() - self.last_flush >= self.chunk_seconds):
+            self.flush()
+        return n
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
 
     def flush(self):
         self.file.flush()
-        StringIO.flush(self)
-        if self.queue is not None:
-            data = (current_process().pid, ''.join(self.queue_buffer)) # pylint: disable=E1102
-            self.queue.put(data)
-            self.queue_buffer = []
+        self.last_flush = time.monotonic()
+        if self.queue is not None and self.queue_buffer:
+            # Held while sending, so chunks are never sent out of order.
+            with self.queue_lock:
+                if self.queue_buffer:
+                    data = (current_process().pid, ''.join(self.queue_buffer)) # pylint: disable=E1102
+                    self.queue.put(data)
+                    self.queue_buffer = []
+                    self.queue_buffer_length = 0
+
+    def start_flushing(self):
+        """
+        Starts a background thread that flushes output to the queue once it's waited chunk_seconds,
+        even if nothing more is written.
+        """
+        if self.queue is None or self.flushing is not None or self.chunk_seconds <= 0:
+            return
+        self.flushing = threading.Event()
+        threading.Thread(target=self.run_flushing, args=(self.flushing,), name='tee-flush', daemon=True).start()
+
+    def run_flushing(self, stopped):
+        """
+        Do not call this directly; it's run by the thread start_flushing() starts.
+        """
+        while not stopped.wait(self.chunk_seconds):
+            if self.queue_buffer and time.monotonic() - self.last_flush >= self.chunk_seconds:
+                self.flush()
+
+    def stop_flushing(self):
+        """
+        Stops the thread started by start_flushing(), if any.
+        """
+        if self.flushing is not None:
+            self.flushing.set()
+            self.flushing = None
+
+    def getvalue(self):
+        return self.local_file.getvalue()
+
+    def get_spooled(self):
+        """
+        Returns the binary spool file, rewound to the start, or None if output isn't spooled.
+        """
+        if self.spool_file is None:
+            return None
+        self.spool_file.flush()
+        self.spool_file.buffer.seek(0)
+        return self.spool_file.buffer
+
+    def close(self):
+        self.stop_flushing()
+        if self.spool_file is not None:
+            self.spool_file.close()
+            self.spool_file = None
 
     def fileno(self):
         return self.file.fileno()
@@ -416,6 +592,16 @@ class TimedProcess(Process):
         duration_seconds = self.get_duration_seconds()
         return duration_seconds >= self.max_seconds
 
+    @property
+    def deadline(self):
+        """
+        Returns the time, as given by time.time(), at which the process will have run
+        for max_seconds of wall-clock time, or None if it has no timeout.
+        """
+        if not self.max_seconds:
+            return None
+        return self.t0_objective + self.max_seconds
+
     @property
     def seconds_until_timeout(self):
         return max(self.max_seconds - self.get_duration_seconds(), 0)
@@ -450,6 +636,83 @@ class TimedProcess(Process):
         return timeout
 
 
+class NextRunIndex:
+    """
+    An in-memory priority queue of jobs keyed on their next run datetime.
+
+    Updating or removing a job doesn't search the heap. Its old entry is left
+    in place and discarded when it reaches the top, so all operations are O(log n).
+    """
+
+    def __init__(self):
+        self._heap = [] # [(next_run, job_id)]
+        self._next_runs = {} # {job_id: next_run}
+
+    def __len__(self):
+        return len(self._next_runs)
+
+    def __contains__(self, job_id):
+        return job_id in self._next_runs
+
+    def get(self, job_id):
+        return self._next_runs.get(job_id)
+
+    def push(self, job_id, next_run):
+        """
+        Adds the job to the index, replacing any previous entry for it.
+        A next_run of None removes the job.
+        """
+        if next_run is None:
+            self.remove(job_id)
+            return
+        if self._next_runs.get(job_id) == next_run:
+            return
+        self._next_runs[job_id] = next_run
+        heapq.heappush(self._heap, (next_run, job_id))
+        if len(self._heap) > 2 * len(self._next_runs) + 100:
+            self._compact()
+
+    def remove(self, job_id):
+        self._next_runs.pop(job_id, None)
+
+    def clear(self):
+        self._heap = []
+        self._next_runs = {}
+
+    def _compact(self):
+        self._heap = [(next_run, job_id) for job_id, next_run in self._next_runs.items()]
+        heapq.heapify(self._heap)
+
+    def _discard_stale(self):
+        while self._heap:
+            next_run, job_id = self._heap[0]
+            if self._next_runs.get(job_id) == next_run:
+                return
+            heapq.heappop(self._heap)
+
+    def peek(self):
+        """
+        Returns the earliest (next_run, job_id) pair, or None if the index is empty.
+        """
+        self._discard_stale()
+        if self._heap:
+            return self._heap[0]
+
+    def pop_due(self, now):
+        """
+        Removes and returns the ids of all jobs whose next run is at or before the given datetime.
+        """
+        job_ids = []
+        while 1:
+            top = self.peek()
+            if top is None or top[0] > now:
+                break
+            heapq.heappop(self._heap)
+            del self._next_runs[top[1]]
+            job_ids.append(top[1])
+        return job_ids
+
+
 def make_naive(dt, tz):
     if timezone.is_aware(dt):
         return timezone.make_naive(dt, tz)
@@ -532,3 +795,124 @@ def clean_samples(result):
     result = result.replace('}', '&#125;')
     result = result.replace('\n', '<br/>')
     return format_html(result)
+
+
+def parse_range_header(header, size):
+    """
+    Parses an HTTP Range header for a single byte range of a resource of the given size.
+
+    Returns a (start, end) tuple of the inclusive byte positions requested,
+    None if the header is missing or should be ignored, such as one that's malformed or asks for multiple ranges,
+    or raises ValueError if the range is valid but can't be satisfied.
+    """
+    if not header or not header.startswith('bytes=') or ',' in header:
+        return None
+    start, sep, end = header[len('bytes='):].strip().partition('-')
+    if not sep or not (start or end) or not all(_.isascii() and _.isdigit() for _ in (start, end) if _):
+        return None
+    if not start:
+        # A suffix range, asking for the last N bytes.
+        length = int(end)
+        if not length:
+            return None
+        if not size:
+            raise ValueError('Unsatisfiable range: %s' % header)
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        return None
+    if start >= size:
+        raise ValueError('Unsatisfiable range: %s' % header)
+    end = int(end) if end else size - 1
+    return start, min(end, size - 1)
+
+
+def iter_file(fileobj, start=0, length=None, chunk_size=65536):
+    """
+    Yields the contents of the binary file fileobj in chunks, starting at the given offset,
+    up to the given number of bytes, closing the file once done.
+    """
+    try:
+        if start:
+            # Compressed files can only seek by reading forward, which is still done in chunks.
+            fileobj.seek(start)
+        while length is None or length > 0:
+            data = fileobj.read(chunk_size if length is None else min(chunk_size, length))
+            if not data:
+                break
+            if length is not None:
+                length -= len(data)
+            yield data
+    finally:
+        fileobj.close()
+
+
+def iter_gzip(chunks, compresslevel=6):
+    """
+    Yields the given chunks of bytes gzip-compressed.
+    """
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def to_timestamp_ms(dt):
+    """
+    Returns the given datetime as milliseconds since the epoch, as used by JavaScript dates.
+    """
+    return int(round(dt.timestamp() * 1000))
+
+
+def from_timestamp_ms(ms):
+    """
+    Returns the datetime at the given number of milliseconds since the epoch, aware if time zones are in use.
+    """
+    dt = datetime.fromtimestamp(ms / 1000., tz=dt_timezone.utc)
+    if not settings.USE_TZ:
+        dt = timezone.make_naive(dt)
+    return dt
+
+
+def downsample_series(points, start, end, buckets):
+    """
+    Reduces a series of (x, y) points, sorted by x and all within [start, end], to at most the given number of
+    (x, min y, mean y, max y) points, one for each equal width bucket of x with any points,
+    at the x of the first point in the bucket.
+
+    The points are consumed one at a time, so they can be streamed from a query of any size.
+    """
+    width = max((end - start) / float(buckets), 1)
+    bucket = None
+    for x, y in points:
+        index = min(int((x - start) // width), buckets - 1)
+        if bucket is not None and index != bucket[0]:
+            yield bucket[1], bucket[2], bucket[3] / float(bucket[5]), bucket[4]
+            bucket = None
+        if bucket is None:
+            # [index, x, min, sum, max, count]
+            bucket = [index, x, y, 0, y, 0]
+        bucket[2] = min(bucket[2], y)
+        bucket[3] += y
+        bucket[4] = max(bucket[4], y)
+        bucket[5] += 1
+    if bucket is not None:
+        yield bucket[1], bucket[2], bucket[3] / float(bucket[5]), bucket[4]
+
+
+def merge_intervals(intervals, gap=0):
+    """
+    Merges a series of (start, end) intervals, sorted by start, that overlap or are within the given gap of each other.
+    """
+    current = None
+    for start, end in intervals:
+        if current is not None and start <= current[1] + gap:
+            current[1] = max(current[1], end)
+            continue
+        if current is not None:
+            yield tuple(current)
+        current = [start, end]
+    if current is not None:
+        yield tuple(current)